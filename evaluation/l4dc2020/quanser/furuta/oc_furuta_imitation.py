@@ -66,6 +66,9 @@ def evaluate(env, erarhmm, nb_rollouts, nb_steps, stoch=False, mix=False):
         x = env.reset()
         roll['x'] = np.vstack((roll['x'], x))
 
+        belief_filter = erarhmm.online_filter()
+        belief_filter.update(x)
+
         b = erarhmm.init_state.pi
         roll['b'] = np.vstack((roll['b'], b))
 
@@ -107,10 +110,7 @@ def evaluate(env, erarhmm, nb_rollouts, nb_steps, stoch=False, mix=False):
             roll['x'] = np.vstack((roll['x'], x))
             roll['r'] = np.hstack((roll['r'], r))
 
-            # pad action
-            _aux_u = np.vstack((roll['u'], np.zeros((1, dm_act))))
-
-            b = erarhmm.filter(roll['x'], _aux_u)[0][-1]
+            b = belief_filter.update(x, u)
             roll['b'] = np.vstack((roll['b'], b))
 
             u = np.zeros((dm_act, ))
@@ -1,4 +1,5 @@
 import numpy as np
+import numpy.random as npr
 
 from sds import HMM
 
@@ -12,24 +13,28 @@ class ARHMM(HMM):
 
     def __init__(self, nb_states, dm_obs, dm_act=0,
                  init_state_prior={}, init_obs_prior={}, trans_prior={}, obs_prior={},
-                 init_state_kwargs={}, init_obs_kwargs={}, trans_kwargs={}, obs_kwargs={}):
+                 init_state_kwargs={}, init_obs_kwargs={}, trans_kwargs={}, obs_kwargs={},
+                 trans_type='stationary'):
 
         super(ARHMM, self).__init__(nb_states, dm_obs, dm_act,
                                     init_state_prior=init_state_prior, trans_prior=trans_prior,
-                                    init_state_kwargs=init_state_kwargs, trans_kwargs=trans_kwargs)
+                                    init_state_kwargs=init_state_kwargs, trans_kwargs=trans_kwargs,
+                                    trans_type=trans_type)
 
+        # the first lags observations come from the initial distribution
         self.init_observation = GaussianInitObservation(self.nb_states, self.dm_obs, self.dm_act,
-                                                        prior=init_obs_prior, **init_obs_kwargs)
+                                                        prior=init_obs_prior, lags=obs_kwargs.get('lags', 1),
+                                                        **init_obs_kwargs)
         self.observations = AutoRegressiveGaussianObservation(self.nb_states, self.dm_obs, self.dm_act,
                                                               prior=obs_prior, **obs_kwargs)
 
     @ensure_args_are_viable_lists
     def log_likelihoods(self, obs, act=None):
-        loginit = self.init_state.log_init()
-        logtrans = self.transitions.log_transition(obs, act)
+        loginit = self.cache(self.init_state.log_init)
+        logtrans = self.cache(self.transitions.log_transition, obs, act, factored=True)
 
-        ilog = self.init_observation.log_likelihood(obs)
-        arlog = self.observations.log_likelihood(obs, act)
+        ilog = self.cache(self.init_observation.log_likelihood, obs)
+        arlog = self.cache(self.observations.log_likelihood, obs, act)
 
         logobs = []
         for _ilog, _arlog in zip(ilog, arlog):
@@ -40,8 +45,7 @@ class ARHMM(HMM):
     @ensure_args_are_viable_lists
     def mean_observation(self, obs, act=None):
         loglikhds = self.log_likelihoods(obs, act)
-        alpha, norm = self.forward(*loglikhds)
-        beta = self.backward(*loglikhds, scale=norm)
+        alpha, norm, beta = self.forward_backward(*loglikhds)
         gamma = self.posterior(alpha, beta)
 
         imu = self.init_observation.smooth(gamma, obs)
@@ -57,6 +61,7 @@ class ARHMM(HMM):
         state = []
         obs = []
 
+        lags = self.observations.lags
         for n in range(len(horizon)):
             _act = np.zeros((horizon[n], self.dm_act)) if act is None else act[n]
             _obs = np.zeros((horizon[n], self.dm_obs))
@@ -66,9 +71,22 @@ class ARHMM(HMM):
             _obs[0, :] = self.init_observation.sample(_state[0])
             for t in range(1, horizon[n]):
                 _state[t] = self.transitions.sample(_state[t - 1], _obs[t - 1, :], _act[t - 1, :])
-                _obs[t, :] = self.observations.sample(_state[t], _obs[t - 1, :], _act[t - 1, :])
+                if t < lags:
+                    _obs[t, :] = self.init_observation.sample(_state[t])
+                else:
+                    _obs[t, :] = self.observations.sample(_state[t], _obs[t - lags:t, :].ravel(),
+                                                          _act[t - 1, :])
 
             state.append(_state)
             obs.append(_obs)
 
         return state, obs
+
+    def _draw_batch(self, t, state, obs, act, noise):
+        # the first lags observations come from the initial distribution
+        lags = self.observations.lags
+        if t < lags:
+            return self.init_observation.draw(state[:, t], noise[:, t, :])
+        return self.observations.draw(state[:, t], noise[:, t, :],
+                                      obs[:, t - lags:t, :].reshape(len(obs), -1),
+                                      act[:, t - 1, :])
@@ -9,7 +9,9 @@ from scipy.stats import multivariate_normal as mvn
 from scipy.stats import invwishart as invw
 
 from sds.stats import multivariate_normal_logpdf as log_mvn
-from sds.utils import linear_regression, stack
+from sds.utils import linear_regression, lag_embed
+from sds.utils import params_version
+from sds.utils import batch_linear_regression, memoize
 
 from sklearn.preprocessing import PolynomialFeatures
 
@@ -47,6 +49,10 @@ class LinearGaussianControl:
     def params(self, value):
         self.K, self.kff, self._sqrt_cov = value
 
+    @property
+    def version(self):
+        return params_version(self.params)
+
     def featurize(self, x):
         feat = self.basis.fit_transform(np.atleast_2d(x)).squeeze()
         return feat
@@ -104,6 +110,7 @@ class LinearGaussianControl:
         self.K = self.K[perm, ...]
         self.kff = self.kff[perm, ...]
         self._sqrt_cov = self._sqrt_cov[perm, ...]
+        self.nb_states = len(perm)
 
     def log_prior(self):
         lp = 0.
@@ -123,6 +130,22 @@ class LinearGaussianControl:
             loglik.append(_loglik)
         return loglik
 
+    # log-likelihoods of the last steps of N windows, N x K
+    def log_likelihood_step(self, x, u):
+        return self.log_likelihood([x[:, -1, :]], [u[:, -1, :]])[0]
+
+    def regression_data(self, x, u):
+        # features with intercept and control targets
+        def _data():
+            xs, ys = [], []
+            for _x, _u in zip(x, u):
+                _feat = self.featurize(_x)
+                xs.append(np.hstack((_feat, np.ones((_feat.shape[0], 1)))))
+                ys.append(_u)
+            return xs, ys
+
+        return memoize(x, u, ('control', self.degree), _data)
+
     def mstep(self, gamma, x, u, weights=None, use_prior=False):
         aux = []
         if weights:
@@ -130,22 +153,13 @@ class LinearGaussianControl:
                aux.append(_w[:, None] * _gamma)
             gamma = aux
 
-        xs, ys, ws = [], [], []
-        for _x, _u, _w in zip(x, u, gamma):
-            _feat = self.featurize(_x)
-            xs.append(np.hstack((_feat, np.ones((_feat.shape[0], 1)))))
-            ys.append(_u)
-            ws.append(_w)
+        xs, ys = self.regression_data(x, u)
 
-        _cov = np.zeros((self.nb_states, self.dm_act, self.dm_act))
-        for k in range(self.nb_states):
-            coef_, sigma = linear_regression(Xs=np.vstack(xs), ys=np.vstack(ys),
-                                             weights=np.vstack(ws)[:, k], fit_intercept=False,
-                                             **self.prior if use_prior else {})
+        coef_, _cov = batch_linear_regression(Xs=xs, ys=ys, weights=gamma,
+                                              **self.prior if use_prior else {})
 
-            self.K[k, ...] = coef_[:, :self.dm_feat]
-            self.kff[k, ...] = coef_[:, -1]
-            _cov[k, ...] = sigma
+        self.K[...] = coef_[:, :, :self.dm_feat]
+        self.kff[...] = coef_[:, :, -1]
 
         # usage = sum([_gamma.sum(0) for _gamma in gamma])
         # unused = np.where(usage < 1)[0]
@@ -204,19 +218,17 @@ class AutoregRessiveLinearGaussianControl:
     def params(self, value):
         self.K, self.kff, self._sqrt_cov = value
 
+    @property
+    def version(self):
+        return params_version(self.params)
+
     def featurize(self, x):
         feat = self.basis.fit_transform(np.atleast_2d(x)).squeeze()
         return feat
 
-    # # stack ar observations and controls
-    # def stack(self, x):
-    #     _hr = len(x) - self.lags
-    #     _x = np.vstack([np.hstack([x[t + l] for l in range(self.lags + 1)]) for t in range(_hr)])
-    #     return np.squeeze(_x)
-
     def mean(self, z, x):
         feat = self.featurize(x)
-        _x = stack(feat, self.lags)
+        _x = np.squeeze(lag_embed(feat, self.lags))
         return np.einsum('kh,...h->...k', self.K[z, ...], _x) + self.kff[z, ...]
 
     @property
@@ -253,8 +265,7 @@ class AutoregRessiveLinearGaussianControl:
         _cov = np.zeros((self.nb_states, self.dm_act, self.dm_act))
         for k in range(self.nb_states):
             ts = [np.where(z == k)[0] for z in zs]
-            xs = [np.hstack([_feat[t + l] for l in range(self.lags + 1)])
-                  for t, _feat, _u in zip(ts, feat, u)]
+            xs = [lag_embed(_feat, self.lags)[t] for t, _feat in zip(ts, feat)]
             ys = [_u[t + self.lags] for t, _u in zip(ts, u)]
 
             coef_, intercept_, sigma = linear_regression(np.vstack(xs), np.vstack(ys),
@@ -270,6 +281,7 @@ class AutoregRessiveLinearGaussianControl:
         self.K = self.K[perm, ...]
         self.kff = self.kff[perm, ...]
         self._sqrt_cov = self._sqrt_cov[perm, ...]
+        self.nb_states = len(perm)
 
     def log_prior(self):
         lp = 0.
@@ -283,6 +295,29 @@ class AutoregRessiveLinearGaussianControl:
             loglik.append(_loglik)
         return loglik
 
+    # log-likelihoods of the last steps of N windows of
+    # lags + 1 observations and actions, N x K
+    def log_likelihood_step(self, x, u):
+        N, W, _ = x.shape
+        _feat = np.reshape(self.featurize(np.reshape(x[:, -self.lags - 1:, :], (N * (self.lags + 1), -1))),
+                           (N, -1))
+        _mu = np.einsum('kah,nh->nka', self.K, _feat) + self.kff[None, :, :]
+        return np.column_stack([log_mvn(u[:, -1, :], _mu[:, k, :], self.cov[k])
+                                for k in range(self.nb_states)])
+
+    def regression_data(self, x, u):
+        # lagged features with intercept and control targets
+        def _data():
+            xs, ys = [], []
+            for _x, _u in zip(x, u):
+                _feat = self.featurize(_x)
+                _x_in = lag_embed(_feat, self.lags)
+                xs.append(np.hstack((_x_in, np.ones((_x_in.shape[0], 1)))))
+                ys.append(_u[self.lags:])
+            return xs, ys
+
+        return memoize(x, u, ('ar-control', self.degree, self.lags), _data)
+
     def mstep(self, gamma, x, u, weights=None, use_prior=False):
         aux = []
         if weights:
@@ -290,23 +325,14 @@ class AutoregRessiveLinearGaussianControl:
                aux.append(_w[:, None] * _gamma)
             gamma = aux
 
-        xs, ys, ws = [], [], []
-        for _x, _u, _w in zip(x, u, gamma):
-            _feat = self.featurize(_x)
-            _x_in = stack(_feat, self.lags)
-            xs.append(np.hstack((_x_in, np.ones((_x_in.shape[0], 1)))))
-            ys.append(_u[self.lags:])
-            ws.append(_w[self.lags:])
+        xs, ys = self.regression_data(x, u)
+        ws = [_w[self.lags:] for _w in gamma]
 
-        _cov = np.zeros((self.nb_states, self.dm_act, self.dm_act))
-        for k in range(self.nb_states):
-            coef_, sigma = linear_regression(Xs=np.vstack(xs), ys=np.vstack(ys),
-                                             weights=np.vstack(ws)[:, k], fit_intercept=False,
-                                             **self.prior if use_prior else {})
+        coef_, _cov = batch_linear_regression(Xs=xs, ys=ys, weights=ws,
+                                              **self.prior if use_prior else {})
 
-            self.K[k, ...] = coef_[:, :(self.lags + 1) * self.dm_feat]
-            self.kff[k, ...] = coef_[:, -1]
-            _cov[k, ...] = sigma
+        self.K[...] = coef_[:, :, :(self.lags + 1) * self.dm_feat]
+        self.kff[...] = coef_[:, :, -1]
 
         # usage = sum([_gamma.sum(0) for _gamma in gamma])
         # unused = np.where(usage < 1)[0]
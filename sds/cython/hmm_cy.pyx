@@ -1,7 +1,12 @@
 import numpy as np
 cimport numpy as np
 
-from libc.math cimport log, exp, fmax, INFINITY
+cimport cython
+from cython.parallel import prange
+
+from libc.math cimport log, exp, sqrt, ceil, fmax, INFINITY
+from libc.stdlib cimport malloc, calloc, free
+from libc.string cimport memcpy
 
 
 cdef double logsumexp(double[::1] x) nogil:
@@ -73,3 +78,1693 @@ cpdef backward_cy(double[::1] loginit,
                 aux[j] = logtrans[t, k, j] + beta[t + 1, j]\
                          + logobs[t + 1, j] + logctl[t + 1, j]
             beta[t, k] = logsumexp(aux) - scale[t]
+
+
+# the batched kernels below operate on ragged buffers, sequence n
+# lives in rows offsets[n]:offsets[n + 1] of logobs, logctl, alpha,
+# norm, beta and gamma and in rows toffsets[n]:toffsets[n + 1] of
+# the transition terms. A transition is evaluated as
+#
+#   logtrans[r, j, k] + loginp[q, k] - lognorm[q, j]
+#
+# with q the transition step and r = q for dense transitions. For
+# stationary transitions logtrans is a single 1 x K x K matrix and
+# r = 0. Factored recurrent transitions pass the K x K matrix plus the
+# input-dependent loginp and let the kernels fill in lognorm, dense
+# and stationary transitions pass zeros for loginp and lognorm.
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _lognorm(double[:,:,::1] logtrans,
+                   double[:,::1] loginp,
+                   double[:,::1] lognorm,
+                   Py_ssize_t tstart,
+                   Py_ssize_t tstop,
+                   Py_ssize_t tstep) noexcept nogil:
+
+    cdef Py_ssize_t K, q, r, k, j
+    cdef double m, out
+
+    K = loginp.shape[1]
+
+    for q in range(tstart, tstop):
+        r = q * tstep
+        for j in range(K):
+            m = -INFINITY
+            for k in range(K):
+                m = fmax(m, logtrans[r, j, k] + loginp[q, k])
+            out = 0
+            for k in range(K):
+                out += exp(logtrans[r, j, k] + loginp[q, k] - m)
+            lognorm[q, j] = m + log(out)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _forward(double[::1] loginit,
+                   double[:,:,::1] logtrans,
+                   double[:,::1] loginp,
+                   double[:,::1] lognorm,
+                   double[:,::1] logobs,
+                   double[:,::1] logctl,
+                   double[:,::1] alpha,
+                   double[::1] norm,
+                   Py_ssize_t start,
+                   Py_ssize_t stop,
+                   Py_ssize_t tstart,
+                   Py_ssize_t tstep) noexcept nogil:
+
+    cdef Py_ssize_t K, t, k, j, q, r
+    cdef double m, out
+
+    K = logobs.shape[1]
+
+    for k in range(K):
+        alpha[start, k] = loginit[k] + logobs[start, k]
+
+    m = -INFINITY
+    for k in range(K):
+        m = fmax(m, alpha[start, k])
+    out = 0
+    for k in range(K):
+        out += exp(alpha[start, k] - m)
+    norm[start] = m + log(out)
+
+    for k in range(K):
+        alpha[start, k] = alpha[start, k] - norm[start]
+
+    for t in range(start + 1, stop):
+        q = tstart + t - 1 - start
+        r = q * tstep
+        for k in range(K):
+            m = -INFINITY
+            for j in range(K):
+                m = fmax(m, alpha[t - 1, j] + logtrans[r, j, k] - lognorm[q, j])
+            out = 0
+            for j in range(K):
+                out += exp(alpha[t - 1, j] + logtrans[r, j, k] - lognorm[q, j] - m)
+            alpha[t, k] = m + log(out) + loginp[q, k] + logobs[t, k] + logctl[t, k]
+
+        m = -INFINITY
+        for k in range(K):
+            m = fmax(m, alpha[t, k])
+        out = 0
+        for k in range(K):
+            out += exp(alpha[t, k] - m)
+        norm[t] = m + log(out)
+
+        for k in range(K):
+            alpha[t, k] = alpha[t, k] - norm[t]
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _backward(double[::1] loginit,
+                    double[:,:,::1] logtrans,
+                    double[:,::1] loginp,
+                    double[:,::1] lognorm,
+                    double[:,::1] logobs,
+                    double[:,::1] logctl,
+                    double[:,::1] beta,
+                    double[::1] scale,
+                    Py_ssize_t start,
+                    Py_ssize_t stop,
+                    Py_ssize_t tstart,
+                    Py_ssize_t tstep) noexcept nogil:
+
+    cdef Py_ssize_t K, t, k, j, q, r
+    cdef double m, out
+
+    K = logobs.shape[1]
+
+    for k in range(K):
+        beta[stop - 1, k] = 0.0 - scale[stop - 1]
+
+    for t in range(stop - 2, start - 1, -1):
+        q = tstart + t - start
+        r = q * tstep
+        for k in range(K):
+            m = -INFINITY
+            for j in range(K):
+                m = fmax(m, logtrans[r, k, j] + loginp[q, j] + beta[t + 1, j]
+                         + logobs[t + 1, j] + logctl[t + 1, j])
+            out = 0
+            for j in range(K):
+                out += exp(logtrans[r, k, j] + loginp[q, j] + beta[t + 1, j]
+                           + logobs[t + 1, j] + logctl[t + 1, j] - m)
+            beta[t, k] = m + log(out) - lognorm[q, k] - scale[t]
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _posterior(double[:,::1] alpha,
+                     double[:,::1] beta,
+                     double[:,::1] gamma,
+                     Py_ssize_t start,
+                     Py_ssize_t stop) noexcept nogil:
+
+    cdef Py_ssize_t K, t, k
+    cdef double m, out
+
+    K = alpha.shape[1]
+
+    for t in range(start, stop):
+        m = -INFINITY
+        for k in range(K):
+            m = fmax(m, alpha[t, k] + beta[t, k])
+        out = 0
+        for k in range(K):
+            gamma[t, k] = exp(alpha[t, k] + beta[t, k] - m)
+            out += gamma[t, k]
+        for k in range(K):
+            gamma[t, k] = gamma[t, k] / out
+
+
+# writes the normalized joint posterior of step t into
+# zeta[zstart + t - start], T - 1 rows per sequence
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _joint_posterior(double[:,:,::1] logtrans,
+                           double[:,::1] loginp,
+                           double[:,::1] lognorm,
+                           double[:,::1] logobs,
+                           double[:,::1] logctl,
+                           double[:,::1] alpha,
+                           double[:,::1] beta,
+                           double[:,:,::1] zeta,
+                           Py_ssize_t start,
+                           Py_ssize_t stop,
+                           Py_ssize_t tstart,
+                           Py_ssize_t tstep,
+                           Py_ssize_t zstart) noexcept nogil:
+
+    cdef Py_ssize_t K, t, k, j, q, r, z
+    cdef double m, out
+
+    K = logobs.shape[1]
+
+    for t in range(start, stop - 1):
+        q = tstart + t - start
+        r = q * tstep
+        z = zstart + t - start
+
+        m = -INFINITY
+        for j in range(K):
+            for k in range(K):
+                zeta[z, j, k] = alpha[t, j] + beta[t + 1, k]\
+                                + logtrans[r, j, k] + loginp[q, k] - lognorm[q, j]\
+                                + logobs[t + 1, k] + logctl[t + 1, k]
+                m = fmax(m, zeta[z, j, k])
+
+        out = 0
+        for j in range(K):
+            for k in range(K):
+                zeta[z, j, k] = exp(zeta[z, j, k] - m)
+                out += zeta[z, j, k]
+
+        for j in range(K):
+            for k in range(K):
+                zeta[z, j, k] = zeta[z, j, k] / out
+
+
+# accumulates the joint posterior over time into
+# counts[n] without materializing the T x K x K tensor
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _joint_posterior_sum(double[:,:,::1] logtrans,
+                               double[:,::1] loginp,
+                               double[:,::1] lognorm,
+                               double[:,::1] logobs,
+                               double[:,::1] logctl,
+                               double[:,::1] alpha,
+                               double[:,::1] beta,
+                               double[:,:,::1] counts,
+                               Py_ssize_t n,
+                               Py_ssize_t start,
+                               Py_ssize_t stop,
+                               Py_ssize_t tstart,
+                               Py_ssize_t tstep) noexcept nogil:
+
+    cdef Py_ssize_t K, t, k, j, q, r
+    cdef double m, out
+
+    K = logobs.shape[1]
+
+    for j in range(K):
+        for k in range(K):
+            counts[n, j, k] = 0.0
+
+    cdef double* aux = <double*> malloc(K * K * sizeof(double))
+
+    for t in range(start, stop - 1):
+        q = tstart + t - start
+        r = q * tstep
+
+        m = -INFINITY
+        for j in range(K):
+            for k in range(K):
+                aux[j * K + k] = alpha[t, j] + beta[t + 1, k]\
+                                 + logtrans[r, j, k] + loginp[q, k] - lognorm[q, j]\
+                                 + logobs[t + 1, k] + logctl[t + 1, k]
+                m = fmax(m, aux[j * K + k])
+
+        out = 0
+        for j in range(K * K):
+            aux[j] = exp(aux[j] - m)
+            out += aux[j]
+
+        for j in range(K):
+            for k in range(K):
+                counts[n, j, k] += aux[j * K + k] / out
+
+    free(aux)
+
+
+# accumulates the joint posterior over time into counts[n] and writes
+# its from- and to-state marginals of step t into frm and to at row
+# zstart + t - start, the T x K x K tensor is never materialized
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _joint_posterior_marginals(double[:,:,::1] logtrans,
+                                     double[:,::1] loginp,
+                                     double[:,::1] lognorm,
+                                     double[:,::1] logobs,
+                                     double[:,::1] logctl,
+                                     double[:,::1] alpha,
+                                     double[:,::1] beta,
+                                     double[:,:,::1] counts,
+                                     double[:,::1] frm,
+                                     double[:,::1] to,
+                                     Py_ssize_t n,
+                                     Py_ssize_t start,
+                                     Py_ssize_t stop,
+                                     Py_ssize_t tstart,
+                                     Py_ssize_t tstep,
+                                     Py_ssize_t zstart) noexcept nogil:
+
+    cdef Py_ssize_t K, t, k, j, q, r, z
+    cdef double m, out, p
+
+    K = logobs.shape[1]
+
+    for j in range(K):
+        for k in range(K):
+            counts[n, j, k] = 0.0
+
+    cdef double* aux = <double*> malloc(K * K * sizeof(double))
+
+    for t in range(start, stop - 1):
+        q = tstart + t - start
+        r = q * tstep
+        z = zstart + t - start
+
+        m = -INFINITY
+        for j in range(K):
+            for k in range(K):
+                aux[j * K + k] = alpha[t, j] + beta[t + 1, k]\
+                                 + logtrans[r, j, k] + loginp[q, k] - lognorm[q, j]\
+                                 + logobs[t + 1, k] + logctl[t + 1, k]
+                m = fmax(m, aux[j * K + k])
+
+        out = 0
+        for j in range(K * K):
+            aux[j] = exp(aux[j] - m)
+            out += aux[j]
+
+        for k in range(K):
+            frm[z, k] = 0.0
+            to[z, k] = 0.0
+
+        for j in range(K):
+            for k in range(K):
+                p = aux[j * K + k] / out
+                counts[n, j, k] += p
+                frm[z, j] += p
+                to[z, k] += p
+
+    free(aux)
+
+
+# subtracts the log-normalizer from x in place and returns it
+cdef double _normalize(double* x, Py_ssize_t K) noexcept nogil:
+    cdef Py_ssize_t k
+    cdef double m, out
+
+    m = -INFINITY
+    for k in range(K):
+        m = fmax(m, x[k])
+    out = 0
+    for k in range(K):
+        out += exp(x[k] - m)
+    out = m + log(out)
+
+    for k in range(K):
+        x[k] = x[k] - out
+    return out
+
+
+# one step of the forward recursion on scratch vectors,
+# curr is the normalized alpha[t] given prev = alpha[t - 1]
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef double _forward_step(double[:,:,::1] logtrans,
+                          double[:,::1] loginp,
+                          double[:,::1] lognorm,
+                          double[:,::1] logobs,
+                          double[:,::1] logctl,
+                          double* prev,
+                          double* curr,
+                          Py_ssize_t t,
+                          Py_ssize_t q,
+                          Py_ssize_t r) noexcept nogil:
+
+    cdef Py_ssize_t K, k, j
+    cdef double m, out
+
+    K = logobs.shape[1]
+
+    for k in range(K):
+        m = -INFINITY
+        for j in range(K):
+            m = fmax(m, prev[j] + logtrans[r, j, k] - lognorm[q, j])
+        out = 0
+        for j in range(K):
+            out += exp(prev[j] + logtrans[r, j, k] - lognorm[q, j] - m)
+        curr[k] = m + log(out) + loginp[q, k] + logobs[t, k] + logctl[t, k]
+
+    return _normalize(curr, K)
+
+
+# one step of the backward recursion on scratch vectors, curr is
+# the unscaled beta[t] given next = beta[t + 1]
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _backward_step(double[:,:,::1] logtrans,
+                         double[:,::1] loginp,
+                         double[:,::1] lognorm,
+                         double[:,::1] logobs,
+                         double[:,::1] logctl,
+                         double* next,
+                         double* curr,
+                         Py_ssize_t t,
+                         Py_ssize_t q,
+                         Py_ssize_t r) noexcept nogil:
+
+    cdef Py_ssize_t K, k, j
+    cdef double m, out
+
+    K = logobs.shape[1]
+
+    for k in range(K):
+        m = -INFINITY
+        for j in range(K):
+            m = fmax(m, logtrans[r, k, j] + loginp[q, j] + next[j]
+                     + logobs[t + 1, j] + logctl[t + 1, j])
+        out = 0
+        for j in range(K):
+            out += exp(logtrans[r, k, j] + loginp[q, j] + next[j]
+                       + logobs[t + 1, j] + logctl[t + 1, j] - m)
+        curr[k] = m + log(out) - lognorm[q, k]
+
+
+# smoothing with alpha kept only every stride steps, segments are
+# recomputed during the backward sweep and beta is a single rolling
+# vector. Writes gamma, accumulates the time-summed joint posterior
+# into counts[n] and the log-likelihood into loglik[n], scratch
+# memory is O((T / stride + stride) K). With marginals, also writes
+# the from- and to-state marginals of step t into frm and to at row
+# zstart + t - start, as recurrent transitions need them
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _checkpointed_statistics(double[::1] loginit,
+                                   double[:,:,::1] logtrans,
+                                   double[:,::1] loginp,
+                                   double[:,::1] lognorm,
+                                   double[:,::1] logobs,
+                                   double[:,::1] logctl,
+                                   double[:,::1] gamma,
+                                   double[:,:,::1] counts,
+                                   double[:,::1] frm,
+                                   double[:,::1] to,
+                                   bint marginals,
+                                   double[::1] loglik,
+                                   Py_ssize_t n,
+                                   Py_ssize_t start,
+                                   Py_ssize_t stop,
+                                   Py_ssize_t tstart,
+                                   Py_ssize_t tstep,
+                                   Py_ssize_t zstart,
+                                   Py_ssize_t stride) noexcept nogil:
+
+    cdef Py_ssize_t K, T, t, k, j, q, r, c, s0, s1, z, nb_ckpts
+    cdef double m, out, p
+
+    K = logobs.shape[1]
+    T = stop - start
+
+    if stride <= 0:
+        stride = <Py_ssize_t> ceil(sqrt(<double> T))
+    nb_ckpts = (T + stride - 1) // stride
+
+    cdef double* ckpt = <double*> malloc(nb_ckpts * K * sizeof(double))
+    cdef double* seg = <double*> malloc((stride if stride > 1 else 2) * K * sizeof(double))
+    cdef double* beta = <double*> malloc(K * sizeof(double))
+    cdef double* aux = <double*> malloc(K * K * sizeof(double))
+
+    # forward sweep, alpha is only kept at the checkpoints
+    for k in range(K):
+        seg[k] = loginit[k] + logobs[start, k]
+    loglik[n] = _normalize(seg, K)
+    memcpy(ckpt, seg, K * sizeof(double))
+
+    for t in range(start + 1, stop):
+        q = tstart + t - 1 - start
+        r = q * tstep
+        c = (t - start) % 2
+        loglik[n] += _forward_step(logtrans, loginp, lognorm, logobs, logctl,
+                                   &seg[(1 - c) * K], &seg[c * K], t, q, r)
+        if (t - start) % stride == 0:
+            memcpy(&ckpt[((t - start) // stride) * K], &seg[c * K], K * sizeof(double))
+
+    # backward sweep over segments in reverse
+    for j in range(K):
+        for k in range(K):
+            counts[n, j, k] = 0.0
+
+    for k in range(K):
+        beta[k] = 0.0
+
+    for c in range(nb_ckpts - 1, -1, -1):
+        s0 = start + c * stride
+        s1 = s0 + stride if s0 + stride < stop else stop
+
+        memcpy(seg, &ckpt[c * K], K * sizeof(double))
+        for t in range(s0 + 1, s1):
+            q = tstart + t - 1 - start
+            r = q * tstep
+            _forward_step(logtrans, loginp, lognorm, logobs, logctl,
+                          &seg[(t - s0 - 1) * K], &seg[(t - s0) * K], t, q, r)
+
+        for t in range(s1 - 1, s0 - 1, -1):
+            if t < stop - 1:
+                q = tstart + t - start
+                r = q * tstep
+
+                # joint posterior of step t with beta holding beta[t + 1]
+                m = -INFINITY
+                for j in range(K):
+                    for k in range(K):
+                        aux[j * K + k] = seg[(t - s0) * K + j] + beta[k]\
+                                         + logtrans[r, j, k] + loginp[q, k] - lognorm[q, j]\
+                                         + logobs[t + 1, k] + logctl[t + 1, k]
+                        m = fmax(m, aux[j * K + k])
+
+                out = 0
+                for j in range(K * K):
+                    aux[j] = exp(aux[j] - m)
+                    out += aux[j]
+
+                z = zstart + t - start
+                if marginals:
+                    for k in range(K):
+                        frm[z, k] = 0.0
+                        to[z, k] = 0.0
+
+                for j in range(K):
+                    for k in range(K):
+                        p = aux[j * K + k] / out
+                        counts[n, j, k] += p
+                        if marginals:
+                            frm[z, j] += p
+                            to[z, k] += p
+
+                # roll beta back to step t
+                _backward_step(logtrans, loginp, lognorm, logobs, logctl,
+                               beta, aux, t, q, r)
+                for k in range(K):
+                    beta[k] = aux[k]
+                _normalize(beta, K)
+
+            m = -INFINITY
+            for k in range(K):
+                m = fmax(m, seg[(t - s0) * K + k] + beta[k])
+            out = 0
+            for k in range(K):
+                gamma[t, k] = exp(seg[(t - s0) * K + k] + beta[k] - m)
+                out += gamma[t, k]
+            for k in range(K):
+                gamma[t, k] = gamma[t, k] / out
+
+    free(ckpt)
+    free(seg)
+    free(beta)
+    free(aux)
+
+
+# parallel-in-time forward and backward. With the step matrices
+#
+#   M_t[j, k] = logtrans[r, j, k] + loginp[q, k] - lognorm[q, j]
+#               + logobs[t, k] + logctl[t, k]
+#
+# both recursions are products in the log-semiring, alpha[t] is
+# alpha[t - 1] (x) M_t and beta[t - 1] is M_t (x) beta[t]. A sequence
+# is cut into blocks, the block products are formed in parallel,
+# carried across block boundaries sequentially and the recursion is
+# then rerun inside every block in parallel from its carried value.
+# Block b covers rows b0:b1 and its product P[b] spans M_{b0 + 1}
+# up to M_{e}, with e = b1 the start of the next block, or the
+# last row for the final block.
+
+
+# P[b] = M_{t0} (x) ... (x) M_{t1}, the identity if the range is empty
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _block_product(double[:,:,::1] logtrans,
+                         double[:,::1] loginp,
+                         double[:,::1] lognorm,
+                         double[:,::1] logobs,
+                         double[:,::1] logctl,
+                         double[:,:,::1] P,
+                         Py_ssize_t b,
+                         Py_ssize_t t0,
+                         Py_ssize_t t1,
+                         Py_ssize_t start,
+                         Py_ssize_t tstart,
+                         Py_ssize_t tstep) noexcept nogil:
+
+    cdef Py_ssize_t K, t, i, j, k, q, r
+    cdef double m, out
+
+    K = logobs.shape[1]
+
+    for i in range(K):
+        for k in range(K):
+            P[b, i, k] = 0.0 if i == k else -INFINITY
+
+    cdef double* aux = <double*> malloc(K * K * sizeof(double))
+
+    for t in range(t0, t1 + 1):
+        q = tstart + t - 1 - start
+        r = q * tstep
+
+        for i in range(K):
+            for k in range(K):
+                m = -INFINITY
+                for j in range(K):
+                    m = fmax(m, P[b, i, j] + logtrans[r, j, k] - lognorm[q, j])
+                out = 0
+                for j in range(K):
+                    out += exp(P[b, i, j] + logtrans[r, j, k] - lognorm[q, j] - m)
+                aux[i * K + k] = m + log(out) + loginp[q, k] + logobs[t, k] + logctl[t, k]
+
+        for i in range(K):
+            for k in range(K):
+                P[b, i, k] = aux[i * K + k]
+
+    free(aux)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _forward_scan(double[::1] loginit,
+                        double[:,:,::1] logtrans,
+                        double[:,::1] loginp,
+                        double[:,::1] lognorm,
+                        double[:,::1] logobs,
+                        double[:,::1] logctl,
+                        double[:,::1] alpha,
+                        double[::1] norm,
+                        double[:,:,::1] P,
+                        double[:,::1] carry,
+                        Py_ssize_t start,
+                        Py_ssize_t stop,
+                        Py_ssize_t tstart,
+                        Py_ssize_t tstep,
+                        Py_ssize_t nb_blocks,
+                        int nb_threads) noexcept nogil:
+
+    cdef Py_ssize_t K, L, B, b, b0, b1, t, k, j, q, r
+    cdef double m, out
+
+    K = logobs.shape[1]
+
+    L = (stop - start + nb_blocks - 1) // nb_blocks
+    B = (stop - start + L - 1) // L
+
+    for b in prange(B, schedule='static', num_threads=nb_threads):
+        b0 = start + b * L
+        b1 = b0 + L if b0 + L < stop else stop - 1
+        _block_product(logtrans, loginp, lognorm, logobs, logctl,
+                       P, b, b0 + 1, b1, start, tstart, tstep)
+
+    for k in range(K):
+        alpha[start, k] = loginit[k] + logobs[start, k]
+    norm[start] = _normalize(&alpha[start, 0], K)
+
+    # normalized alpha at the block starts
+    for k in range(K):
+        carry[0, k] = alpha[start, k]
+
+    for b in range(B - 1):
+        for k in range(K):
+            m = -INFINITY
+            for j in range(K):
+                m = fmax(m, carry[b, j] + P[b, j, k])
+            out = 0
+            for j in range(K):
+                out += exp(carry[b, j] + P[b, j, k] - m)
+            carry[b + 1, k] = m + log(out)
+        _normalize(&carry[b + 1, 0], K)
+
+    # every block fills rows b0 + 1 up to its end
+    for b in prange(B, schedule='static', num_threads=nb_threads):
+        b0 = start + b * L
+        b1 = b0 + L if b0 + L < stop else stop - 1
+        for t in range(b0 + 1, b1 + 1):
+            q = tstart + t - 1 - start
+            r = q * tstep
+            norm[t] = _forward_step(logtrans, loginp, lognorm, logobs, logctl,
+                                    &carry[b, 0] if t == b0 + 1 else &alpha[t - 1, 0],
+                                    &alpha[t, 0], t, q, r)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _backward_scan(double[:,:,::1] logtrans,
+                         double[:,::1] loginp,
+                         double[:,::1] lognorm,
+                         double[:,::1] logobs,
+                         double[:,::1] logctl,
+                         double[:,::1] beta,
+                         double[::1] scale,
+                         double[:,:,::1] P,
+                         double[:,::1] carry,
+                         Py_ssize_t start,
+                         Py_ssize_t stop,
+                         Py_ssize_t tstart,
+                         Py_ssize_t tstep,
+                         Py_ssize_t nb_blocks,
+                         int nb_threads) noexcept nogil:
+
+    cdef Py_ssize_t K, L, B, b, b0, b1, t, i, k, j, q, r
+    cdef double m, out, acc
+
+    K = logobs.shape[1]
+
+    L = (stop - start + nb_blocks - 1) // nb_blocks
+    B = (stop - start + L - 1) // L
+
+    for b in prange(B, schedule='static', num_threads=nb_threads):
+        b0 = start + b * L
+        b1 = b0 + L if b0 + L < stop else stop - 1
+        _block_product(logtrans, loginp, lognorm, logobs, logctl,
+                       P, b, b0 + 1, b1, start, tstart, tstep)
+
+    # scaled beta at the block starts, carry[B] holds the last row
+    for k in range(K):
+        carry[B, k] = 0.0 - scale[stop - 1]
+
+    for b in range(B - 1, -1, -1):
+        b0 = start + b * L
+        b1 = b0 + L if b0 + L < stop else stop - 1
+
+        acc = 0.0
+        for t in range(b0, b1):
+            acc = acc + scale[t]
+
+        for i in range(K):
+            m = -INFINITY
+            for j in range(K):
+                m = fmax(m, P[b, i, j] + carry[b + 1, j])
+            out = 0
+            for j in range(K):
+                out += exp(P[b, i, j] + carry[b + 1, j] - m)
+            carry[b, i] = m + log(out) - acc
+
+    for k in range(K):
+        beta[stop - 1, k] = carry[B, k]
+
+    # every block fills rows b0 up to its end
+    for b in prange(B, schedule='static', num_threads=nb_threads):
+        b0 = start + b * L
+        b1 = b0 + L if b0 + L < stop else stop - 1
+        for t in range(b1 - 1, b0 - 1, -1):
+            q = tstart + t - start
+            r = q * tstep
+            _backward_step(logtrans, loginp, lognorm, logobs, logctl,
+                           &carry[b + 1, 0] if t == b1 - 1 else &beta[t + 1, 0],
+                           &beta[t, 0], t, q, r)
+            for k in range(K):
+                beta[t, k] = beta[t, k] - scale[t]
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _viterbi(double[::1] loginit,
+                   double[:,:,::1] logtrans,
+                   double[:,::1] loginp,
+                   double[:,::1] lognorm,
+                   double[:,::1] logobs,
+                   double[:,::1] logctl,
+                   double[:,::1] delta,
+                   np.int64_t[:,::1] args,
+                   np.int64_t[::1] z,
+                   Py_ssize_t start,
+                   Py_ssize_t stop,
+                   Py_ssize_t tstart,
+                   Py_ssize_t tstep) noexcept nogil:
+
+    cdef Py_ssize_t K, t, k, j, q, r, arg
+    cdef double m, aux
+
+    K = logobs.shape[1]
+
+    for k in range(K):
+        delta[stop - 1, k] = 0.0
+
+    for t in range(stop - 2, start - 1, -1):
+        q = tstart + t - start
+        r = q * tstep
+        for j in range(K):
+            m = -INFINITY
+            arg = 0
+            for k in range(K):
+                aux = logtrans[r, j, k] + loginp[q, k] + delta[t + 1, k]\
+                      + logobs[t + 1, k] + logctl[t + 1, k]
+                if aux > m:
+                    m = aux
+                    arg = k
+            delta[t, j] = m - lognorm[q, j]
+            args[t + 1, j] = arg
+
+    m = -INFINITY
+    arg = 0
+    for k in range(K):
+        aux = loginit[k] + delta[start, k] + logobs[start, k]
+        if aux > m:
+            m = aux
+            arg = k
+    z[start] = arg
+
+    for t in range(start + 1, stop):
+        z[t] = args[t, z[t - 1]]
+
+
+# beam-pruned smoothing, after the forward step of time t only the size
+# most likely states of alpha[t] that also carry at least threshold of
+# its mass survive, their indices are kept in active[t, :nb_active[t]].
+# alpha is not renormalized after pruning, the discarded mass shows up
+# in the next normalizer and the summed normalizer is the log-likelihood
+# of the surviving paths, a lower bound on the exact one. Forward steps
+# cost O(K B), backward steps and joint posteriors O(B^2).
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef double _prune(double[:,::1] alpha,
+                   Py_ssize_t[:,::1] active,
+                   Py_ssize_t[::1] nb_active,
+                   Py_ssize_t t,
+                   Py_ssize_t size,
+                   double threshold) noexcept nogil:
+
+    cdef Py_ssize_t K, B, b, k, arg, nb
+    cdef double m, out
+
+    K = alpha.shape[1]
+    B = K if size <= 0 or size > K else size
+
+    nb = 0
+    if B == K and threshold <= 0.0:
+        for k in range(K):
+            active[t, k] = k
+        nb_active[t] = K
+        return 0.0
+
+    cdef unsigned char* keep = <unsigned char*> calloc(K, sizeof(unsigned char))
+
+    # selection in decreasing order, alpha[t] is normalized
+    for b in range(B):
+        m = -INFINITY
+        arg = -1
+        for k in range(K):
+            if keep[k] == 0 and alpha[t, k] > m:
+                m = alpha[t, k]
+                arg = k
+        if arg < 0 or (b > 0 and exp(m) < threshold):
+            break
+        keep[arg] = 1
+
+    out = 0.0
+    for k in range(K):
+        if keep[k] == 1:
+            active[t, nb] = k
+            nb = nb + 1
+            out += exp(alpha[t, k])
+        else:
+            alpha[t, k] = -INFINITY
+    nb_active[t] = nb
+
+    free(keep)
+    return fmax(1.0 - out, 0.0)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _forward_beam(double[::1] loginit,
+                        double[:,:,::1] logtrans,
+                        double[:,::1] loginp,
+                        double[:,::1] lognorm,
+                        double[:,::1] logobs,
+                        double[:,::1] logctl,
+                        double[:,::1] alpha,
+                        double[::1] norm,
+                        Py_ssize_t[:,::1] active,
+                        Py_ssize_t[::1] nb_active,
+                        double[::1] pruned,
+                        Py_ssize_t start,
+                        Py_ssize_t stop,
+                        Py_ssize_t tstart,
+                        Py_ssize_t tstep,
+                        bint factored,
+                        Py_ssize_t size,
+                        double threshold) noexcept nogil:
+
+    cdef Py_ssize_t K, t, k, j, b, q, r
+    cdef double m, out
+
+    K = logobs.shape[1]
+
+    for k in range(K):
+        alpha[start, k] = loginit[k] + logobs[start, k]
+    norm[start] = _normalize(&alpha[start, 0], K)
+
+    # the last step is never pruned
+    if start < stop - 1:
+        pruned[start] = _prune(alpha, active, nb_active, start, size, threshold)
+    else:
+        pruned[start] = _prune(alpha, active, nb_active, start, 0, 0.0)
+
+    for t in range(start + 1, stop):
+        q = tstart + t - 1 - start
+        r = q * tstep
+
+        # input normalizers of the surviving rows only
+        if factored:
+            for b in range(nb_active[t - 1]):
+                j = active[t - 1, b]
+                m = -INFINITY
+                for k in range(K):
+                    m = fmax(m, logtrans[r, j, k] + loginp[q, k])
+                out = 0
+                for k in range(K):
+                    out += exp(logtrans[r, j, k] + loginp[q, k] - m)
+                lognorm[q, j] = m + log(out)
+
+        for k in range(K):
+            m = -INFINITY
+            for b in range(nb_active[t - 1]):
+                j = active[t - 1, b]
+                m = fmax(m, alpha[t - 1, j] + logtrans[r, j, k] - lognorm[q, j])
+            out = 0
+            for b in range(nb_active[t - 1]):
+                j = active[t - 1, b]
+                out += exp(alpha[t - 1, j] + logtrans[r, j, k] - lognorm[q, j] - m)
+            alpha[t, k] = m + log(out) + loginp[q, k] + logobs[t, k] + logctl[t, k]
+
+        norm[t] = _normalize(&alpha[t, 0], K)
+        if t < stop - 1:
+            pruned[t] = _prune(alpha, active, nb_active, t, size, threshold)
+        else:
+            pruned[t] = _prune(alpha, active, nb_active, t, 0, 0.0)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _backward_beam(double[:,:,::1] logtrans,
+                         double[:,::1] loginp,
+                         double[:,::1] lognorm,
+                         double[:,::1] logobs,
+                         double[:,::1] logctl,
+                         double[:,::1] beta,
+                         double[::1] scale,
+                         Py_ssize_t[:,::1] active,
+                         Py_ssize_t[::1] nb_active,
+                         Py_ssize_t start,
+                         Py_ssize_t stop,
+                         Py_ssize_t tstart,
+                         Py_ssize_t tstep) noexcept nogil:
+
+    cdef Py_ssize_t K, t, k, j, a, b, q, r
+    cdef double m, out
+
+    K = logobs.shape[1]
+
+    for k in range(K):
+        beta[stop - 1, k] = 0.0 - scale[stop - 1]
+
+    for t in range(stop - 2, start - 1, -1):
+        q = tstart + t - start
+        r = q * tstep
+
+        for k in range(K):
+            beta[t, k] = -INFINITY
+
+        for a in range(nb_active[t]):
+            k = active[t, a]
+            m = -INFINITY
+            for b in range(nb_active[t + 1]):
+                j = active[t + 1, b]
+                m = fmax(m, logtrans[r, k, j] + loginp[q, j] + beta[t + 1, j]
+                         + logobs[t + 1, j] + logctl[t + 1, j])
+            out = 0
+            for b in range(nb_active[t + 1]):
+                j = active[t + 1, b]
+                out += exp(logtrans[r, k, j] + loginp[q, j] + beta[t + 1, j]
+                           + logobs[t + 1, j] + logctl[t + 1, j] - m)
+            beta[t, k] = m + log(out) - lognorm[q, k] - scale[t]
+
+
+# normalized joint posterior of the surviving pairs of step t, written
+# into zeta[zstart + t - start] if dense, else added to counts[n]
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _joint_posterior_beam(double[:,:,::1] logtrans,
+                                double[:,::1] loginp,
+                                double[:,::1] lognorm,
+                                double[:,::1] logobs,
+                                double[:,::1] logctl,
+                                double[:,::1] alpha,
+                                double[:,::1] beta,
+                                Py_ssize_t[:,::1] active,
+                                Py_ssize_t[::1] nb_active,
+                                double[:,:,::1] zeta,
+                                bint dense,
+                                Py_ssize_t n,
+                                Py_ssize_t start,
+                                Py_ssize_t stop,
+                                Py_ssize_t tstart,
+                                Py_ssize_t tstep,
+                                Py_ssize_t zstart) noexcept nogil:
+
+    cdef Py_ssize_t K, t, k, j, a, b, q, r, z
+    cdef double m, out, v
+
+    K = logobs.shape[1]
+
+    if not dense:
+        for j in range(K):
+            for k in range(K):
+                zeta[n, j, k] = 0.0
+
+    for t in range(start, stop - 1):
+        q = tstart + t - start
+        r = q * tstep
+        z = zstart + t - start if dense else n
+
+        # max and sum first, the pairs are revisited instead of buffered
+        m = -INFINITY
+        for a in range(nb_active[t]):
+            j = active[t, a]
+            for b in range(nb_active[t + 1]):
+                k = active[t + 1, b]
+                m = fmax(m, alpha[t, j] + beta[t + 1, k]
+                         + logtrans[r, j, k] + loginp[q, k] - lognorm[q, j]
+                         + logobs[t + 1, k] + logctl[t + 1, k])
+
+        out = 0
+        for a in range(nb_active[t]):
+            j = active[t, a]
+            for b in range(nb_active[t + 1]):
+                k = active[t + 1, b]
+                out += exp(alpha[t, j] + beta[t + 1, k]
+                           + logtrans[r, j, k] + loginp[q, k] - lognorm[q, j]
+                           + logobs[t + 1, k] + logctl[t + 1, k] - m)
+
+        for a in range(nb_active[t]):
+            j = active[t, a]
+            for b in range(nb_active[t + 1]):
+                k = active[t + 1, b]
+                v = exp(alpha[t, j] + beta[t + 1, k]
+                        + logtrans[r, j, k] + loginp[q, k] - lognorm[q, j]
+                        + logobs[t + 1, k] + logctl[t + 1, k] - m) / out
+                zeta[z, j, k] += v
+
+
+# stationary transitions given as a product P = A @ B of two nonnegative
+# sparse factors, A is K x R and B is R x K, both in CSR layout with
+# row pointers ptr, column indices ind and values val. The recursions
+# pass through the R intermediate states and cost O(nnz(A) + nnz(B))
+# per step instead of O(K^2). Banded transitions use A = I and low-rank
+# transitions dense K x R and R x K factors. The products run on scaled
+# probabilities, a state whose mass falls below double precision relative
+# to the leading one gets a log-probability of -inf.
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _forward_factor(double[::1] loginit,
+                          Py_ssize_t[::1] lptr,
+                          Py_ssize_t[::1] lind,
+                          double[::1] lval,
+                          Py_ssize_t[::1] rptr,
+                          Py_ssize_t[::1] rind,
+                          double[::1] rval,
+                          double[:,::1] logobs,
+                          double[:,::1] logctl,
+                          double[:,::1] alpha,
+                          double[::1] norm,
+                          Py_ssize_t start,
+                          Py_ssize_t stop) noexcept nogil:
+
+    cdef Py_ssize_t K, R, t, k, m, e
+    cdef double a
+
+    K = logobs.shape[1]
+    R = rptr.shape[0] - 1
+
+    cdef double* h = <double*> malloc(R * sizeof(double))
+    cdef double* p = <double*> malloc(K * sizeof(double))
+
+    for k in range(K):
+        alpha[start, k] = loginit[k] + logobs[start, k]
+    norm[start] = _normalize(&alpha[start, 0], K)
+
+    for t in range(start + 1, stop):
+        for m in range(R):
+            h[m] = 0.0
+        for k in range(K):
+            a = exp(alpha[t - 1, k])
+            if a > 0.0:
+                for e in range(lptr[k], lptr[k + 1]):
+                    h[lind[e]] += a * lval[e]
+
+        for k in range(K):
+            p[k] = 0.0
+        for m in range(R):
+            if h[m] > 0.0:
+                for e in range(rptr[m], rptr[m + 1]):
+                    p[rind[e]] += h[m] * rval[e]
+
+        for k in range(K):
+            alpha[t, k] = log(p[k]) + logobs[t, k] + logctl[t, k]
+        norm[t] = _normalize(&alpha[t, 0], K)
+
+    free(h)
+    free(p)
+
+
+# scaled emission of step t + 1, e = exp(b - max(b)) with
+# b = beta[t + 1] + logobs[t + 1] + logctl[t + 1], returns max(b)
+cdef double _factor_emission(double[:,::1] logobs,
+                             double[:,::1] logctl,
+                             double[:,::1] beta,
+                             double* e,
+                             Py_ssize_t t) noexcept nogil:
+
+    cdef Py_ssize_t K, k
+    cdef double mx
+
+    K = logobs.shape[1]
+
+    mx = -INFINITY
+    for k in range(K):
+        e[k] = beta[t + 1, k] + logobs[t + 1, k] + logctl[t + 1, k]
+        mx = fmax(mx, e[k])
+    for k in range(K):
+        e[k] = exp(e[k] - mx)
+    return mx
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _backward_factor(Py_ssize_t[::1] lptr,
+                           Py_ssize_t[::1] lind,
+                           double[::1] lval,
+                           Py_ssize_t[::1] rptr,
+                           Py_ssize_t[::1] rind,
+                           double[::1] rval,
+                           double[:,::1] logobs,
+                           double[:,::1] logctl,
+                           double[:,::1] beta,
+                           double[::1] scale,
+                           Py_ssize_t start,
+                           Py_ssize_t stop) noexcept nogil:
+
+    cdef Py_ssize_t K, R, t, k, m, e
+    cdef double mx, out
+
+    K = logobs.shape[1]
+    R = rptr.shape[0] - 1
+
+    cdef double* g = <double*> malloc(R * sizeof(double))
+    cdef double* x = <double*> malloc(K * sizeof(double))
+
+    for k in range(K):
+        beta[stop - 1, k] = 0.0 - scale[stop - 1]
+
+    for t in range(stop - 2, start - 1, -1):
+        mx = _factor_emission(logobs, logctl, beta, x, t)
+
+        for m in range(R):
+            g[m] = 0.0
+            for e in range(rptr[m], rptr[m + 1]):
+                g[m] += rval[e] * x[rind[e]]
+
+        for k in range(K):
+            out = 0.0
+            for e in range(lptr[k], lptr[k + 1]):
+                out += lval[e] * g[lind[e]]
+            beta[t, k] = mx + log(out) - scale[t]
+
+    free(g)
+    free(x)
+
+
+# accumulates the expected number of times every nonzero of A and B
+# is used into lcounts[n] and rcounts[n], for B = I or A = I these
+# are the time-summed joint posteriors restricted to the support
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _factor_statistics(Py_ssize_t[::1] lptr,
+                             Py_ssize_t[::1] lind,
+                             double[::1] lval,
+                             Py_ssize_t[::1] rptr,
+                             Py_ssize_t[::1] rind,
+                             double[::1] rval,
+                             double[:,::1] logobs,
+                             double[:,::1] logctl,
+                             double[:,::1] alpha,
+                             double[:,::1] beta,
+                             double[:,::1] lcounts,
+                             double[:,::1] rcounts,
+                             Py_ssize_t n,
+                             Py_ssize_t start,
+                             Py_ssize_t stop) noexcept nogil:
+
+    cdef Py_ssize_t K, R, t, k, m, e
+    cdef double a, z
+
+    K = logobs.shape[1]
+    R = rptr.shape[0] - 1
+
+    for e in range(lcounts.shape[1]):
+        lcounts[n, e] = 0.0
+    for e in range(rcounts.shape[1]):
+        rcounts[n, e] = 0.0
+
+    cdef double* h = <double*> malloc(R * sizeof(double))
+    cdef double* g = <double*> malloc(R * sizeof(double))
+    cdef double* x = <double*> malloc(K * sizeof(double))
+
+    for t in range(start, stop - 1):
+        _factor_emission(logobs, logctl, beta, x, t)
+
+        for m in range(R):
+            h[m] = 0.0
+            g[m] = 0.0
+            for e in range(rptr[m], rptr[m + 1]):
+                g[m] += rval[e] * x[rind[e]]
+        for k in range(K):
+            a = exp(alpha[t, k])
+            for e in range(lptr[k], lptr[k + 1]):
+                h[lind[e]] += a * lval[e]
+
+        z = 0.0
+        for m in range(R):
+            z += h[m] * g[m]
+
+        for k in range(K):
+            a = exp(alpha[t, k]) / z
+            for e in range(lptr[k], lptr[k + 1]):
+                lcounts[n, e] += a * lval[e] * g[lind[e]]
+        for m in range(R):
+            a = h[m] / z
+            for e in range(rptr[m], rptr[m + 1]):
+                rcounts[n, e] += a * rval[e] * x[rind[e]]
+
+    free(h)
+    free(g)
+    free(x)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef forward_batch_cy(double[::1] loginit,
+                       double[:,:,::1] logtrans,
+                       double[:,::1] loginp,
+                       double[:,::1] lognorm,
+                       Py_ssize_t[::1] toffsets,
+                       bint stationary,
+                       bint factored,
+                       double[:,::1] logobs,
+                       double[:,::1] logctl,
+                       Py_ssize_t[::1] offsets,
+                       double[:,::1] alpha,
+                       double[::1] norm,
+                       int nb_threads):
+
+    cdef Py_ssize_t n, N, tstep
+    N = offsets.shape[0] - 1
+    tstep = 0 if stationary else 1
+
+    for n in prange(N, nogil=True, schedule='dynamic', num_threads=nb_threads):
+        if factored:
+            _lognorm(logtrans, loginp, lognorm, toffsets[n], toffsets[n + 1], tstep)
+        _forward(loginit, logtrans, loginp, lognorm, logobs, logctl, alpha, norm,
+                 offsets[n], offsets[n + 1], toffsets[n], tstep)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef backward_batch_cy(double[::1] loginit,
+                        double[:,:,::1] logtrans,
+                        double[:,::1] loginp,
+                        double[:,::1] lognorm,
+                        Py_ssize_t[::1] toffsets,
+                        bint stationary,
+                        bint factored,
+                        double[:,::1] logobs,
+                        double[:,::1] logctl,
+                        Py_ssize_t[::1] offsets,
+                        double[:,::1] beta,
+                        double[::1] scale,
+                        int nb_threads):
+
+    cdef Py_ssize_t n, N, tstep
+    N = offsets.shape[0] - 1
+    tstep = 0 if stationary else 1
+
+    for n in prange(N, nogil=True, schedule='dynamic', num_threads=nb_threads):
+        if factored:
+            _lognorm(logtrans, loginp, lognorm, toffsets[n], toffsets[n + 1], tstep)
+        _backward(loginit, logtrans, loginp, lognorm, logobs, logctl, beta, scale,
+                  offsets[n], offsets[n + 1], toffsets[n], tstep)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef forward_backward_batch_cy(double[::1] loginit,
+                                double[:,:,::1] logtrans,
+                                double[:,::1] loginp,
+                                double[:,::1] lognorm,
+                                Py_ssize_t[::1] toffsets,
+                                bint stationary,
+                                bint factored,
+                                double[:,::1] logobs,
+                                double[:,::1] logctl,
+                                Py_ssize_t[::1] offsets,
+                                double[:,::1] alpha,
+                                double[::1] norm,
+                                double[:,::1] beta,
+                                int nb_threads):
+
+    cdef Py_ssize_t n, N, tstep
+    N = offsets.shape[0] - 1
+    tstep = 0 if stationary else 1
+
+    for n in prange(N, nogil=True, schedule='dynamic', num_threads=nb_threads):
+        if factored:
+            _lognorm(logtrans, loginp, lognorm, toffsets[n], toffsets[n + 1], tstep)
+        _forward(loginit, logtrans, loginp, lognorm, logobs, logctl, alpha, norm,
+                 offsets[n], offsets[n + 1], toffsets[n], tstep)
+        _backward(loginit, logtrans, loginp, lognorm, logobs, logctl, beta, norm,
+                  offsets[n], offsets[n + 1], toffsets[n], tstep)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef joint_posterior_batch_cy(double[:,:,::1] logtrans,
+                               double[:,::1] loginp,
+                               double[:,::1] lognorm,
+                               Py_ssize_t[::1] toffsets,
+                               bint stationary,
+                               bint factored,
+                               double[:,::1] logobs,
+                               double[:,::1] logctl,
+                               Py_ssize_t[::1] offsets,
+                               double[:,::1] alpha,
+                               double[:,::1] beta,
+                               double[:,:,::1] zeta,
+                               int nb_threads):
+
+    cdef Py_ssize_t n, N, tstep
+    N = offsets.shape[0] - 1
+    tstep = 0 if stationary else 1
+
+    for n in prange(N, nogil=True, schedule='dynamic', num_threads=nb_threads):
+        if factored:
+            _lognorm(logtrans, loginp, lognorm, toffsets[n], toffsets[n + 1], tstep)
+        _joint_posterior(logtrans, loginp, lognorm, logobs, logctl, alpha, beta, zeta,
+                         offsets[n], offsets[n + 1], toffsets[n], tstep, offsets[n] - n)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef expected_statistics_batch_cy(double[::1] loginit,
+                                   double[:,:,::1] logtrans,
+                                   double[:,::1] loginp,
+                                   double[:,::1] lognorm,
+                                   Py_ssize_t[::1] toffsets,
+                                   bint stationary,
+                                   bint factored,
+                                   double[:,::1] logobs,
+                                   double[:,::1] logctl,
+                                   Py_ssize_t[::1] offsets,
+                                   double[:,::1] alpha,
+                                   double[::1] norm,
+                                   double[:,::1] beta,
+                                   double[:,::1] gamma,
+                                   double[:,:,::1] counts,
+                                   int nb_threads):
+
+    cdef Py_ssize_t n, N, tstep
+    N = offsets.shape[0] - 1
+    tstep = 0 if stationary else 1
+
+    for n in prange(N, nogil=True, schedule='dynamic', num_threads=nb_threads):
+        if factored:
+            _lognorm(logtrans, loginp, lognorm, toffsets[n], toffsets[n + 1], tstep)
+        _forward(loginit, logtrans, loginp, lognorm, logobs, logctl, alpha, norm,
+                 offsets[n], offsets[n + 1], toffsets[n], tstep)
+        _backward(loginit, logtrans, loginp, lognorm, logobs, logctl, beta, norm,
+                  offsets[n], offsets[n + 1], toffsets[n], tstep)
+        _posterior(alpha, beta, gamma, offsets[n], offsets[n + 1])
+        _joint_posterior_sum(logtrans, loginp, lognorm, logobs, logctl, alpha, beta,
+                             counts, n, offsets[n], offsets[n + 1], toffsets[n], tstep)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef reduced_statistics_batch_cy(double[::1] loginit,
+                                  double[:,:,::1] logtrans,
+                                  double[:,::1] loginp,
+                                  double[:,::1] lognorm,
+                                  Py_ssize_t[::1] toffsets,
+                                  bint stationary,
+                                  bint factored,
+                                  double[:,::1] logobs,
+                                  double[:,::1] logctl,
+                                  Py_ssize_t[::1] offsets,
+                                  double[:,::1] alpha,
+                                  double[::1] norm,
+                                  double[:,::1] beta,
+                                  double[:,::1] gamma,
+                                  double[:,:,::1] counts,
+                                  double[:,::1] frm,
+                                  double[:,::1] to,
+                                  int nb_threads):
+
+    cdef Py_ssize_t n, N, tstep
+    N = offsets.shape[0] - 1
+    tstep = 0 if stationary else 1
+
+    for n in prange(N, nogil=True, schedule='dynamic', num_threads=nb_threads):
+        if factored:
+            _lognorm(logtrans, loginp, lognorm, toffsets[n], toffsets[n + 1], tstep)
+        _forward(loginit, logtrans, loginp, lognorm, logobs, logctl, alpha, norm,
+                 offsets[n], offsets[n + 1], toffsets[n], tstep)
+        _backward(loginit, logtrans, loginp, lognorm, logobs, logctl, beta, norm,
+                  offsets[n], offsets[n + 1], toffsets[n], tstep)
+        _posterior(alpha, beta, gamma, offsets[n], offsets[n + 1])
+        _joint_posterior_marginals(logtrans, loginp, lognorm, logobs, logctl, alpha, beta,
+                                   counts, frm, to, n, offsets[n], offsets[n + 1],
+                                   toffsets[n], tstep, offsets[n] - n)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef checkpointed_statistics_batch_cy(double[::1] loginit,
+                                       double[:,:,::1] logtrans,
+                                       double[:,::1] loginp,
+                                       double[:,::1] lognorm,
+                                       Py_ssize_t[::1] toffsets,
+                                       bint stationary,
+                                       bint factored,
+                                       double[:,::1] logobs,
+                                       double[:,::1] logctl,
+                                       Py_ssize_t[::1] offsets,
+                                       double[:,::1] gamma,
+                                       double[:,:,::1] counts,
+                                       double[:,::1] frm,
+                                       double[:,::1] to,
+                                       bint marginals,
+                                       double[::1] loglik,
+                                       Py_ssize_t stride,
+                                       int nb_threads):
+
+    cdef Py_ssize_t n, N, tstep
+    N = offsets.shape[0] - 1
+    tstep = 0 if stationary else 1
+
+    for n in prange(N, nogil=True, schedule='dynamic', num_threads=nb_threads):
+        if factored:
+            _lognorm(logtrans, loginp, lognorm, toffsets[n], toffsets[n + 1], tstep)
+        _checkpointed_statistics(loginit, logtrans, loginp, lognorm, logobs, logctl,
+                                 gamma, counts, frm, to, marginals, loglik, n,
+                                 offsets[n], offsets[n + 1], toffsets[n], tstep,
+                                 offsets[n] - n, stride)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef forward_scan_batch_cy(double[::1] loginit,
+                            double[:,:,::1] logtrans,
+                            double[:,::1] loginp,
+                            double[:,::1] lognorm,
+                            Py_ssize_t[::1] toffsets,
+                            bint stationary,
+                            bint factored,
+                            double[:,::1] logobs,
+                            double[:,::1] logctl,
+                            Py_ssize_t[::1] offsets,
+                            double[:,::1] alpha,
+                            double[::1] norm,
+                            Py_ssize_t nb_blocks,
+                            int nb_threads):
+
+    cdef Py_ssize_t n, N, tstep, K
+    N = offsets.shape[0] - 1
+    K = logobs.shape[1]
+    tstep = 0 if stationary else 1
+
+    cdef double[:,:,::1] P = np.zeros((nb_blocks, K, K))
+    cdef double[:,::1] carry = np.zeros((nb_blocks + 1, K))
+
+    # sequences one after the other, parallel over time within each
+    for n in range(N):
+        with nogil:
+            if factored:
+                _lognorm(logtrans, loginp, lognorm, toffsets[n], toffsets[n + 1], tstep)
+            _forward_scan(loginit, logtrans, loginp, lognorm, logobs, logctl,
+                          alpha, norm, P, carry, offsets[n], offsets[n + 1],
+                          toffsets[n], tstep, nb_blocks, nb_threads)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef backward_scan_batch_cy(double[::1] loginit,
+                             double[:,:,::1] logtrans,
+                             double[:,::1] loginp,
+                             double[:,::1] lognorm,
+                             Py_ssize_t[::1] toffsets,
+                             bint stationary,
+                             bint factored,
+                             double[:,::1] logobs,
+                             double[:,::1] logctl,
+                             Py_ssize_t[::1] offsets,
+                             double[:,::1] beta,
+                             double[::1] scale,
+                             Py_ssize_t nb_blocks,
+                             int nb_threads):
+
+    cdef Py_ssize_t n, N, tstep, K
+    N = offsets.shape[0] - 1
+    K = logobs.shape[1]
+    tstep = 0 if stationary else 1
+
+    cdef double[:,:,::1] P = np.zeros((nb_blocks, K, K))
+    cdef double[:,::1] carry = np.zeros((nb_blocks + 1, K))
+
+    for n in range(N):
+        with nogil:
+            if factored:
+                _lognorm(logtrans, loginp, lognorm, toffsets[n], toffsets[n + 1], tstep)
+            _backward_scan(logtrans, loginp, lognorm, logobs, logctl,
+                           beta, scale, P, carry, offsets[n], offsets[n + 1],
+                           toffsets[n], tstep, nb_blocks, nb_threads)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef viterbi_batch_cy(double[::1] loginit,
+                       double[:,:,::1] logtrans,
+                       double[:,::1] loginp,
+                       double[:,::1] lognorm,
+                       Py_ssize_t[::1] toffsets,
+                       bint stationary,
+                       bint factored,
+                       double[:,::1] logobs,
+                       double[:,::1] logctl,
+                       Py_ssize_t[::1] offsets,
+                       double[:,::1] delta,
+                       np.int64_t[:,::1] args,
+                       np.int64_t[::1] z,
+                       int nb_threads):
+
+    cdef Py_ssize_t n, N, tstep
+    N = offsets.shape[0] - 1
+    tstep = 0 if stationary else 1
+
+    for n in prange(N, nogil=True, schedule='dynamic', num_threads=nb_threads):
+        if factored:
+            _lognorm(logtrans, loginp, lognorm, toffsets[n], toffsets[n + 1], tstep)
+        _viterbi(loginit, logtrans, loginp, lognorm, logobs, logctl, delta, args, z,
+                 offsets[n], offsets[n + 1], toffsets[n], tstep)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef forward_factor_batch_cy(double[::1] loginit,
+                              Py_ssize_t[::1] lptr,
+                              Py_ssize_t[::1] lind,
+                              double[::1] lval,
+                              Py_ssize_t[::1] rptr,
+                              Py_ssize_t[::1] rind,
+                              double[::1] rval,
+                              double[:,::1] logobs,
+                              double[:,::1] logctl,
+                              Py_ssize_t[::1] offsets,
+                              double[:,::1] alpha,
+                              double[::1] norm,
+                              int nb_threads):
+
+    cdef Py_ssize_t n, N
+    N = offsets.shape[0] - 1
+
+    for n in prange(N, nogil=True, schedule='dynamic', num_threads=nb_threads):
+        _forward_factor(loginit, lptr, lind, lval, rptr, rind, rval,
+                        logobs, logctl, alpha, norm, offsets[n], offsets[n + 1])
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef backward_factor_batch_cy(double[::1] loginit,
+                               Py_ssize_t[::1] lptr,
+                               Py_ssize_t[::1] lind,
+                               double[::1] lval,
+                               Py_ssize_t[::1] rptr,
+                               Py_ssize_t[::1] rind,
+                               double[::1] rval,
+                               double[:,::1] logobs,
+                               double[:,::1] logctl,
+                               Py_ssize_t[::1] offsets,
+                               double[:,::1] beta,
+                               double[::1] scale,
+                               int nb_threads):
+
+    cdef Py_ssize_t n, N
+    N = offsets.shape[0] - 1
+
+    for n in prange(N, nogil=True, schedule='dynamic', num_threads=nb_threads):
+        _backward_factor(lptr, lind, lval, rptr, rind, rval,
+                         logobs, logctl, beta, scale, offsets[n], offsets[n + 1])
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef forward_backward_factor_batch_cy(double[::1] loginit,
+                                       Py_ssize_t[::1] lptr,
+                                       Py_ssize_t[::1] lind,
+                                       double[::1] lval,
+                                       Py_ssize_t[::1] rptr,
+                                       Py_ssize_t[::1] rind,
+                                       double[::1] rval,
+                                       double[:,::1] logobs,
+                                       double[:,::1] logctl,
+                                       Py_ssize_t[::1] offsets,
+                                       double[:,::1] alpha,
+                                       double[::1] norm,
+                                       double[:,::1] beta,
+                                       int nb_threads):
+
+    cdef Py_ssize_t n, N
+    N = offsets.shape[0] - 1
+
+    for n in prange(N, nogil=True, schedule='dynamic', num_threads=nb_threads):
+        _forward_factor(loginit, lptr, lind, lval, rptr, rind, rval,
+                        logobs, logctl, alpha, norm, offsets[n], offsets[n + 1])
+        _backward_factor(lptr, lind, lval, rptr, rind, rval,
+                         logobs, logctl, beta, norm, offsets[n], offsets[n + 1])
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef expected_statistics_factor_batch_cy(double[::1] loginit,
+                                          Py_ssize_t[::1] lptr,
+                                          Py_ssize_t[::1] lind,
+                                          double[::1] lval,
+                                          Py_ssize_t[::1] rptr,
+                                          Py_ssize_t[::1] rind,
+                                          double[::1] rval,
+                                          double[:,::1] logobs,
+                                          double[:,::1] logctl,
+                                          Py_ssize_t[::1] offsets,
+                                          double[:,::1] alpha,
+                                          double[::1] norm,
+                                          double[:,::1] beta,
+                                          double[:,::1] gamma,
+                                          double[:,::1] lcounts,
+                                          double[:,::1] rcounts,
+                                          int nb_threads):
+
+    cdef Py_ssize_t n, N
+    N = offsets.shape[0] - 1
+
+    for n in prange(N, nogil=True, schedule='dynamic', num_threads=nb_threads):
+        _forward_factor(loginit, lptr, lind, lval, rptr, rind, rval,
+                        logobs, logctl, alpha, norm, offsets[n], offsets[n + 1])
+        _backward_factor(lptr, lind, lval, rptr, rind, rval,
+                         logobs, logctl, beta, norm, offsets[n], offsets[n + 1])
+        _posterior(alpha, beta, gamma, offsets[n], offsets[n + 1])
+        _factor_statistics(lptr, lind, lval, rptr, rind, rval, logobs, logctl,
+                           alpha, beta, lcounts, rcounts, n, offsets[n], offsets[n + 1])
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef beam_statistics_batch_cy(double[::1] loginit,
+                               double[:,:,::1] logtrans,
+                               double[:,::1] loginp,
+                               double[:,::1] lognorm,
+                               Py_ssize_t[::1] toffsets,
+                               bint stationary,
+                               bint factored,
+                               double[:,::1] logobs,
+                               double[:,::1] logctl,
+                               Py_ssize_t[::1] offsets,
+                               double[:,::1] alpha,
+                               double[::1] norm,
+                               double[:,::1] beta,
+                               double[:,::1] gamma,
+                               Py_ssize_t[:,::1] active,
+                               Py_ssize_t[::1] nb_active,
+                               double[::1] pruned,
+                               double[:,:,::1] zeta,
+                               bint dense,
+                               Py_ssize_t size,
+                               double threshold,
+                               int nb_threads):
+
+    # zeta holds T - 1 rows per sequence if dense, else one count matrix
+    cdef Py_ssize_t n, N, tstep
+    N = offsets.shape[0] - 1
+    tstep = 0 if stationary else 1
+
+    for n in prange(N, nogil=True, schedule='dynamic', num_threads=nb_threads):
+        _forward_beam(loginit, logtrans, loginp, lognorm, logobs, logctl, alpha, norm,
+                      active, nb_active, pruned, offsets[n], offsets[n + 1],
+                      toffsets[n], tstep, factored, size, threshold)
+        _backward_beam(logtrans, loginp, lognorm, logobs, logctl, beta, norm,
+                       active, nb_active, offsets[n], offsets[n + 1], toffsets[n], tstep)
+        _posterior(alpha, beta, gamma, offsets[n], offsets[n + 1])
+        _joint_posterior_beam(logtrans, loginp, lognorm, logobs, logctl, alpha, beta,
+                              active, nb_active, zeta, dense, n, offsets[n], offsets[n + 1],
+                              toffsets[n], tstep, offsets[n] - n)
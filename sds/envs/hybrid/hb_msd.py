@@ -30,6 +30,10 @@ class HybridMassSpringDamper(gym.Env):
 
         self.obs = None
 
+        # streaming belief over hidden states
+        self.belief_filter = self.rarhmm.online_filter()
+        self.belief = None
+
         self.hist_obs = np.empty((0, self.dm_obs))
         self.hist_act = np.empty((0, self.dm_act))
 
@@ -58,7 +62,7 @@ class HybridMassSpringDamper(gym.Env):
 
         # evolve dynamics
         x, u = xhist[-1, :], uhist[-1, :]
-        zn, xn = self.rarhmm.step(x, u, b, stoch=False, mix=False)
+        zn, xn = self.rarhmm.step(x, u, b, stoch=False, average=False)
 
         return zn, xn
 
@@ -79,9 +83,13 @@ class HybridMassSpringDamper(gym.Env):
         rwrd = self.rewrad(self.obs, _act)
 
         # evolve dynamics
-        _, self.obs = self.dynamics(self.hist_obs, self.hist_act)
+        _, self.obs = self.rarhmm.step(self.obs, _act, self.belief,
+                                       stoch=False, average=False)
         self.hist_obs = np.vstack((self.hist_obs, self.obs))
 
+        # filter hidden state
+        self.belief = self.belief_filter.update(self.obs, _act)
+
         return self.obs, rwrd, False, {}
 
     def reset(self):
@@ -93,6 +101,9 @@ class HybridMassSpringDamper(gym.Env):
         self.obs = self.rarhmm.init_observation.sample(_state)
         self.hist_obs = np.vstack((self.hist_obs, self.obs))
 
+        self.belief_filter.reset()
+        self.belief = self.belief_filter.update(self.obs)
+
         return self.obs
 
     # following function for plotting
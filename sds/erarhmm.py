@@ -62,14 +62,14 @@ class erARHMM(rARHMM):
         loginit, logtrans, logobs = super(erARHMM, self).log_likelihoods(obs, act)
         if self.learn_ctl:
             if self.ar_ctl:
-                ilog = self.init_control.log_likelihood(obs, act)
-                arlog = self.controls.log_likelihood(obs, act)
+                ilog = self.cache(self.init_control.log_likelihood, obs, act)
+                arlog = self.cache(self.controls.log_likelihood, obs, act)
 
                 logctl = []
                 for _ilog, _arlog in zip(ilog, arlog):
                     logctl.append(np.vstack((_ilog, _arlog)))
             else:
-                logctl = self.controls.log_likelihood(obs, act)
+                logctl = self.cache(self.controls.log_likelihood, obs, act)
 
             return loginit, logtrans, logobs, logctl
         else:
@@ -95,13 +95,14 @@ class erARHMM(rARHMM):
 
     def permute(self, perm):
         super(erARHMM, self).permute(perm)
+        if self.ar_ctl:
+            self.init_control.permute(perm)
         self.controls.permute(perm)
 
     @ensure_args_are_viable_lists
     def mean_control(self, obs, act=None):
         loglikhds = self.log_likelihoods(obs, act)
-        alpha, norm = self.forward(*loglikhds)
-        beta = self.backward(*loglikhds, scale=norm)
+        alpha, norm, beta = self.forward_backward(*loglikhds)
         gamma = self.posterior(alpha, beta)
 
         return self.controls.smooth(gamma, obs, act)
@@ -2,35 +2,221 @@ import numpy as np
 import numpy.random as npr
 
 from scipy.special import logsumexp
+from scipy import sparse
 
 from sds.initial import CategoricalInitState
-from sds.transitions import StationaryTransition
+from sds.transitions import StationaryTransition, StickyTransition
+from sds.transitions import SparseTransition, BandedTransition
+from sds.transitions import LowRankTransition
+from sds.transitions import SparseFactors
 from sds.observations import GaussianObservation
 
 from sds.utils import ensure_args_are_viable_lists
-from sds.cython.hmm_cy import forward_cy, backward_cy
+from sds.utils import to_ragged, from_ragged
+from sds.utils import LikelihoodCache
+from sds.utils import Dataset
+from sds.utils import inverse_cdf
+from sds.cython.hmm_cy import forward_batch_cy, backward_batch_cy
+from sds.cython.hmm_cy import forward_backward_batch_cy
+from sds.cython.hmm_cy import joint_posterior_batch_cy
+from sds.cython.hmm_cy import expected_statistics_batch_cy
+from sds.cython.hmm_cy import reduced_statistics_batch_cy
+from sds.cython.hmm_cy import checkpointed_statistics_batch_cy
+from sds.cython.hmm_cy import forward_scan_batch_cy, backward_scan_batch_cy
+from sds.cython.hmm_cy import viterbi_batch_cy
+from sds.cython.hmm_cy import forward_factor_batch_cy, backward_factor_batch_cy
+from sds.cython.hmm_cy import forward_backward_factor_batch_cy
+from sds.cython.hmm_cy import expected_statistics_factor_batch_cy
+from sds.cython.hmm_cy import beam_statistics_batch_cy
 
 from tqdm import trange
 
+import multiprocessing
+nb_cores = multiprocessing.cpu_count()
+
 to_c = lambda arr: np.copy(arr, 'C')\
     if not arr.flags['C_CONTIGUOUS'] else arr
 
 
+def ragged_logtrans(logtrans):
+    # pack transitions for the batched kernels, returns the
+    # transition buffer, input term, normalizer, offsets and
+    # the stationary/factored flags the kernels expect
+    if isinstance(logtrans[0], SparseFactors):
+        # kernels without a sparse variant see the dense matrix
+        logtrans = [_logtrans.dense() for _logtrans in logtrans]
+
+    lengths = [len(_logtrans[1]) if isinstance(_logtrans, tuple)
+               else len(_logtrans) for _logtrans in logtrans]
+
+    toffsets = np.zeros((len(logtrans) + 1, ), dtype=np.intp)
+    toffsets[1:] = np.cumsum(lengths)
+
+    # factored recurrent transitions, a K x K matrix and a T x K input term
+    if isinstance(logtrans[0], tuple):
+        _logmat = np.array(logtrans[0][0][None, :, :], dtype=np.float64, order='C')
+        _loginp, _ = to_ragged([_logtrans[1] for _logtrans in logtrans])
+        return _logmat, _loginp, np.zeros(_loginp.shape), toffsets, True, True
+
+    nb_states = logtrans[0].shape[-1]
+    _loginp = np.zeros((toffsets[-1], nb_states))
+
+    # time-invariant transitions are broadcast views of one
+    # matrix, hand only that matrix over to the kernels
+    if all(_logtrans.strides[0] == 0 or _logtrans.shape[0] == 1
+           for _logtrans in logtrans):
+        _logmat = np.array(logtrans[0][:1], dtype=np.float64, order='C')
+        if all(np.array_equal(_logtrans[0], _logmat[0]) for _logtrans in logtrans):
+            return _logmat, _loginp, _loginp, toffsets, True, False
+
+    _logtrans, _ = to_ragged(logtrans)
+    return _logtrans, _loginp, _loginp, toffsets, False, False
+
+
+def sparse_factors(logtrans):
+    # csr arrays of stationary sparse-factor transitions,
+    # None if the transitions are not given in that form
+    if isinstance(logtrans[0], SparseFactors):
+        return logtrans[0].arrays
+    return None
+
+
+def dense_logtrans(logtrans):
+    # expand factored transitions for the numpy code paths
+    _logtrans = []
+    for _lt in logtrans:
+        if isinstance(_lt, SparseFactors):
+            _lt = _lt.dense()
+        elif isinstance(_lt, tuple):
+            _aux = _lt[0][None, :, :] + _lt[1][:, None, :]
+            _lt = _aux - logsumexp(_aux, axis=-1, keepdims=True)
+        _logtrans.append(_lt)
+    return _logtrans
+
+
+class OnlineFilter:
+
+    def __init__(self, model, nb_streams=None):
+        self.model = model
+        self.nb_streams = nb_streams
+
+        # window needed for a single step, longer for multi-lag
+        # observations and ar controls
+        self.order = 1 + getattr(self.model.observations, 'lags', 1)
+        if getattr(self.model, 'ar_ctl', False):
+            self.order += self.model.lags
+
+        self.reset()
+
+    @property
+    def size(self):
+        return 1 if self.nb_streams is None else self.nb_streams
+
+    def reset(self):
+        # fixed trailing windows, the newest step is the last row
+        self.obs = np.zeros((self.size, self.order, self.model.dm_obs))
+        self.act = np.zeros((self.size, self.order, self.model.dm_act))
+
+        self.logalpha = np.tile(self.model.init_state.log_init(), (self.size, 1))
+        self.nb_steps = 0
+
+    @property
+    def belief(self):
+        _belief = np.exp(self.logalpha - logsumexp(self.logalpha, axis=-1, keepdims=True))
+        return _belief[0] if self.nb_streams is None else _belief
+
+    def window(self, length):
+        # last length observations and actions of every stream
+        return self.obs[:, -length:], self.act[:, -length:]
+
+    # the terms of the newest step are evaluated by the components
+    # at once for all streams, on the shortest window they need
+
+    def log_observation(self):
+        t = self.nb_steps - 1
+        lags = getattr(self.model.observations, 'lags', 0)
+        if t < lags:
+            return self.model.init_observation.log_likelihood_step(*self.window(t + 1))
+        return self.model.observations.log_likelihood_step(*self.window(lags + 1))
+
+    def log_transition(self):
+        x, u = self.window(2)
+        if self.model.stationary:
+            # one matrix shared by all streams
+            return self.model.transitions.log_transition([x[0]], [u[0]])[0][-1]
+        return self.model.transitions.log_transition_step(x[:, -2], u[:, -2])
+
+    def log_control(self):
+        # step t, whose action has just been revealed
+        t = self.nb_steps - 1
+        if not self.model.ar_ctl:
+            return self.model.controls.log_likelihood_step(*self.window(1))
+
+        if t < self.model.lags:
+            return self.model.init_control.log_likelihood_step(*self.window(t + 1))
+        return self.model.controls.log_likelihood_step(*self.window(self.model.lags + 1))
+
+    def update(self, obs, act=None):
+        # act is the action that led from the last observation to obs
+        if act is not None and self.nb_steps > 0:
+            self.act[:, -1, :] = np.reshape(act, (self.size, self.model.dm_act))
+
+        _alpha = self.logalpha
+        # control term of the last step, as in the batch forward
+        if getattr(self.model, 'learn_ctl', False) and self.nb_steps > 1:
+            _alpha = _alpha + self.log_control()
+
+        # shift the windows in place
+        self.obs[:, :-1], self.act[:, :-1] = self.obs[:, 1:], self.act[:, 1:]
+        self.obs[:, -1] = np.reshape(obs, (self.size, self.model.dm_obs))
+        self.act[:, -1] = 0.
+        self.nb_steps += 1
+
+        if self.nb_steps == 1:
+            _alpha = _alpha + self.log_observation()
+        else:
+            _alpha = logsumexp(_alpha[:, :, None] + self.log_transition(), axis=1) + self.log_observation()
+
+        self.logalpha = _alpha - logsumexp(_alpha, axis=-1, keepdims=True)
+
+        return self.belief
+
+
 class HMM:
 
     def __init__(self, nb_states, dm_obs, dm_act=0,
                  init_state_prior={}, trans_prior={}, obs_prior={},
-                 init_state_kwargs={}, trans_kwargs={}, obs_kwargs={}):
+                 init_state_kwargs={}, trans_kwargs={}, obs_kwargs={},
+                 trans_type='stationary'):
 
         self.nb_states = nb_states
         self.dm_obs = dm_obs
         self.dm_act = dm_act
 
+        # sparse, banded and low-rank transitions scale to many states
+        self.trans_type = trans_type
+        trans_types = dict(stationary=StationaryTransition, sticky=StickyTransition,
+                           sparse=SparseTransition, banded=BandedTransition,
+                           lowrank=LowRankTransition)
+
         self.init_state = CategoricalInitState(self.nb_states, prior=init_state_prior, **init_state_kwargs)
-        self.transitions = StationaryTransition(self.nb_states, prior=trans_prior, **trans_kwargs)
+        self.transitions = trans_types[self.trans_type](self.nb_states, prior=trans_prior, **trans_kwargs)
         self.observations = GaussianObservation(self.nb_states, self.dm_obs, self.dm_act,
                                                 prior=obs_prior, **obs_kwargs)
 
+        # reuse component evaluations on unchanged parameters and data
+        self.cache = LikelihoodCache()
+
+    def __getstate__(self):
+        # cached evaluations hold on to data, do not pickle them
+        state = self.__dict__.copy()
+        state.pop('cache', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.cache = LikelihoodCache()
+
     @property
     def params(self):
         return self.init_state.params, \
@@ -52,9 +238,28 @@ class HMM:
         self.observations.initialize(obs, act)
 
     def permute(self, perm):
+        # perm may also be a subset of the states, see prune
         self.init_state.permute(perm)
+        if hasattr(self, 'init_observation'):
+            self.init_observation.permute(perm)
         self.transitions.permute(perm)
         self.observations.permute(perm)
+        self.nb_states = len(perm)
+
+    def prune(self, gamma, threshold=1.):
+        # drops the states whose expected occupancy is below threshold
+        # time steps, the others keep their order. Returns True if any
+        # state was dropped, always keeps the most used one
+        usage = sum([np.sum(_gamma, axis=0) for _gamma in gamma])
+        keep = np.where(usage >= threshold)[0]
+        if len(keep) == 0:
+            keep = np.array([np.argmax(usage)])
+
+        if len(keep) == self.nb_states:
+            return False
+
+        self.permute(keep)
+        return True
 
     def log_priors(self):
         logprior = 0.0
@@ -65,9 +270,9 @@ class HMM:
 
     @ensure_args_are_viable_lists
     def log_likelihoods(self, obs, act=None):
-        loginit = self.init_state.log_init()
-        logtrans = self.transitions.log_transition(obs, act)
-        logobs = self.observations.log_likelihood(obs, act)
+        loginit = self.cache(self.init_state.log_init)
+        logtrans = self.cache(self.transitions.log_transition, obs, act, factored=True)
+        logobs = self.cache(self.observations.log_likelihood, obs, act)
         return loginit, logtrans, logobs
 
     def log_norm(self, obs, act=None):
@@ -78,83 +283,169 @@ class HMM:
     def log_probability(self, obs, act=None):
         return self.log_norm(obs, act) + self.log_priors()
 
-    def forward(self, loginit, logtrans, logobs, logctl=None, cython=True):
+    def forward(self, loginit, logtrans, logobs, logctl=None, cython=True, scan=False):
         if logctl is None:
             logctl = []
             for _logobs in logobs:
                 logctl.append(np.zeros((_logobs.shape[0], self.nb_states)))
 
+        if cython:
+            _logobs, offsets = to_ragged(logobs)
+            _logctl, _ = to_ragged(logctl)
+
+            _alpha = np.zeros(_logobs.shape)
+            _norm = np.zeros((_logobs.shape[0], ))
+
+            _factors = sparse_factors(logtrans)
+            if _factors is not None and not scan:
+                forward_factor_batch_cy(to_c(loginit), *_factors, _logobs, _logctl,
+                                        offsets, _alpha, _norm, nb_cores)
+                return from_ragged(_alpha, offsets), from_ragged(_norm, offsets)
+
+            _trans = ragged_logtrans(logtrans)
+            if scan:
+                # parallel in time, for few very long sequences
+                forward_scan_batch_cy(to_c(loginit), *_trans, _logobs, _logctl,
+                                      offsets, _alpha, _norm, nb_cores, nb_cores)
+            else:
+                forward_batch_cy(to_c(loginit), *_trans, _logobs, _logctl,
+                                 offsets, _alpha, _norm, nb_cores)
+
+            return from_ragged(_alpha, offsets), from_ragged(_norm, offsets)
+
+        logtrans = dense_logtrans(logtrans)
+
         alpha, norm = [], []
         for _logobs, _logctl, _logtrans in zip(logobs, logctl, logtrans):
             T = _logobs.shape[0]
             _alpha = np.zeros((T, self.nb_states))
             _norm = np.zeros((T, ))
 
-            if cython:
-                forward_cy(to_c(loginit), to_c(_logtrans),
-                           to_c(_logobs), to_c(_logctl),
-                           to_c(_alpha), to_c(_norm))
-            else:
-                for k in range(self.nb_states):
-                    _alpha[0, k] = loginit[k] + _logobs[0, k]
-                _norm[0] = logsumexp(_alpha[0], axis=-1, keepdims=True)
-                _alpha[0] = _alpha[0] - _norm[0]
+            for k in range(self.nb_states):
+                _alpha[0, k] = loginit[k] + _logobs[0, k]
+            _norm[0] = logsumexp(_alpha[0], axis=-1)
+            _alpha[0] = _alpha[0] - _norm[0]
 
-                _aux = np.zeros((self.nb_states,))
-                for t in range(1, T):
-                    for k in range(self.nb_states):
-                        for j in range(self.nb_states):
-                            _aux[j] = _alpha[t - 1, j] + _logtrans[t - 1, j, k]
-                        _alpha[t, k] = logsumexp(_aux) + _logobs[t, k] + _logctl[t, k]
+            _aux = np.zeros((self.nb_states,))
+            for t in range(1, T):
+                for k in range(self.nb_states):
+                    for j in range(self.nb_states):
+                        _aux[j] = _alpha[t - 1, j] + _logtrans[t - 1, j, k]
+                    _alpha[t, k] = logsumexp(_aux) + _logobs[t, k] + _logctl[t, k]
 
-                    _norm[t] = logsumexp(_alpha[t], axis=-1, keepdims=True)
-                    _alpha[t] = _alpha[t] - _norm[t]
+                _norm[t] = logsumexp(_alpha[t], axis=-1)
+                _alpha[t] = _alpha[t] - _norm[t]
 
             alpha.append(_alpha)
             norm.append(_norm)
         return alpha, norm
 
     def backward(self, loginit, logtrans, logobs,
-                 logctl=None, scale=None, cython=True):
+                 logctl=None, scale=None, cython=True, scan=False):
         if logctl is None:
             logctl = []
             for _logobs in logobs:
                 logctl.append(np.zeros((_logobs.shape[0], self.nb_states)))
 
+        if cython:
+            _logobs, offsets = to_ragged(logobs)
+            _logctl, _ = to_ragged(logctl)
+            _scale, _ = to_ragged(scale)
+
+            _beta = np.zeros(_logobs.shape)
+
+            _factors = sparse_factors(logtrans)
+            if _factors is not None and not scan:
+                backward_factor_batch_cy(to_c(loginit), *_factors, _logobs, _logctl,
+                                         offsets, _beta, _scale, nb_cores)
+                return from_ragged(_beta, offsets)
+
+            _trans = ragged_logtrans(logtrans)
+            if scan:
+                backward_scan_batch_cy(to_c(loginit), *_trans, _logobs, _logctl,
+                                       offsets, _beta, _scale, nb_cores, nb_cores)
+            else:
+                backward_batch_cy(to_c(loginit), *_trans, _logobs, _logctl,
+                                  offsets, _beta, _scale, nb_cores)
+
+            return from_ragged(_beta, offsets)
+
+        logtrans = dense_logtrans(logtrans)
+
         beta = []
         for _logobs, _logctl, _logtrans, _scale in zip(logobs, logctl, logtrans, scale):
             T = _logobs.shape[0]
             _beta = np.zeros((T, self.nb_states))
 
-            if cython:
-                backward_cy(to_c(loginit), to_c(_logtrans),
-                            to_c(_logobs), to_c(_logctl),
-                            to_c(_beta), to_c(_scale))
-            else:
-                for k in range(self.nb_states):
-                    _beta[T - 1, k] = 0.0 - _scale[T - 1]
+            for k in range(self.nb_states):
+                _beta[T - 1, k] = 0.0 - _scale[T - 1]
 
-                _aux = np.zeros((self.nb_states,))
-                for t in range(T - 2, -1, -1):
-                    for k in range(self.nb_states):
-                        for j in range(self.nb_states):
-                            _aux[j] = _logtrans[t, k, j] + _beta[t + 1, j]\
-                                      + _logobs[t + 1, j] + _logctl[t + 1, j]
-                        _beta[t, k] = logsumexp(_aux) - _scale[t]
+            _aux = np.zeros((self.nb_states,))
+            for t in range(T - 2, -1, -1):
+                for k in range(self.nb_states):
+                    for j in range(self.nb_states):
+                        _aux[j] = _logtrans[t, k, j] + _beta[t + 1, j]\
+                                  + _logobs[t + 1, j] + _logctl[t + 1, j]
+                    _beta[t, k] = logsumexp(_aux) - _scale[t]
 
             beta.append(_beta)
         return beta
 
+    def forward_backward(self, loginit, logtrans, logobs, logctl=None):
+        if logctl is None:
+            logctl = []
+            for _logobs in logobs:
+                logctl.append(np.zeros((_logobs.shape[0], self.nb_states)))
+
+        # all sequences in one call, parallel over trajectories
+        _logobs, offsets = to_ragged(logobs)
+        _logctl, _ = to_ragged(logctl)
+
+        _alpha = np.zeros(_logobs.shape)
+        _norm = np.zeros((_logobs.shape[0], ))
+        _beta = np.zeros(_logobs.shape)
+
+        _factors = sparse_factors(logtrans)
+        if _factors is not None:
+            forward_backward_factor_batch_cy(to_c(loginit), *_factors, _logobs, _logctl,
+                                             offsets, _alpha, _norm, _beta, nb_cores)
+        else:
+            forward_backward_batch_cy(to_c(loginit), *ragged_logtrans(logtrans), _logobs, _logctl,
+                                      offsets, _alpha, _norm, _beta, nb_cores)
+
+        return from_ragged(_alpha, offsets),\
+               from_ragged(_norm, offsets),\
+               from_ragged(_beta, offsets)
+
     def posterior(self, alpha, beta):
         return [np.exp(_alpha + _beta - logsumexp(_alpha + _beta, axis=1,  keepdims=True))
                 for _alpha, _beta in zip(alpha, beta)]
 
-    def joint_posterior(self, alpha, beta, loginit, logtrans, logobs, logctl=None):
+    def joint_posterior(self, alpha, beta, loginit, logtrans,
+                        logobs, logctl=None, cython=True):
         if logctl is None:
             logctl = []
             for _logobs in logobs:
                 logctl.append(np.zeros((_logobs.shape[0], self.nb_states)))
 
+        if cython:
+            _logobs, offsets = to_ragged(logobs)
+            _logctl, _ = to_ragged(logctl)
+            _alpha, _ = to_ragged(alpha)
+            _beta, _ = to_ragged(beta)
+            _trans = ragged_logtrans(logtrans)
+
+            # T - 1 steps per sequence
+            zoffsets = offsets - np.arange(len(offsets))
+            _zeta = np.zeros((zoffsets[-1], self.nb_states, self.nb_states))
+
+            joint_posterior_batch_cy(*_trans, _logobs, _logctl, offsets,
+                                     _alpha, _beta, _zeta, nb_cores)
+
+            return from_ragged(_zeta, zoffsets)
+
+        logtrans = dense_logtrans(logtrans)
+
         zeta = []
         for _logobs, _logctl, _logtrans, _alpha, _beta in\
                 zip(logobs, logctl, logtrans, alpha, beta):
@@ -168,10 +459,158 @@ class HMM:
             zeta.append(_zeta)
         return zeta
 
+    def expected_statistics(self, loginit, logtrans, logobs, logctl=None):
+        if logctl is None:
+            logctl = []
+            for _logobs in logobs:
+                logctl.append(np.zeros((_logobs.shape[0], self.nb_states)))
+
+        _logobs, offsets = to_ragged(logobs)
+        _logctl, _ = to_ragged(logctl)
+
+        _alpha = np.zeros(_logobs.shape)
+        _norm = np.zeros((_logobs.shape[0], ))
+        _beta = np.zeros(_logobs.shape)
+        _gamma = np.zeros(_logobs.shape)
+
+        _factors = sparse_factors(logtrans)
+        if _factors is not None:
+            # expected use of every nonzero of both factors, handed
+            # to the transitions as a pair of csr count matrices
+            lhs, rhs = logtrans[0].lhs, logtrans[0].rhs
+            _lcounts = np.zeros((len(logobs), lhs.nnz))
+            _rcounts = np.zeros((len(logobs), rhs.nnz))
+
+            expected_statistics_factor_batch_cy(to_c(loginit), *_factors, _logobs, _logctl,
+                                                offsets, _alpha, _norm, _beta, _gamma,
+                                                _lcounts, _rcounts, nb_cores)
+
+            zeta = [(sparse.csr_matrix((_lc, lhs.indices, lhs.indptr), shape=lhs.shape),
+                     sparse.csr_matrix((_rc, rhs.indices, rhs.indptr), shape=rhs.shape))
+                    for _lc, _rc in zip(_lcounts, _rcounts)]
+            return from_ragged(_gamma, offsets), zeta, from_ragged(_norm, offsets)
+
+        _trans = ragged_logtrans(logtrans)
+        _counts = np.zeros((len(logobs), self.nb_states, self.nb_states))
+
+        if not self.stationary:
+            # recurrent transitions also need the from- and to-state
+            # marginals of every step, T - 1 rows per sequence
+            zoffsets = offsets - np.arange(len(offsets))
+            _frm = np.zeros((zoffsets[-1], self.nb_states))
+            _to = np.zeros((zoffsets[-1], self.nb_states))
+
+            reduced_statistics_batch_cy(to_c(loginit), *_trans, _logobs, _logctl,
+                                        offsets, _alpha, _norm, _beta, _gamma,
+                                        _counts, _frm, _to, nb_cores)
+
+            zeta = list(zip(_counts, from_ragged(_frm, zoffsets), from_ragged(_to, zoffsets)))
+            return from_ragged(_gamma, offsets), zeta, from_ragged(_norm, offsets)
+
+        expected_statistics_batch_cy(to_c(loginit), *_trans, _logobs, _logctl,
+                                     offsets, _alpha, _norm, _beta,
+                                     _gamma, _counts, nb_cores)
+
+        # time-summed zeta, keeps a singleton time axis
+        zeta = [_c[None, :, :] for _c in _counts]
+        return from_ragged(_gamma, offsets), zeta, from_ragged(_norm, offsets)
+
+    def checkpointed_statistics(self, loginit, logtrans, logobs, logctl=None, stride=0):
+        # memory-bounded smoothing for very long sequences, alpha is stored
+        # every stride steps, sqrt(T) by default, and recomputed on the way back.
+        # Returns the full T x K gamma but only the reduced zeta of
+        # expected_statistics, time-summed counts and for recurrent
+        # models their per-step from- and to-state marginals
+        if logctl is None:
+            logctl = []
+            for _logobs in logobs:
+                logctl.append(np.zeros((_logobs.shape[0], self.nb_states)))
+
+        _logobs, offsets = to_ragged(logobs)
+        _logctl, _ = to_ragged(logctl)
+        _trans = ragged_logtrans(logtrans)
+
+        _gamma = np.zeros(_logobs.shape)
+        _counts = np.zeros((len(logobs), self.nb_states, self.nb_states))
+        _loglik = np.zeros((len(logobs), ))
+
+        # T - 1 steps per sequence, left empty for stationary models
+        marginals = not self.stationary
+        zoffsets = offsets - np.arange(len(offsets))
+        _frm = np.zeros((zoffsets[-1] if marginals else 0, self.nb_states))
+        _to = np.zeros((zoffsets[-1] if marginals else 0, self.nb_states))
+
+        checkpointed_statistics_batch_cy(to_c(loginit), *_trans, _logobs, _logctl,
+                                         offsets, _gamma, _counts, _frm, _to, marginals,
+                                         _loglik, stride, nb_cores)
+
+        if marginals:
+            zeta = list(zip(_counts, from_ragged(_frm, zoffsets), from_ragged(_to, zoffsets)))
+        else:
+            zeta = [_c[None, :, :] for _c in _counts]
+        return from_ragged(_gamma, offsets), zeta, _loglik
+
+    def beam_statistics(self, loginit, logtrans, logobs, logctl=None,
+                        size=0, threshold=0., reduce=False):
+        # approximate smoothing on the states that survive a forward beam,
+        # the size most likely states of alpha holding at least threshold
+        # of its mass at every step. Also returns the forward mass pruned
+        # at every step, the summed normalizer is a lower bound on the
+        # log-likelihood that is tight when the pruned mass vanishes
+        if logctl is None:
+            logctl = []
+            for _logobs in logobs:
+                logctl.append(np.zeros((_logobs.shape[0], self.nb_states)))
+
+        _logobs, offsets = to_ragged(logobs)
+        _logctl, _ = to_ragged(logctl)
+        _trans = ragged_logtrans(logtrans)
+
+        _alpha = np.zeros(_logobs.shape)
+        _norm = np.zeros((_logobs.shape[0], ))
+        _beta = np.zeros(_logobs.shape)
+        _gamma = np.zeros(_logobs.shape)
+        _active = np.zeros(_logobs.shape, dtype=np.intp)
+        _nb_active = np.zeros((_logobs.shape[0], ), dtype=np.intp)
+        _pruned = np.zeros((_logobs.shape[0], ))
+
+        # time-summed counts or T - 1 steps per sequence
+        zoffsets = offsets - np.arange(len(offsets))
+        if reduce:
+            _zeta = np.zeros((len(logobs), self.nb_states, self.nb_states))
+        else:
+            _zeta = np.zeros((zoffsets[-1], self.nb_states, self.nb_states))
+
+        beam_statistics_batch_cy(to_c(loginit), *_trans, _logobs, _logctl,
+                                 offsets, _alpha, _norm, _beta, _gamma,
+                                 _active, _nb_active, _pruned, _zeta,
+                                 not reduce, size, threshold, nb_cores)
+
+        zeta = [_c[None, :, :] for _c in _zeta] if reduce\
+            else from_ragged(_zeta, zoffsets)
+        return from_ragged(_gamma, offsets), zeta,\
+               from_ragged(_norm, offsets), from_ragged(_pruned, offsets)
+
     @ensure_args_are_viable_lists
-    def viterbi(self, obs, act=None):
+    def viterbi(self, obs, act=None, cython=True):
         loginit, logtrans, logobs = self.log_likelihoods(obs, act)[0:3]
 
+        if cython:
+            _logobs, offsets = to_ragged(logobs)
+            _trans = ragged_logtrans(logtrans)
+            _logctl = np.zeros(_logobs.shape)
+
+            _delta = np.zeros(_logobs.shape)
+            _args = np.zeros(_logobs.shape, np.int64)
+            _z = np.zeros((_logobs.shape[0], ), np.int64)
+
+            viterbi_batch_cy(to_c(loginit), *_trans, _logobs, _logctl,
+                             offsets, _delta, _args, _z, nb_cores)
+
+            return from_ragged(_delta, offsets), from_ragged(_z, offsets)
+
+        logtrans = dense_logtrans(logtrans)
+
         delta = []
         z = []
         for _logobs, _logtrans in zip(logobs, logtrans):
@@ -195,14 +634,42 @@ class HMM:
 
         return delta, z
 
-    def estep(self, obs, act=None):
+    @property
+    def stationary(self):
+        return isinstance(self.transitions, StationaryTransition)
+
+    def estep(self, obs, act=None, reduce=False, checkpoint=False, beam=None):
         loglikhds = self.log_likelihoods(obs, act)
-        alpha, norm = self.forward(*loglikhds)
-        beta = self.backward(*loglikhds, scale=norm)
+        if beam is not None:
+            # approximate, beam holds the size and threshold of
+            # beam_statistics, the likelihood is a lower bound
+            assert not checkpoint, "beam-pruned e-step is not checkpointed"
+            gamma, zeta, norm, pruned = self.beam_statistics(*loglikhds, reduce=reduce and self.stationary,
+                                                             **beam)
+            self.pruned_mass = np.sum(np.hstack(pruned))
+            return gamma, zeta, np.sum(np.hstack(norm))
+
+        if checkpoint:
+            # no full alpha or beta, gamma is still T x K but zeta is
+            # only available in the reduced form of reduce=True
+            if not reduce:
+                raise ValueError("checkpointed e-step only returns reduced statistics, "
+                                 "call it with reduce=True")
+            gamma, zeta, loglik = self.checkpointed_statistics(*loglikhds)
+            return gamma, zeta, np.sum(loglik)
+
+        if reduce:
+            # sufficient statistics only, no T x K x K zeta. Time-summed
+            # counts, plus their per-step marginals for recurrent models
+            gamma, zeta, norm = self.expected_statistics(*loglikhds)
+            return gamma, zeta, np.sum(np.hstack(norm))
+
+        alpha, norm, beta = self.forward_backward(*loglikhds)
         gamma = self.posterior(alpha, beta)
         zeta = self.joint_posterior(alpha, beta, *loglikhds)
 
-        return gamma, zeta
+        # forward normalizer is the log-likelihood of current parameters
+        return gamma, zeta, np.sum(np.hstack(norm))
 
     def mstep(self, gamma, zeta,
               obs, act,
@@ -223,27 +690,43 @@ class HMM:
            obs_mstep_kwargs={}, **kwargs):
 
         process_id = kwargs.get('process_id', 0)
+        checkpoint = kwargs.get('checkpoint', False)
+        beam = kwargs.get('beam', None)
+        prune = kwargs.get('prune', None)
+
+        # weighted recurrent m-steps need the full joint posterior
+        reduce = self.stationary or kwargs.get('weights', None) is None
 
         train_lls = []
-        train_ll = self.log_norm(train_obs, train_act)
+        gamma, zeta, train_ll = self.estep(train_obs, train_act, reduce=reduce,
+                                           checkpoint=checkpoint, beam=beam)
+        if prune is not None and self.prune(gamma, prune):
+            gamma, zeta, train_ll = self.estep(train_obs, train_act, reduce=reduce,
+                                               checkpoint=checkpoint, beam=beam)
         train_lls.append(train_ll)
         last_train_ll = train_ll
 
         pbar = trange(nb_iter, position=process_id)
-        pbar.set_description("#{}, ll: {:.5f}".format(process_id, train_lls[-1]))
+        pbar.set_description(self._progress(process_id, train_lls[-1], beam))
 
         for _ in pbar:
-            gamma, zeta = self.estep(train_obs, train_act)
             self.mstep(gamma, zeta, train_obs, train_act,
                        init_mstep_kwargs,
                        trans_mstep_kwargs,
                        obs_mstep_kwargs,
                        **kwargs)
 
-            train_ll = self.log_norm(train_obs, train_act)
+            # e-step on the new parameters also yields their likelihood
+            gamma, zeta, train_ll = self.estep(train_obs, train_act, reduce=reduce,
+                                               checkpoint=checkpoint, beam=beam)
+
+            # dead states are dropped and the statistics recomputed
+            if prune is not None and self.prune(gamma, prune):
+                gamma, zeta, train_ll = self.estep(train_obs, train_act, reduce=reduce,
+                                                   checkpoint=checkpoint, beam=beam)
             train_lls.append(train_ll)
 
-            pbar.set_description("#{}, ll: {:.5f}".format(process_id, train_lls[-1]))
+            pbar.set_description(self._progress(process_id, train_lls[-1], beam))
 
             if abs(train_ll - last_train_ll) < prec:
                 break
@@ -252,21 +735,40 @@ class HMM:
 
         return train_lls
 
+    def _progress(self, process_id, train_ll, beam=None):
+        if beam is None:
+            return "#{}, ll: {:.5f}".format(process_id, train_ll)
+        # pruned e-steps give a lower bound, report the discarded mass
+        return "#{}, ll >= {:.5f}, pruned: {:.2e}".format(process_id, train_ll, self.pruned_mass)
+
     @ensure_args_are_viable_lists
     def earlystop_em(self, train_obs, train_act=None, nb_iter=50, prec=1e-4,
                      init_mstep_kwargs={}, trans_mstep_kwargs={}, obs_mstep_kwargs={},
                      test_obs=None, test_act=None, **kwargs):
 
+        if isinstance(test_obs, Dataset):
+            test_obs, test_act = test_obs.obs, test_obs.act
+
         assert test_obs is not None and test_act is not None
 
         process_id = kwargs.get('process_id', 0)
+        checkpoint = kwargs.get('checkpoint', False)
+        beam = kwargs.get('beam', None)
+        prune = kwargs.get('prune', None)
+
+        # weighted recurrent m-steps need the full joint posterior
+        reduce = self.stationary or kwargs.get('weights', None) is None
 
         nb_train = np.vstack(train_obs).shape[0]
         nb_test = np.vstack(test_obs).shape[0]
         nb_all = nb_train + nb_test
 
         train_lls = []
-        train_ll = self.log_norm(train_obs, train_act)
+        gamma, zeta, train_ll = self.estep(train_obs, train_act, reduce=reduce,
+                                           checkpoint=checkpoint, beam=beam)
+        if prune is not None and self.prune(gamma, prune):
+            gamma, zeta, train_ll = self.estep(train_obs, train_act, reduce=reduce,
+                                               checkpoint=checkpoint, beam=beam)
         train_lls.append(train_ll)
         last_train_ll = train_ll
 
@@ -285,14 +787,17 @@ class HMM:
                              " score: {:.5f}".format(process_id, train_ll, test_ll, score))
 
         for _ in pbar:
-            gamma, zeta = self.estep(train_obs, train_act)
             self.mstep(gamma, zeta, train_obs, train_act,
                        init_mstep_kwargs,
                        trans_mstep_kwargs,
                        obs_mstep_kwargs,
                        **kwargs)
 
-            train_ll = self.log_norm(train_obs, train_act)
+            gamma, zeta, train_ll = self.estep(train_obs, train_act, reduce=reduce,
+                                               checkpoint=checkpoint, beam=beam)
+            if prune is not None and self.prune(gamma, prune):
+                gamma, zeta, train_ll = self.estep(train_obs, train_act, reduce=reduce,
+                                                   checkpoint=checkpoint, beam=beam)
             train_lls.append(train_ll)
 
             test_ll = self.log_norm(test_obs, test_act)
@@ -314,13 +819,15 @@ class HMM:
     @ensure_args_are_viable_lists
     def mean_observation(self, obs, act=None):
         loglikhds = self.log_likelihoods(obs, act)
-        alpha, norm = self.forward(*loglikhds)
-        beta = self.backward(*loglikhds, scale=norm)
+        alpha, norm, beta = self.forward_backward(*loglikhds)
         gamma = self.posterior(alpha, beta)
 
         mean_obs = self.observations.smooth(gamma, obs, act)
         return mean_obs
 
+    def online_filter(self, nb_streams=None):
+        return OnlineFilter(self, nb_streams)
+
     @ensure_args_are_viable_lists
     def filter(self, obs, act=None):
         logliklhds = self.log_likelihoods(obs, act)
@@ -349,7 +856,42 @@ class HMM:
 
         return state, obs
 
+    def sample_batch(self, nb_samples, horizon, act=None):
+        # all samples advance together, the variates are drawn in
+        # blocks up front and stationary transition cdfs only once
+        N, T = nb_samples, horizon
+        _act = np.zeros((N, T, self.dm_act)) if act is None\
+            else np.broadcast_to(np.asarray(act), (N, T, self.dm_act))
+
+        _unif = npr.rand(N, T)
+        _noise = npr.randn(N, T, self.dm_obs)
+
+        state = np.zeros((N, T), np.int64)
+        obs = np.zeros((N, T, self.dm_obs))
+
+        state[:, 0] = inverse_cdf(np.cumsum(self.init_state.pi), _unif[:, 0])
+        obs[:, 0, :] = self._draw_batch(0, state, obs, _act, _noise)
+
+        _cdf = self.transitions.cdf() if self.stationary else None
+        for t in range(1, T):
+            if self.stationary:
+                _trans_cdf = _cdf[state[:, t - 1]]
+            else:
+                _trans_cdf = self.transitions.cdf(obs[:, t - 1, :], _act[:, t - 1, :])[np.arange(N), state[:, t - 1]]
+            state[:, t] = inverse_cdf(_trans_cdf, _unif[:, t])
+            obs[:, t, :] = self._draw_batch(t, state, obs, _act, _noise)
+
+        return list(state), list(obs)
+
+    # observations of step t of all samples given their states and
+    # the history up to t, models with lags override only this part
+    def _draw_batch(self, t, state, obs, act, noise):
+        return self.observations.draw(state[:, t], noise[:, t, :])
+
     def step(self, obs, act, belief, stoch=True, average=False):
+        # single observation history, see forcast for multi-lag models
+        assert getattr(self.observations, 'lags', 1) == 1
+
         if stoch:
             # it doesn't make sense to average while sampling
             assert not average
@@ -385,28 +927,33 @@ class HMM:
         nxt_state = []
         nxt_obs = []
 
+        lags = getattr(self.observations, 'lags', 1)
         for n in range(len(horizon)):
             _hist_obs = hist_obs[n]
             _hist_act = hist_act[n]
 
+            # predictions follow the last lags observations of the history,
+            # _lagged(t) is the window that ends with the t-th prediction
+            _obs = np.zeros((horizon[n] + lags, self.dm_obs))
+            _obs[:lags, :] = _hist_obs[-lags:, ...]
+            _lagged = lambda t: _obs[t:t + lags, :].ravel()
+
             _nxt_act = np.zeros((horizon[n], self.dm_act)) if nxt_act is None else nxt_act[n]
-            _nxt_obs = np.zeros((horizon[n] + 1, self.dm_obs))
+            _nxt_obs = _obs[lags - 1:, :]
             _nxt_state = np.zeros((horizon[n] + 1,), np.int64)
 
             _belief = self.filter(_hist_obs, _hist_act)[0][-1, ...]
 
             if stoch:
                 _nxt_state[0] = npr.choice(self.nb_states, p=_belief)
-                _nxt_obs[0, :] = _hist_obs[-1, ...]
                 for t in range(horizon[n]):
                     _nxt_state[t + 1] = self.transitions.sample(_nxt_state[t], _nxt_obs[t, :], _nxt_act[t, :])
-                    _nxt_obs[t + 1, :] = self.observations.sample(_nxt_state[t + 1], _nxt_obs[t, :], _nxt_act[t, :])
+                    _nxt_obs[t + 1, :] = self.observations.sample(_nxt_state[t + 1], _lagged(t), _nxt_act[t, :])
             else:
                 if average:
                     # return empty discrete state when mixing
                     _nxt_state = None
 
-                    _nxt_obs[0, :] = _hist_obs[-1, ...]
                     for t in range(horizon[n]):
 
                         # average over transitions and belief space
@@ -419,13 +966,12 @@ class HMM:
 
                         # average observations
                         for k in range(self.nb_states):
-                            _nxt_obs[t + 1, :] += _belief[k] * self.observations.mean(k, _nxt_obs[t, :], _nxt_act[t, :])
+                            _nxt_obs[t + 1, :] += _belief[k] * self.observations.mean(k, _lagged(t), _nxt_act[t, :])
                 else:
                     _nxt_state[0] = np.argmax(_belief)
-                    _nxt_obs[0, :] = _hist_obs[-1, ...]
                     for t in range(horizon[n]):
                         _nxt_state[t + 1] = self.transitions.likeliest(_nxt_state[t], _nxt_obs[t, :], _nxt_act[t, :])
-                        _nxt_obs[t + 1, :] = self.observations.mean(_nxt_state[t + 1], _nxt_obs[t, :], _nxt_act[t, :])
+                        _nxt_obs[t + 1, :] = self.observations.mean(_nxt_state[t + 1], _lagged(t), _nxt_act[t, :])
 
             nxt_state.append(_nxt_state)
             nxt_obs.append(_nxt_obs)
@@ -438,25 +984,28 @@ class HMM:
         from sklearn.metrics import mean_squared_error,\
             explained_variance_score, r2_score
 
+        # histories need at least as many steps as the model has lags
+        lags = getattr(self.observations, 'lags', 1)
+
         mse, smse, evar = [], [], []
         for _obs, _act in zip(obs, act):
             _hist_obs, _hist_act, _nxt_act = [], [], []
             _target, _prediction = [], []
 
-            _nb_steps = _obs.shape[0] - horizon
-            for t in range(_nb_steps):
+            _steps = range(lags - 1, _obs.shape[0] - horizon)
+            for t in _steps:
                 _hist_obs.append(_obs[:t + 1, :])
                 _hist_act.append(_act[:t + 1, :])
                 _nxt_act.append(_act[t: t + horizon, :])
 
-            _hr = [horizon for _ in range(_nb_steps)]
+            _hr = [horizon for _ in _steps]
             _, _forcast = self.forcast(hist_obs=_hist_obs, hist_act=_hist_act,
                                        nxt_act=_nxt_act, horizon=_hr, stoch=stoch,
                                        average=average)
 
-            for t in range(_nb_steps):
+            for n, t in enumerate(_steps):
                 _target.append(_obs[t + horizon, :])
-                _prediction.append(_forcast[t][-1, :])
+                _prediction.append(_forcast[n][-1, :])
 
             _target = np.vstack(_target)
             _prediction = np.vstack(_prediction)
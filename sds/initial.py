@@ -8,7 +8,10 @@ from scipy import linalg, stats, special
 from scipy.stats import multivariate_normal as mvn
 
 from sds.stats import multivariate_normal_logpdf as lg_mvn
+from sds.stats import masked_multivariate_normal_logpdf as mk_mvn
+from sds.stats import conditional_expectations as cond_exp
 from sds.utils import linear_regression
+from sds.utils import params_version, versioned_memo
 
 from sklearn.preprocessing import PolynomialFeatures
 
@@ -31,6 +34,10 @@ class CategoricalInitState:
     def params(self, value):
         self.logpi = value
 
+    @property
+    def version(self):
+        return params_version(self.params)
+
     @property
     def pi(self):
         return np.exp(self.logpi - logsumexp(self.logpi))
@@ -54,7 +61,9 @@ class CategoricalInitState:
         return lp
 
     def permute(self, perm):
+        # a subset of the states drops the others
         self.logpi = self.logpi[perm]
+        self.nb_states = len(perm)
 
     def mstep(self, gamma, **kwargs):
         _pi = sum([_w[0, :] for _w in gamma]) + self.reg
@@ -63,11 +72,14 @@ class CategoricalInitState:
 
 class GaussianInitObservation:
 
-    def __init__(self, nb_states, dm_obs, dm_act, prior, reg=1e-8):
+    def __init__(self, nb_states, dm_obs, dm_act, prior, lags=1, reg=1e-8):
         self.nb_states = nb_states
         self.dm_obs = dm_obs
         self.dm_act = dm_act
 
+        # leading observations without an autoregressive history
+        self.lags = lags
+
         self.prior = prior
         self.reg = reg
 
@@ -80,6 +92,8 @@ class GaussianInitObservation:
             _cov = sc.stats.invwishart.rvs(self.dm_obs + 1, np.eye(self.dm_obs))
             self._sqrt_cov[k, ...] = np.linalg.cholesky(_cov * np.eye(self.dm_obs))
 
+        self._mask_factors = None
+
     @property
     def params(self):
         return self.mu, self._sqrt_cov
@@ -88,6 +102,10 @@ class GaussianInitObservation:
     def params(self, value):
         self.mu, self._sqrt_cov = value
 
+    @property
+    def version(self):
+        return params_version(self.params)
+
     def mean(self, z):
         return self.mu[z, :]
 
@@ -99,13 +117,23 @@ class GaussianInitObservation:
     def cov(self, value):
         self._sqrt_cov = np.linalg.cholesky(value + self.reg * np.eye(self.dm_obs))
 
+    @property
+    def mask_factors(self):
+        # marginal factors of partially observed rows by mask
+        return versioned_memo(self, '_mask_factors', params_version(self._sqrt_cov))
+
     def sample(self, z):
         _x = mvn(mean=self.mean(z), cov=self.cov[z, ...]).rvs()
         return np.atleast_1d(_x)
 
+    # samples of N states at once from given standard normal noise
+    def draw(self, z, noise):
+        return self.mu[z, :] + np.einsum('nkh,nh->nk', self._sqrt_cov[z, ...], noise)
+
     def initialize(self, x):
         from sklearn.cluster import KMeans
         _obs = np.concatenate(x)
+        _obs = _obs[~np.any(np.isnan(_obs), axis=1)]
         km = KMeans(self.nb_states).fit(_obs)
 
         self.mu = km.cluster_centers_
@@ -115,6 +143,7 @@ class GaussianInitObservation:
     def permute(self, perm):
         self.mu = self.mu[perm, ...]
         self._sqrt_cov = self._sqrt_cov[perm, ...]
+        self.nb_states = len(perm)
 
     def log_prior(self):
         lp = 0.
@@ -123,12 +152,21 @@ class GaussianInitObservation:
         return lp
 
     def log_likelihood(self, x):
-        loglik = []
-        for _x in x:
-            _loglik = np.column_stack([lg_mvn(_x[0], self.mean(k), self.cov[k])
-                                       for k in range(self.nb_states)])
-            loglik.append(_loglik)
-        return loglik
+        return [self.rows_log_likelihood(_x[:self.lags]) for _x in x]
+
+    # log-likelihoods of the last steps of N windows, N x K
+    def log_likelihood_step(self, x, u=None):
+        return self.rows_log_likelihood(x[:, -1, :])
+
+    # log-likelihoods of independent observations, T x K
+    def rows_log_likelihood(self, x):
+        # missing entries are nans and get marginalized
+        if np.any(np.isnan(x)):
+            _mask = ~np.isnan(x)
+            return mk_mvn(np.where(_mask, x, 0.), self.mu,
+                          self._sqrt_cov, _mask, self.mask_factors).T
+        return np.column_stack([lg_mvn(x, self.mean(k), self.cov[k])
+                                for k in range(self.nb_states)])
 
     def mstep(self, gamma, x, weights=None, **kwargs):
         aux = []
@@ -137,27 +175,41 @@ class GaussianInitObservation:
                aux.append(_w[:, None] * _gamma)
             gamma = aux
 
+        # missing entries are replaced by their expectations under the
+        # current parameters, their uncertainty enters the covariances
+        xs = []
+        _extra = np.zeros((self.nb_states, self.dm_obs, self.dm_obs))
+        for _x, _w in zip(x, gamma):
+            if np.any(np.isnan(_x[:self.lags])):
+                _xhat, _ccov = cond_exp(_x[:self.lags], self.mu, self.cov)
+                for _inds, _C in _ccov:
+                    _extra += np.sum(_w[_inds], axis=0)[:, None, None] * _C
+                xs.append(_xhat)
+            else:
+                xs.append(_x[:self.lags, None, :])
+
         _J = self.reg * np.ones((self.nb_states, self.dm_obs))
         _h = np.zeros((self.nb_states, self.dm_obs))
-        for _x, _w in zip(x, gamma):
-            _J += _w[0, :, None]
-            _h += _w[0, :, None] * _x[0, None, :]
+        for _x, _w in zip(xs, gamma):
+            _J += np.sum(_w[:self.lags, :, None], axis=0)
+            _h += np.sum(_w[:self.lags, :, None] * _x, axis=0)
 
         self.mu = _h / _J
 
         sqerr = np.zeros((self.nb_states, self.dm_obs, self.dm_obs))
         weight = self.reg * np.ones((self.nb_states, ))
-        for _x, _w in zip(x, gamma):
-            resid = _x[0, None, :] - self.mu
-            sqerr += _w[0, :, None, None] * resid[:, None, :] * resid[:, :, None]
-            weight += _w[0, ...]
+        for _x, _w in zip(xs, gamma):
+            resid = _x - self.mu
+            sqerr += np.sum(_w[:self.lags, :, None, None] * resid[:, :, None, :] * resid[:, :, :, None], axis=0)
+            weight += np.sum(_w[:self.lags, ...], axis=0)
+        sqerr += _extra
 
         self.cov = sqerr / weight[:, None, None]
 
     def smooth(self, gamma, x):
         mean = []
         for _x, _gamma in zip(x, gamma):
-            mean.append(np.einsum('k,kl->l', _gamma[0, ...], self.mu))
+            mean.append(np.einsum('nk,kl->nl', _gamma[:self.lags, ...], self.mu))
         return mean
 
 
@@ -196,6 +248,10 @@ class GaussianInitControl:
     def params(self, value):
         self.K, self.kff, self._sqrt_cov = value
 
+    @property
+    def version(self):
+        return params_version(self.params)
+
     def featurize(self, x):
         feat = self.basis.fit_transform(np.atleast_2d(x)).squeeze()
         return feat
@@ -248,6 +304,7 @@ class GaussianInitControl:
         self.K = self.K[perm, ...]
         self.kff = self.kff[perm, ...]
         self._sqrt_cov = self._sqrt_cov[perm, ...]
+        self.nb_states = len(perm)
 
     def log_prior(self):
         lp = 0.
@@ -263,6 +320,11 @@ class GaussianInitControl:
             loglik.append(_loglik)
         return loglik
 
+    # log-likelihoods of the last steps of N windows, N x K
+    def log_likelihood_step(self, x, u):
+        return np.column_stack([lg_mvn(u[:, -1, :], self.mean(k, x=x[:, -1, :]), self.cov[k])
+                                for k in range(self.nb_states)])
+
     def mstep(self, gamma, x, u, weights=None, **kwargs):
         aux = []
         if weights:
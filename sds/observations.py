@@ -7,15 +7,25 @@ from scipy import stats
 from scipy.stats import multivariate_normal as mvn
 from scipy.stats import invwishart as invw
 
+from scipy.linalg import solve_triangular
+
 from sds.stats import multivariate_normal_logpdf as lg_mvn
+from sds.stats import factored_multivariate_normal_logpdf as fc_mvn
+from sds.stats import diagonal_multivariate_normal_logpdf as dg_mvn
+from sds.stats import masked_multivariate_normal_logpdf as mk_mvn
+from sds.stats import conditional_expectations as cond_exp
 
 from sds.utils import random_rotation
 from sds.utils import linear_regression
+from sds.utils import batch_linear_regression
+from sds.utils import memoize
+from sds.utils import lag_embed
+from sds.utils import params_version, versioned_memo
 
 
 class GaussianObservation:
 
-    def __init__(self, nb_states, dm_obs, dm_act, prior, reg=1e-32):
+    def __init__(self, nb_states, dm_obs, dm_act, prior, reg=1e-32, cov_type='full'):
         self.nb_states = nb_states
         self.dm_obs = dm_obs
         self.dm_act = dm_act
@@ -23,6 +33,10 @@ class GaussianObservation:
         self.prior = prior
         self.reg = reg
 
+        # 'full' per-state, 'diagonal' per-state or one 'tied' covariance
+        assert cov_type in ('full', 'diagonal', 'tied')
+        self.cov_type = cov_type
+
         self.mu = npr.randn(self.nb_states, self.dm_obs)
 
         # self._sqrt_cov = npr.randn(self.nb_states, self.dm_obs, self.dm_obs)
@@ -32,6 +46,11 @@ class GaussianObservation:
             _cov = sc.stats.invwishart.rvs(self.dm_obs + 1, np.eye(self.dm_obs))
             self._sqrt_cov[k, ...] = np.linalg.cholesky(_cov * np.eye(self.dm_obs))
 
+        if self.cov_type != 'full':
+            self.cov = self.cov
+
+        self._mask_factors = None
+
     @property
     def params(self):
         return self.mu, self._sqrt_cov
@@ -40,6 +59,10 @@ class GaussianObservation:
     def params(self, value):
         self.mu, self._sqrt_cov = value
 
+    @property
+    def version(self):
+        return params_version(self.params)
+
     def mean(self, z, x=None, u=None):
         return self.mu[z, :]
 
@@ -49,15 +72,33 @@ class GaussianObservation:
 
     @cov.setter
     def cov(self, value):
-        self._sqrt_cov = np.linalg.cholesky(value + self.reg * np.eye(self.dm_obs))
+        # the factors keep the K x D x D layout for every covariance type
+        if self.cov_type == 'diagonal':
+            _var = np.diagonal(value, axis1=-2, axis2=-1)
+            self._sqrt_cov = np.sqrt(_var + self.reg)[..., None] * np.eye(self.dm_obs)
+        elif self.cov_type == 'tied':
+            _sqrt_cov = np.linalg.cholesky(np.mean(value, axis=0) + self.reg * np.eye(self.dm_obs))
+            self._sqrt_cov = np.repeat(_sqrt_cov[None, ...], self.nb_states, axis=0)
+        else:
+            self._sqrt_cov = np.linalg.cholesky(value + self.reg * np.eye(self.dm_obs))
+
+    @property
+    def mask_factors(self):
+        # marginal factors of partially observed rows by mask
+        return versioned_memo(self, '_mask_factors', params_version(self._sqrt_cov))
 
     def sample(self, z, x=None, u=None):
         _x = mvn(mean=self.mean(z), cov=self.cov[z, ...]).rvs()
         return np.atleast_1d(_x)
 
+    # samples of N states at once from given standard normal noise
+    def draw(self, z, noise, x=None, u=None):
+        return self.mu[z, :] + np.einsum('nkh,nh->nk', self._sqrt_cov[z, ...], noise)
+
     def initialize(self, x, u, **kwargs):
         from sklearn.cluster import KMeans
         _obs = np.concatenate(x)
+        _obs = _obs[~np.any(np.isnan(_obs), axis=1)]
         km = KMeans(self.nb_states).fit(_obs)
 
         self.mu = km.cluster_centers_
@@ -65,8 +106,10 @@ class GaussianObservation:
                              for k in range(self.nb_states)])
 
     def permute(self, perm):
+        # a subset of the states drops the others
         self.mu = self.mu[perm]
         self._sqrt_cov = self._sqrt_cov[perm]
+        self.nb_states = len(perm)
 
     def log_prior(self):
         lp = 0.
@@ -75,6 +118,29 @@ class GaussianObservation:
         return lp
 
     def log_likelihood(self, x, u):
+        # missing entries are nans and get marginalized
+        if any(np.any(np.isnan(_x)) for _x in x):
+            loglik = []
+            for _x in x:
+                _mask = ~np.isnan(_x)
+                _loglik = mk_mvn(np.where(_mask, _x, 0.), self.mu, self._sqrt_cov,
+                                 _mask, self.mask_factors)
+                loglik.append(_loglik.T)
+            return loglik
+
+        if self.cov_type == 'diagonal':
+            _sqrt_var = np.diagonal(self._sqrt_cov, axis1=-2, axis2=-1)
+            return [dg_mvn(_x[:, None, :], self.mu, _sqrt_var) for _x in x]
+
+        if self.cov_type == 'tied':
+            # whiten the data and the means once with the shared factor
+            _sqrt_cov_inv = solve_triangular(self._sqrt_cov[0], np.eye(self.dm_obs), lower=True)
+            _half_log_det = np.sum(np.log(np.abs(np.diag(self._sqrt_cov[0]))))
+            _mu = np.dot(self.mu, _sqrt_cov_inv.T)
+            _ones = np.ones((self.dm_obs, ))
+            return [dg_mvn(np.dot(_x, _sqrt_cov_inv.T)[:, None, :], _mu, _ones) - _half_log_det
+                    for _x in x]
+
         loglik = []
         for _x in x:
             _loglik = np.column_stack([lg_mvn(_x, self.mean(k), self.cov[k])
@@ -82,23 +148,64 @@ class GaussianObservation:
             loglik.append(_loglik)
         return loglik
 
+    # log-likelihoods of the last steps of N windows, N x K
+    def log_likelihood_step(self, x, u=None):
+        return self.log_likelihood([x[:, -1, :]], None)[0]
+
     def mstep(self, gamma, x, u, weights=None, **kwargs):
+        # missing entries are replaced by their expectations under the
+        # current parameters, their uncertainty enters the covariances
+        xs = []
+        _extra = np.zeros((self.nb_states, self.dm_obs, self.dm_obs))
+        for _x, _w in zip(x, gamma):
+            if np.any(np.isnan(_x)):
+                _xhat, _ccov = cond_exp(_x, self.mu, self.cov)
+                for _inds, _C in _ccov:
+                    _extra += np.sum(_w[_inds], axis=0)[:, None, None] * _C
+                xs.append(_xhat)
+            else:
+                xs.append(_x[:, None, :])
+
         _J = np.zeros((self.nb_states, self.dm_obs))
         _h = np.zeros((self.nb_states, self.dm_obs))
-        for _x, _w in zip(x, gamma):
+        for _x, _w in zip(xs, gamma):
             _J += np.sum(_w[:, :, None], axis=0)
-            _h += np.sum(_w[:, :, None] * _x[:, None, :], axis=0)
+            _h += np.sum(_w[:, :, None] * _x, axis=0)
 
         self.mu = _h / _J
 
-        sqerr = np.zeros((self.nb_states, self.dm_obs, self.dm_obs))
-        weight = self.reg * np.ones((self.nb_states, ))
-        for _x, _w in zip(x, gamma):
-            resid = _x[:, None, :] - self.mu
-            sqerr += np.sum(_w[:, :, None, None] * resid[:, :, None, :] * resid[:, :, :, None], axis=0)
-            weight += np.sum(_w, axis=0)
+        if self.cov_type == 'diagonal':
+            sqerr = np.zeros((self.nb_states, self.dm_obs))
+            weight = self.reg * np.ones((self.nb_states, ))
+            for _x, _w in zip(xs, gamma):
+                resid = _x - self.mu
+                sqerr += np.einsum('tk,tkd->kd', _w, resid**2)
+                weight += np.sum(_w, axis=0)
+            sqerr += np.diagonal(_extra, axis1=-2, axis2=-1)
+
+            self.cov = (sqerr / weight[:, None])[..., None] * np.eye(self.dm_obs)
 
-        self.cov = sqerr / weight[:, None, None]
+        elif self.cov_type == 'tied':
+            sqerr = np.zeros((self.dm_obs, self.dm_obs))
+            weight = self.reg
+            for _x, _w in zip(xs, gamma):
+                resid = _x - self.mu
+                sqerr += np.einsum('tk,tki,tkj->ij', _w, resid, resid, optimize=True)
+                weight += np.sum(_w)
+            sqerr += np.sum(_extra, axis=0)
+
+            self.cov = np.repeat((sqerr / weight)[None, ...], self.nb_states, axis=0)
+
+        else:
+            sqerr = np.zeros((self.nb_states, self.dm_obs, self.dm_obs))
+            weight = self.reg * np.ones((self.nb_states, ))
+            for _x, _w in zip(xs, gamma):
+                resid = _x - self.mu
+                sqerr += np.sum(_w[:, :, None, None] * resid[:, :, None, :] * resid[:, :, :, None], axis=0)
+                weight += np.sum(_w, axis=0)
+            sqerr += _extra
+
+            self.cov = sqerr / weight[:, None, None]
 
     def smooth(self, gamma, x, u):
         mean = []
@@ -109,7 +216,7 @@ class GaussianObservation:
 
 class AutoRegressiveGaussianObservation:
 
-    def __init__(self, nb_states, dm_obs, dm_act, prior, reg=1e-32):
+    def __init__(self, nb_states, dm_obs, dm_act, prior, reg=1e-32, cov_type='full', lags=1):
         self.nb_states = nb_states
         self.dm_obs = dm_obs
         self.dm_act = dm_act
@@ -117,9 +224,16 @@ class AutoRegressiveGaussianObservation:
         self.prior = prior
         self.reg = reg
 
+        # number of past observations, the oldest comes first in A
+        self.lags = lags
+
+        # 'full' per-state, 'diagonal' per-state or one 'tied' covariance
+        assert cov_type in ('full', 'diagonal', 'tied')
+        self.cov_type = cov_type
+
         self._sqrt_cov = np.zeros((self.nb_states, self.dm_obs, self.dm_obs))
 
-        self.A = np.zeros((self.nb_states, self.dm_obs, self.dm_obs))
+        self.A = np.zeros((self.nb_states, self.dm_obs, self.dm_obs * self.lags))
         self.B = np.zeros((self.nb_states, self.dm_obs, self.dm_act))
         self.c = np.zeros((self.nb_states, self.dm_obs))
 
@@ -132,10 +246,17 @@ class AutoRegressiveGaussianObservation:
         for k in range(self.nb_states):
             _cov = sc.stats.invwishart.rvs(self.dm_obs + 1, np.eye(self.dm_obs))
             self._sqrt_cov[k, ...] = np.linalg.cholesky(_cov * np.eye(self.dm_obs))
-            self.A[k, ...] = sc.stats.matrix_normal.rvs(mean=None, rowcov=_cov, colcov=_cov)
+            self.A[k, ...] = sc.stats.matrix_normal.rvs(mean=None, rowcov=_cov,
+                                                        colcov=np.kron(np.eye(self.lags), _cov))
             self.B[k, ...] = sc.stats.matrix_normal.rvs(mean=None, rowcov=_cov, colcov=_cov)[:, [0]]
             self.c[k, ...] = sc.stats.matrix_normal.rvs(mean=None, rowcov=_cov, colcov=_cov)[:, 0]
 
+        if self.cov_type != 'full':
+            self.cov = self.cov
+
+        self._factors = None
+        self._mask_factors = None
+
     @property
     def params(self):
         return self.A, self.B, self.c, self._sqrt_cov
@@ -144,6 +265,11 @@ class AutoRegressiveGaussianObservation:
     def params(self, value):
         self.A, self.B, self.c, self._sqrt_cov = value
 
+    @property
+    def version(self):
+        return params_version(self.params)
+
+    # x holds the last lags observations side by side, oldest first
     def mean(self, z, x, u):
         return np.einsum('kh,...h->...k', self.A[z, ...], x) +\
                np.einsum('kh,...h->...k', self.B[z, ...], u) + self.c[z, :]
@@ -154,16 +280,56 @@ class AutoRegressiveGaussianObservation:
 
     @cov.setter
     def cov(self, value):
-        self._sqrt_cov = np.linalg.cholesky(value + self.reg * np.eye(self.dm_obs))
+        # the factors keep the K x D x D layout for every covariance type
+        if self.cov_type == 'diagonal':
+            _var = np.diagonal(value, axis1=-2, axis2=-1)
+            self._sqrt_cov = np.sqrt(_var + self.reg)[..., None] * np.eye(self.dm_obs)
+        elif self.cov_type == 'tied':
+            _sqrt_cov = np.linalg.cholesky(np.mean(value, axis=0) + self.reg * np.eye(self.dm_obs))
+            self._sqrt_cov = np.repeat(_sqrt_cov[None, ...], self.nb_states, axis=0)
+        else:
+            self._sqrt_cov = np.linalg.cholesky(value + self.reg * np.eye(self.dm_obs))
+
+    @property
+    def factors(self):
+        # inverse cholesky factors and half log-determinants,
+        # recomputed only when the covariances change
+        version = params_version(self._sqrt_cov)
+        if self._factors is None or self._factors[0] != version:
+            _eye = np.eye(self.dm_obs)
+            if self.cov_type == 'diagonal':
+                _sqrt_cov_inv = _eye / np.diagonal(self._sqrt_cov, axis1=-2, axis2=-1)[..., None]
+            elif self.cov_type == 'tied':
+                _sqrt_cov_inv = solve_triangular(self._sqrt_cov[0], _eye, lower=True)
+                _sqrt_cov_inv = np.repeat(_sqrt_cov_inv[None, ...], self.nb_states, axis=0)
+            else:
+                _sqrt_cov_inv = np.stack([solve_triangular(_L, _eye, lower=True)
+                                          for _L in self._sqrt_cov])
+            _half_log_det = np.sum(np.log(np.abs(np.diagonal(self._sqrt_cov,
+                                                             axis1=-2, axis2=-1))), axis=-1)
+            self._factors = (version, _sqrt_cov_inv, _half_log_det)
+        return self._factors[1:]
+
+    @property
+    def mask_factors(self):
+        # marginal factors of partially observed targets by mask
+        return versioned_memo(self, '_mask_factors', params_version(self._sqrt_cov))
 
     def sample(self, z, x, u):
         _x = mvn(self.mean(z, x, u), cov=self.cov[z, ...]).rvs()
         return np.atleast_1d(_x)
 
+    # samples of N states at once from given standard normal noise,
+    # x holds the lagged observations of every sample side by side
+    def draw(self, z, noise, x, u):
+        return np.einsum('nkh,nh->nk', self.A[z, ...], x)\
+               + np.einsum('nkh,nh->nk', self.B[z, ...], u[:, :self.dm_act])\
+               + self.c[z, :] + np.einsum('nkh,nh->nk', self._sqrt_cov[z, ...], noise)
+
     def reset(self):
         self._sqrt_cov = np.zeros((self.nb_states, self.dm_obs, self.dm_obs))
 
-        self.A = np.zeros((self.nb_states, self.dm_obs, self.dm_obs))
+        self.A = np.zeros((self.nb_states, self.dm_obs, self.dm_obs * self.lags))
         self.B = np.zeros((self.nb_states, self.dm_obs, self.dm_act))
         self.c = np.zeros((self.nb_states, self.dm_obs))
 
@@ -176,10 +342,14 @@ class AutoRegressiveGaussianObservation:
         for k in range(self.nb_states):
             _cov = sc.stats.invwishart.rvs(self.dm_obs + 1, 1. * np.eye(self.dm_obs))
             self._sqrt_cov[k, ...] = np.linalg.cholesky(_cov * np.eye(self.dm_obs))
-            self.A[k, ...] = sc.stats.matrix_normal.rvs(mean=None, rowcov=_cov, colcov=_cov)
+            self.A[k, ...] = sc.stats.matrix_normal.rvs(mean=None, rowcov=_cov,
+                                                        colcov=np.kron(np.eye(self.lags), _cov))
             self.B[k, ...] = sc.stats.matrix_normal.rvs(mean=None, rowcov=_cov, colcov=_cov)[:, [0]]
             self.c[k, ...] = sc.stats.matrix_normal.rvs(mean=None, rowcov=_cov, colcov=_cov)[:, 0]
 
+        if self.cov_type != 'full':
+            self.cov = self.cov
+
     def initialize(self, x, u, **kwargs):
         localize = kwargs.get('localize', True)
 
@@ -187,33 +357,42 @@ class AutoRegressiveGaussianObservation:
         if localize:
             from sklearn.cluster import KMeans
             km = KMeans(self.nb_states)
-            km.fit(np.hstack((np.vstack(x), np.vstack(u))))
+            _data = np.hstack((np.vstack(x), np.vstack(u)))
+            # missing entries are set to the average for clustering
+            _data = np.where(np.isnan(_data), np.nanmean(_data, axis=0), _data)
+            km.fit(_data)
             zs = np.split(km.labels_, np.cumsum(Ts)[:-1])
-            zs = [z[:-1] for z in zs]
+            zs = [z[:-self.lags] for z in zs]
         else:
-            zs = [npr.choice(self.nb_states, size=T - 1) for T in Ts]
+            zs = [npr.choice(self.nb_states, size=T - self.lags) for T in Ts]
 
         _cov = np.zeros((self.nb_states, self.dm_obs, self.dm_obs))
         for k in range(self.nb_states):
             ts = [np.where(z == k)[0] for z in zs]
-            xs = [np.hstack((_x[t, :], _u[t, :])) for t, _x, _u in zip(ts, x, u)]
-            ys = [_x[t + 1, :] for t, _x in zip(ts, x)]
+            xs = [np.hstack((lag_embed(_x[:-1, :], self.lags - 1)[t], _u[t + self.lags - 1, :]))
+                  for t, _x, _u in zip(ts, x, u)]
+            ys = [_x[t + self.lags, :] for t, _x in zip(ts, x)]
+
+            xs, ys = np.vstack(xs), np.vstack(ys)
+            _valid = ~np.any(np.isnan(xs), axis=1) & ~np.any(np.isnan(ys), axis=1)
 
-            coef_, intercept_, sigma = linear_regression(np.vstack(xs), np.vstack(ys),
+            coef_, intercept_, sigma = linear_regression(xs[_valid], ys[_valid],
                                                          weights=None, fit_intercept=True,
                                                          **self.prior)
-            self.A[k, ...] = coef_[:, :self.dm_obs]
-            self.B[k, ...] = coef_[:, self.dm_obs:]
+            self.A[k, ...] = coef_[:, :self.dm_obs * self.lags]
+            self.B[k, ...] = coef_[:, self.dm_obs * self.lags:]
             self.c[k, :] = intercept_
             _cov[k, ...] = sigma
 
         self.cov = _cov
 
     def permute(self, perm):
+        # a subset of the states drops the others
         self.A = self.A[perm, ...]
         self.B = self.B[perm, ...]
         self.c = self.c[perm, :]
         self._sqrt_cov = self._sqrt_cov[perm, ...]
+        self.nb_states = len(perm)
 
     def log_prior(self):
         lp = 0.
@@ -228,11 +407,82 @@ class AutoRegressiveGaussianObservation:
     def log_likelihood(self, x, u):
         loglik = []
         for _x, _u in zip(x, u):
-            _loglik = np.column_stack([lg_mvn(_x[1:, :], self.mean(k, _x[:-1, :], _u[:-1, :self.dm_act]), self.cov[k])
-                                       for k in range(self.nb_states)])
-            loglik.append(_loglik)
+            _xs = lag_embed(_x[:-1, :], self.lags - 1)
+            _us = _u[self.lags - 1:-1, :self.dm_act]
+            loglik.append(self.conditional_log_likelihood(_xs, _us, _x[self.lags:, :]))
         return loglik
 
+    # log-likelihoods of the last steps of N windows of
+    # lags + 1 observations and actions, N x K
+    def log_likelihood_step(self, x, u):
+        _xs = np.reshape(x[:, -self.lags - 1:-1, :], (len(x), -1))
+        return self.conditional_log_likelihood(_xs, u[:, -2, :self.dm_act], x[:, -1, :])
+
+    # log-likelihoods of targets y given the lagged observations
+    # xs and actions us of the same rows, T x K
+    def conditional_log_likelihood(self, xs, us, y):
+        if np.any(np.isnan(xs)) or np.any(np.isnan(us)) or np.any(np.isnan(y)):
+            return self.masked_log_likelihood(xs, us, y)
+
+        _sqrt_cov_inv, _half_log_det = self.factors
+
+        A, B, c = self.A, self.B, self.c
+        if self.cov_type == 'tied':
+            # whitened dynamics, the targets are whitened once for all states
+            _L_inv = _sqrt_cov_inv[0]
+            A, B, c = np.matmul(_L_inv, A), np.matmul(_L_inv, B), np.dot(c, _L_inv.T)
+
+        # means of all states at once from the lagged
+        # observations, K x T x D
+        _mu = np.matmul(xs, np.swapaxes(A, -1, -2))\
+              + np.matmul(us, np.swapaxes(B, -1, -2))\
+              + c[:, None, :]
+
+        if self.cov_type == 'diagonal':
+            _sqrt_var = np.diagonal(self._sqrt_cov, axis1=-2, axis2=-1)
+            _loglik = dg_mvn(y, _mu, _sqrt_var[:, None, :])
+        elif self.cov_type == 'tied':
+            _loglik = dg_mvn(np.dot(y, _L_inv.T), _mu, np.ones((self.dm_obs, ))) - _half_log_det[0]
+        else:
+            _loglik = fc_mvn(y, _mu, _sqrt_cov_inv, _half_log_det)
+        return _loglik.T
+
+    def masked_log_likelihood(self, xs, us, y):
+        # missing targets are marginalized, steps with missing
+        # inputs have no prediction and carry no information
+        _valid = ~np.any(np.isnan(xs), axis=1) & ~np.any(np.isnan(us), axis=1)
+        _mask = ~np.isnan(y) & _valid[:, None]
+
+        _mu = np.matmul(np.nan_to_num(xs), np.swapaxes(self.A, -1, -2))\
+              + np.matmul(np.nan_to_num(us), np.swapaxes(self.B, -1, -2))\
+              + self.c[:, None, :]
+
+        _loglik = mk_mvn(np.where(_mask, y, 0.), _mu, self._sqrt_cov,
+                         _mask, self.mask_factors)
+        return _loglik.T
+
+    def regression_data(self, x, u):
+        # inputs with intercept and next-step targets, steps
+        # with missing entries are zeroed and flagged invalid
+        def _data():
+            xs, ys, valid = [], [], []
+            for _x, _u in zip(x, u):
+                _xs = lag_embed(_x[:-1, :], self.lags - 1)
+                _xs = np.hstack((_xs, _u[self.lags - 1:-1, :self.dm_act], np.ones((_xs.shape[0], 1))))
+                _ys = _x[self.lags:, :]
+
+                _valid = ~np.any(np.isnan(_xs), axis=1) & ~np.any(np.isnan(_ys), axis=1)
+                if not np.all(_valid):
+                    _xs[~_valid] = 0.
+                    _ys = np.where(_valid[:, None], _ys, 0.)
+
+                xs.append(_xs)
+                ys.append(_ys)
+                valid.append(_valid)
+            return xs, ys, valid
+
+        return memoize(x, u, ('ar-observation', self.dm_act, self.lags), _data)
+
     def mstep(self, gamma, x, u, weights=None, use_prior=False):
         aux = []
         if weights:
@@ -240,22 +490,16 @@ class AutoRegressiveGaussianObservation:
                aux.append(_w[:, None] * _gamma)
             gamma = aux
 
-        xs, ys, ws = [], [], []
-        for _x, _u, _w in zip(x, u, gamma):
-            xs.append(np.hstack((_x[:-1, :], _u[:-1, :self.dm_act], np.ones((_x.shape[0] - 1, 1)))))
-            ys.append(_x[1:, :])
-            ws.append(_w[1:, :])
+        xs, ys, valid = self.regression_data(x, u)
+        ws = [_w[self.lags:, :] * _valid[:, None] for _w, _valid in zip(gamma, valid)]
 
-        _cov = np.zeros((self.nb_states, self.dm_obs, self.dm_obs))
-        for k in range(self.nb_states):
-            coef_, sigma = linear_regression(Xs=np.vstack(xs), ys=np.vstack(ys),
-                                             weights=np.vstack(ws)[:, k], fit_intercept=False,
-                                             **self.prior if use_prior else {})
+        # all states from one pass over the data
+        coef_, _cov = batch_linear_regression(Xs=xs, ys=ys, weights=ws, cov_type=self.cov_type,
+                                              **self.prior if use_prior else {})
 
-            self.A[k, ...] = coef_[:, :self.dm_obs]
-            self.B[k, ...] = coef_[:, self.dm_obs:self.dm_obs + self.dm_act]
-            self.c[k, ...] = coef_[:, -1]
-            _cov[k, ...] = sigma
+        self.A[...] = coef_[:, :, :self.dm_obs * self.lags]
+        self.B[...] = coef_[:, :, self.dm_obs * self.lags:-1]
+        self.c[...] = coef_[:, :, -1]
 
         # usage = sum([_gamma.sum(0) for _gamma in gamma])
         # unused = np.where(usage < 1)[0]
@@ -268,13 +512,19 @@ class AutoRegressiveGaussianObservation:
         #         self.c[k] = self.c[i] + 0.01 * npr.randn(*self.c[i].shape)
         #         _cov[k] = _cov[i]
 
+        if self.cov_type == 'diagonal':
+            _cov = _cov[..., None] * np.eye(self.dm_obs)
+        elif self.cov_type == 'tied':
+            _cov = np.repeat(_cov[None, ...], self.nb_states, axis=0)
+
         self.cov = _cov
 
     def smooth(self, gamma, x, u):
         mean = []
         for _x, _u, _gamma in zip(x, u, gamma):
-            _mu = np.zeros((len(_x) - 1, self.nb_states, self.dm_obs))
+            _xs = lag_embed(_x[:-1, :], self.lags - 1)
+            _mu = np.zeros((len(_xs), self.nb_states, self.dm_obs))
             for k in range(self.nb_states):
-                _mu[:, k, :] = self.mean(k, _x[:-1, :], _u[:-1, :self.dm_act])
-            mean.append(np.einsum('nk,nkl->nl', _gamma[1:, ...], _mu))
+                _mu[:, k, :] = self.mean(k, _xs, _u[self.lags - 1:-1, :self.dm_act])
+            mean.append(np.einsum('nk,nkl->nl', _gamma[self.lags:, ...], _mu))
         return mean
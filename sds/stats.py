@@ -65,6 +65,60 @@ def _multivariate_normal_logpdf(data, mus, Sigmas, Ls=None):
     return lp
 
 
+def factored_multivariate_normal_logpdf(data, mus, Ls_inv, half_log_det):
+    """
+    Compute the log probability density of multivariate Gaussian distributions
+    from precomputed inverse Cholesky factors, without any factorization.
+    Parameters
+    ----------
+    data : array_like (..., N, D)
+        The points at which to evaluate the log density
+    mus : array_like (..., N, D)
+        The mean(s) of the Gaussian distribution(s)
+    Ls_inv : array_like (..., D, D)
+        Inverse(s) of the lower Cholesky factor(s) of the covariance(s)
+    half_log_det : array_like (...,)
+        Half log-determinant(s) of the covariance(s)
+    Returns
+    -------
+    lps : array_like (..., N)
+        Log probabilities under the multivariate Gaussian distribution(s).
+    """
+    D = data.shape[-1]
+
+    # whitened residuals, one batched matmul per distribution
+    z = np.matmul(data - mus, np.swapaxes(Ls_inv, -1, -2))         # (..., N, D)
+
+    lp = -0.5 * np.sum(z**2, axis=-1)                                # (..., N)
+    return lp - 0.5 * D * np.log(2 * np.pi) - half_log_det[..., None]
+
+
+def diagonal_multivariate_normal_logpdf(data, mus, sqrt_vars):
+    """
+    Compute the log probability density of multivariate Gaussian
+    distributions with diagonal covariances, elementwise in O(D).
+    Parameters
+    ----------
+    data : array_like (..., D)
+        The points at which to evaluate the log density
+    mus : array_like (..., D)
+        The mean(s) of the Gaussian distribution(s)
+    sqrt_vars : array_like (..., D)
+        Standard deviations along the diagonal of the covariance(s)
+    Returns
+    -------
+    lps : array_like (...,)
+        Log probabilities under the multivariate Gaussian distribution(s).
+    """
+    D = data.shape[-1]
+
+    z = (data - mus) / sqrt_vars                                     # (..., D)
+    half_log_det = np.sum(np.log(np.abs(sqrt_vars)), axis=-1)       # (...,)
+
+    lp = -0.5 * np.sum(z**2, axis=-1)                                # (...,)
+    return lp - 0.5 * D * np.log(2 * np.pi) - half_log_det
+
+
 def multivariate_normal_logpdf(data, mus, Sigmas, mask=None):
     """
     Compute the log probability density of a multivariate Gaussian distribution.
@@ -151,3 +205,141 @@ def multivariate_normal_logpdf(data, mus, Sigmas, mask=None):
     # Reshape the output
     assert np.all(np.isfinite(lls))
     return np.reshape(lls, shp)
+
+
+def marginal_factors(Ls, mask):
+    """
+    Inverse Cholesky factors and half log-determinants of the marginal
+    covariances over the observed entries of a mask, for all states.
+    Parameters
+    ----------
+    Ls : array_like (K, D, D)
+        Lower Cholesky factors of the full covariances
+    mask : array_like (D,) bool
+        Entries that are observed
+    Returns
+    -------
+    Ls_inv : array_like (K, d, d)
+        Inverse lower Cholesky factors of the marginal covariances
+    half_log_det : array_like (K,)
+        Half log-determinants of the marginal covariances
+    """
+    # the marginal covariance only needs the observed rows of the factor
+    _Ls = Ls[:, mask, :]
+    _Ls = np.linalg.cholesky(np.matmul(_Ls, np.swapaxes(_Ls, -1, -2)))
+
+    Ls_inv = np.linalg.solve(_Ls, np.broadcast_to(np.eye(_Ls.shape[-1]), _Ls.shape))
+    half_log_det = np.sum(np.log(np.abs(np.diagonal(_Ls, axis1=-2, axis2=-1))), axis=-1)
+    return Ls_inv, half_log_det
+
+
+def masked_multivariate_normal_logpdf(data, mus, Ls, mask, factors=None):
+    """
+    Compute the log probability density of partially observed data under
+    multivariate Gaussian distributions, marginalizing the missing entries.
+    Rows are grouped by mask and each group is evaluated for all states
+    in one batched product, without expanding covariances to full shape.
+    Parameters
+    ----------
+    data : array_like (N, D)
+        The points at which to evaluate the log density, the missing
+        entries must be finite but are otherwise ignored
+    mus : array_like (K, D) or (K, N, D)
+        The mean(s) of the Gaussian distribution(s)
+    Ls : array_like (K, D, D)
+        Lower Cholesky factors of the covariances
+    mask : array_like (N, D) bool
+        Entries in the data that are observed
+    factors : dict, optional
+        Marginal factors by mask, filled on demand and reused as long
+        as the caller passes the same dict for unchanged covariances
+    Returns
+    -------
+    lps : array_like (K, N)
+        Log probabilities under the multivariate Gaussian distribution(s).
+    """
+    N, D = data.shape
+    K = Ls.shape[0]
+
+    factors = {} if factors is None else factors
+
+    lps = np.zeros((K, N))
+
+    unique_masks, mask_index = np.unique(mask, return_inverse=True, axis=0)
+    mask_index = np.ravel(mask_index)
+    for i, this_mask in enumerate(unique_masks):
+        # rows without any observed entry do not contribute
+        if not np.any(this_mask):
+            continue
+
+        key = this_mask.tobytes()
+        if key not in factors:
+            factors[key] = marginal_factors(Ls, this_mask)
+        Ls_inv, half_log_det = factors[key]
+
+        this_inds = np.where(mask_index == i)[0]
+        this_data = data[np.ix_(this_inds, this_mask)]                      # (n, d)
+        if mus.ndim == 2:
+            this_mus = mus[:, None, this_mask]                              # (K, 1, d)
+        else:
+            this_mus = mus[:, this_inds][..., this_mask]                    # (K, n, d)
+
+        lps[:, this_inds] = factored_multivariate_normal_logpdf(this_data, this_mus,
+                                                                Ls_inv, half_log_det)
+    return lps
+
+
+def conditional_expectations(data, mus, Sigmas):
+    """
+    Expectations of the missing (nan) entries of data under multivariate
+    Gaussian distributions given the observed entries of each row, with
+    the conditional covariances that come with them per mask group.
+    Parameters
+    ----------
+    data : array_like (N, D)
+        Partially observed points, missing entries are nan
+    mus : array_like (K, D)
+        The mean(s) of the Gaussian distribution(s)
+    Sigmas : array_like (K, D, D)
+        The covariances(s) of the Gaussian distribution(s)
+    Returns
+    -------
+    xhat : array_like (N, K, D)
+        The data completed under each distribution
+    ccov : list of (array_like (n,), array_like (K, D, D))
+        Row indices of every partially observed mask group and the
+        conditional covariances of its rows, zero on observed entries
+    """
+    N, D = data.shape
+    K = mus.shape[0]
+
+    mask = ~np.isnan(data)
+    xhat = np.repeat(np.where(mask, data, 0.)[:, None, :], K, axis=1)
+
+    ccov = []
+    unique_masks, mask_index = np.unique(mask, return_inverse=True, axis=0)
+    mask_index = np.ravel(mask_index)
+    for i, this_mask in enumerate(unique_masks):
+        if np.all(this_mask):
+            continue
+
+        obs, hid = np.where(this_mask)[0], np.where(~this_mask)[0]
+        this_inds = np.where(mask_index == i)[0]
+
+        S_oo = Sigmas[np.ix_(np.arange(K), obs, obs)]
+        S_oh = Sigmas[np.ix_(np.arange(K), obs, hid)]
+        S_hh = Sigmas[np.ix_(np.arange(K), hid, hid)]
+
+        # regression of the hidden on the observed entries
+        R = np.swapaxes(np.linalg.solve(S_oo, S_oh), -1, -2) if len(obs) > 0\
+            else np.zeros((K, len(hid), 0))                                 # (K, dh, do)
+
+        resid = data[np.ix_(this_inds, obs)][None, :, :] - mus[:, None, obs]  # (K, n, do)
+        this_mus = mus[:, None, hid] + np.matmul(resid, np.swapaxes(R, -1, -2))
+        xhat[np.ix_(this_inds, np.arange(K), hid)] = np.swapaxes(this_mus, 0, 1)
+
+        C = np.zeros((K, D, D))
+        C[np.ix_(np.arange(K), hid, hid)] = S_hh - np.matmul(R, S_oh)
+        ccov.append((this_inds, C))
+
+    return xhat, ccov
@@ -6,20 +6,23 @@ from scipy.stats import dirichlet
 
 import scipy as sc
 from scipy import special
+from scipy import sparse
 
 import torch
 import torch.nn as nn
 import torch.distributions as dist
 
-from torch.optim import Adam
+from torch.optim import Adam, LBFGS
 from torch.utils.data import BatchSampler, SubsetRandomSampler
 
-from sklearn.preprocessing import PolynomialFeatures
+from itertools import combinations_with_replacement
 
 from sds.utils import ensure_args_are_viable_lists
 from sds.utils import ensure_args_torch_floats
 from sds.utils import ensure_res_numpy_floats
 from sds.utils import to_float, np_float
+from sds.utils import params_version
+from sds.utils import memoize
 
 
 class StationaryTransition:
@@ -42,6 +45,10 @@ class StationaryTransition:
     def params(self, value):
         self.logmat = value[0]
 
+    @property
+    def version(self):
+        return params_version(self.params)
+
     @property
     def matrix(self):
         return np.exp(self.logmat - logsumexp(self.logmat, axis=-1, keepdims=True))
@@ -49,28 +56,43 @@ class StationaryTransition:
     def initialize(self, x, u):
         pass
 
+    # next-state probabilities of a single step
+    def probs(self, z, x=None, u=None):
+        return self.matrix[z, :]
+
     # sample transiton
     def sample(self, z, x=None, u=None):
-        return npr.choice(self.nb_states, p=self.matrix[z, :])
+        return npr.choice(self.nb_states, p=self.probs(z))
 
     # most likely transition
     def likeliest(self, z, x=None, u=None):
-        return np.argmax(self.matrix[z, :])
+        return np.argmax(self.probs(z))
+
+    # cumulative transition probabilities for inverse-cdf sampling
+    def cdf(self, x=None, u=None):
+        return np.cumsum(self.matrix, axis=-1)
 
     def permute(self, perm):
+        # a subset of the states drops the others,
+        # rows are normalized on evaluation
         self.logmat = self.logmat[np.ix_(perm, perm)]
+        self.nb_states = len(perm)
 
     def log_prior(self):
         lp = 0.
         return lp
 
     @ensure_args_are_viable_lists
-    def log_transition(self, x, u):
+    def log_transition(self, x, u, factored=False):
+        # time-invariant already, no factored form needed
+        _logmat = self.logmat - logsumexp(self.logmat, axis=-1, keepdims=True)
+
         logtrans = []
         for _x, _u in zip(x, u):
             T = np.maximum(len(_x) - 1, 1)
-            _logtrans = np.tile(self.logmat[None, :, :], (T, 1, 1))
-            logtrans.append(_logtrans - logsumexp(_logtrans, axis=-1, keepdims=True))
+            # time-invariant, read-only view without copies
+            _logtrans = np.broadcast_to(_logmat[None, :, :], (T, self.nb_states, self.nb_states))
+            logtrans.append(_logtrans)
         return logtrans
 
     def mstep(self, gamma, x, u, weights=None, reg=1e-16):
@@ -103,6 +125,233 @@ class StickyTransition(StationaryTransition):
         self.logmat = np.log(_mat)
 
 
+# stationary transitions as a product lhs @ rhs of two nonnegative
+# csr factors, K x R and R x K, shared by the nb_steps transitions of
+# one sequence. The factored kernels run forward-backward through the
+# R intermediate states, other code paths expand the dense matrix.
+class SparseFactors:
+
+    def __init__(self, lhs, rhs, nb_steps):
+        self.lhs = lhs
+        self.rhs = rhs
+        self.nb_steps = nb_steps
+
+    def __len__(self):
+        return self.nb_steps
+
+    @property
+    def arrays(self):
+        # row pointers, column indices and values of both factors
+        _arrays = []
+        for _factor in (self.lhs, self.rhs):
+            _arrays += [_factor.indptr.astype(np.intp), _factor.indices.astype(np.intp),
+                        np.ascontiguousarray(_factor.data, dtype=np.float64)]
+        return tuple(_arrays)
+
+    def dense(self):
+        with np.errstate(divide='ignore'):
+            _logmat = np.log((self.lhs @ self.rhs).toarray())
+        return np.broadcast_to(_logmat[None, :, :], (self.nb_steps, ) + _logmat.shape)
+
+
+class SparseTransition(StationaryTransition):
+    # stationary transitions restricted to a fixed boolean K x K
+    # support, given dense or sparse. Only the log-probabilities of
+    # the nonzeros are stored, in the csr order of the support, and
+    # forward-backward cost grows with their number
+    def __init__(self, nb_states, prior, support=None, **kwargs):
+        self.nb_states = nb_states
+        self.prior = prior
+
+        if support is None:
+            support = np.ones((self.nb_states, self.nb_states), dtype=bool)
+        self.support = sparse.csr_matrix(support, dtype=bool)
+        self.support.sort_indices()
+        assert np.all(np.diff(self.support.indptr) > 0)
+
+        # uniform over the successors of every state
+        self.logvals = - np.log(np.diff(self.support.indptr))[self.rows]
+
+    @property
+    def params(self):
+        return tuple([self.logvals])
+
+    @params.setter
+    def params(self, value):
+        self.logvals = value[0]
+
+    @property
+    def version(self):
+        return params_version([self.logvals, self.support.indptr, self.support.indices])
+
+    # row of every nonzero of the support
+    @property
+    def rows(self):
+        return np.repeat(np.arange(self.nb_states), np.diff(self.support.indptr))
+
+    # dense views for the code paths without a sparse variant
+    @property
+    def logmat(self):
+        _logmat = np.full((self.nb_states, self.nb_states), -np.inf)
+        _logmat[self.rows, self.support.indices] = self.logvals
+        return _logmat
+
+    @logmat.setter
+    def logmat(self, value):
+        # entries off the support are ignored
+        self.logvals = self.normalize(np.asarray(value)[self.rows, self.support.indices])
+
+    def normalize(self, logvals):
+        _max = np.maximum.reduceat(logvals, self.support.indptr[:-1])
+        _norm = _max + np.log(np.add.reduceat(np.exp(logvals - _max[self.rows]),
+                                              self.support.indptr[:-1]))
+        return logvals - _norm[self.rows]
+
+    @property
+    def factors(self):
+        _rhs = sparse.csr_matrix((np.exp(self.logvals), self.support.indices, self.support.indptr),
+                                 shape=self.support.shape)
+        return sparse.identity(self.nb_states, format='csr'), _rhs
+
+    def probs(self, z, x=None, u=None):
+        _ptr = self.support.indptr
+        _probs = np.zeros((self.nb_states, ))
+        _probs[self.support.indices[_ptr[z]:_ptr[z + 1]]] = np.exp(self.logvals[_ptr[z]:_ptr[z + 1]])
+        return _probs
+
+    def permute(self, perm):
+        # position of every nonzero, shifted by one to survive as csr data
+        _pos = sparse.csr_matrix((np.arange(1., self.support.nnz + 1.), self.support.indices,
+                                  self.support.indptr), shape=self.support.shape)
+        _pos = _pos[perm, :][:, perm].tocoo()
+
+        _rows, _cols = _pos.row, _pos.col
+        _logvals = self.logvals[_pos.data.astype(np.intp) - 1]
+
+        # states left without successors stay put
+        _empty = np.setdiff1d(np.arange(len(perm)), _rows)
+        _rows = np.hstack((_rows, _empty))
+        _cols = np.hstack((_cols, _empty))
+        _logvals = np.hstack((_logvals, np.zeros(len(_empty))))
+
+        _order = np.lexsort((_cols, _rows))
+        self.nb_states = len(perm)
+        self.support = sparse.csr_matrix((np.ones(len(_order), dtype=bool),
+                                          (_rows[_order], _cols[_order])),
+                                         shape=(self.nb_states, self.nb_states))
+        self.logvals = self.normalize(_logvals[_order])
+
+    @ensure_args_are_viable_lists
+    def log_transition(self, x, u, factored=False):
+        if not factored:
+            return super(SparseTransition, self).log_transition(x, u)
+
+        lhs, rhs = self.factors
+        return [SparseFactors(lhs, rhs, np.maximum(len(_x) - 1, 1)) for _x in x]
+
+    def mstep(self, zeta, x, u, weights=None, reg=1e-16):
+        # counts of the support entries only, factored statistics
+        # carry them as the csr counts of rhs
+        _rows, _cols = self.rows, self.support.indices
+        counts = np.zeros((self.support.nnz, ))
+        for _zeta in zeta:
+            if isinstance(_zeta, tuple):
+                counts += np.asarray(_zeta[1][_rows, _cols]).ravel()
+            else:
+                counts += np.sum(_zeta, axis=0)[_rows, _cols]
+
+        counts += reg
+        self.logvals = np.log(counts / np.add.reduceat(counts, self.support.indptr[:-1])[_rows])
+
+
+class BandedTransition(SparseTransition):
+    # transitions to states at most bandwidth indices away,
+    # left-to-right models only move forward
+    def __init__(self, nb_states, prior, bandwidth=1, left_to_right=False, **kwargs):
+        self.bandwidth = bandwidth
+        self.left_to_right = left_to_right
+
+        _lower = 0 if self.left_to_right else - min(self.bandwidth, nb_states - 1)
+        _offsets = list(range(_lower, min(self.bandwidth, nb_states - 1) + 1))
+        support = sparse.diags([np.ones(nb_states - abs(d), dtype=bool) for d in _offsets],
+                               _offsets, shape=(nb_states, nb_states), format='csr', dtype=bool)
+
+        super(BandedTransition, self).__init__(nb_states, prior=prior, support=support)
+
+
+class LowRankTransition(StationaryTransition):
+    # transitions through rank intermediate states, P = U @ V with
+    # row-stochastic U, K x rank, and V, rank x K
+    def __init__(self, nb_states, prior, rank=1, **kwargs):
+        self.nb_states = nb_states
+        self.prior = prior
+        self.rank = rank
+
+        # uniform factors are a fixed point of em, start at random
+        self.logu = np.log(npr.dirichlet(np.ones(self.rank), size=self.nb_states))
+        self.logv = np.log(npr.dirichlet(np.ones(self.nb_states), size=self.rank))
+
+    @property
+    def params(self):
+        return tuple([self.logu, self.logv])
+
+    @params.setter
+    def params(self, value):
+        self.logu = value[0]
+        self.logv = value[1]
+
+    @property
+    def logmat(self):
+        with np.errstate(divide='ignore'):
+            return np.log(self.matrix)
+
+    @property
+    def matrix(self):
+        return np.exp(self.logu) @ np.exp(self.logv)
+
+    @property
+    def factors(self):
+        return sparse.csr_matrix(np.exp(self.logu)), sparse.csr_matrix(np.exp(self.logv))
+
+    def probs(self, z, x=None, u=None):
+        return np.exp(self.logu[z, :]) @ np.exp(self.logv)
+
+    def permute(self, perm):
+        self.logu = self.logu[perm, :]
+        self.logv = self.logv[:, perm]
+        self.nb_states = len(perm)
+
+        # a subset of the states leaves v unnormalized
+        self.logv = self.logv - logsumexp(self.logv, axis=-1, keepdims=True)
+
+    @ensure_args_are_viable_lists
+    def log_transition(self, x, u, factored=False):
+        if not factored:
+            return super(LowRankTransition, self).log_transition(x, u)
+
+        lhs, rhs = self.factors
+        return [SparseFactors(lhs, rhs, np.maximum(len(_x) - 1, 1)) for _x in x]
+
+    def mstep(self, zeta, x, u, weights=None, reg=1e-16):
+        _u, _v = np.exp(self.logu), np.exp(self.logv)
+
+        ucounts, vcounts = np.zeros_like(_u), np.zeros_like(_v)
+        for _zeta in zeta:
+            if isinstance(_zeta, tuple):
+                ucounts += _zeta[0].toarray()
+                vcounts += _zeta[1].toarray()
+            else:
+                # split dense counts over the intermediate states
+                _resp = np.sum(_zeta, axis=0) / np.maximum(_u @ _v, 1e-300)
+                ucounts += _u * (_resp @ _v.T)
+                vcounts += _v * (_u.T @ _resp)
+
+        ucounts += reg
+        vcounts += reg
+        self.logu = np.log(ucounts / np.sum(ucounts, axis=-1, keepdims=True))
+        self.logv = np.log(vcounts / np.sum(vcounts, axis=-1, keepdims=True))
+
+
 class PolyRecurrentTransition:
     def __init__(self, nb_states, dm_obs, dm_act, prior,
                  norm=None, degree=1, device='cpu'):
@@ -137,6 +386,7 @@ class PolyRecurrentTransition:
     @ensure_args_torch_floats
     def logmat(self, value):
         self.regressor.logmat.data = value
+        self.regressor.np_params = None
 
     @property
     @ensure_res_numpy_floats
@@ -147,6 +397,7 @@ class PolyRecurrentTransition:
     @ensure_args_torch_floats
     def coef(self, value):
         self.regressor.coef.data = value
+        self.regressor.np_params = None
 
     @property
     def params(self):
@@ -157,50 +408,132 @@ class PolyRecurrentTransition:
         self.logmat = value[0]
         self.coef = value[1]
 
+    @property
+    def version(self):
+        return params_version(list(self.regressor.parameters()))
+
+    @property
+    def features_key(self):
+        return ('poly', self.dm_act, self.degree,
+                self.norm['mean'].tobytes(), self.norm['std'].tobytes())
+
     def initialize(self, x, u, **kwargs):
         pass
 
+    # numpy copies of the regressor weights for single-step evaluation,
+    # dropped by the regressor whenever it changes its parameters
+    @property
+    def np_params(self):
+        if self.regressor.np_params is None:
+            _params = dict(logmat=np_float(self.regressor.logmat),
+                           coef=np_float(self.regressor.coef),
+                           mean=np.ravel(self.norm['mean']), std=np.ravel(self.norm['std']),
+                           index=[_idx.cpu().numpy() for _idx in self.regressor._index])
+            self.regressor.np_params = _params
+        return self.regressor.np_params
+
+    # input terms of the logits of N single steps, N x K
+    def np_output(self, x, u):
+        _params = self.np_params
+
+        xu = np.hstack((np.atleast_2d(x), np.atleast_2d(u)[:, :self.dm_act]))
+        xu = (xu - _params['mean']) / _params['std']
+        feat = np.hstack([np.prod(xu[:, _idx], axis=-1) for _idx in _params['index']])
+        return np.dot(feat, _params['coef'].T)
+
+    # next-state probabilities of a single step, bypasses torch
+    def probs(self, z, x, u):
+        _logits = self.np_params['logmat'][z, :] + self.np_output(np.ravel(x), np.ravel(u))[0]
+        _probs = np.exp(_logits - np.max(_logits))
+        return _probs / np.sum(_probs)
+
+    # normalized log-transitions of N single steps, N x K x K
+    def log_transition_step(self, x, u):
+        _logtrans = self.np_params['logmat'][None, :, :] + self.np_output(x, u)[:, None, :]
+        return _logtrans - logsumexp(_logtrans, axis=-1, keepdims=True)
+
     def sample(self, z, x, u):
-        mat = np.squeeze(np.exp(self.log_transition(x, u)[0]))
-        return npr.choice(self.nb_states, p=mat[z, :])
+        return npr.choice(self.nb_states, p=self.probs(z, x, u))
 
     def likeliest(self, z, x, u):
-        mat = np.squeeze(np.exp(self.log_transition(x, u)[0]))
-        return np.argmax(mat[z, :])
+        return np.argmax(self.probs(z, x, u))
+
+    # cumulative transition probabilities of N inputs at once, N x K x K
+    @torch.no_grad()
+    def cdf(self, x, u):
+        self.regressor.eval()
+        _in = np.hstack((np.atleast_2d(x), np.atleast_2d(u)[:, :self.dm_act]))
+        return np.cumsum(np.exp(np_float(self.regressor.forward(_in))), axis=-1)
 
     def permute(self, perm):
-        self.logmat = self.logmat[np.ix_(perm, perm)]
-        self.coef = self.coef[perm, :]
+        self.regressor.permute(perm)
+        self.nb_states = len(perm)
 
     @ensure_res_numpy_floats
     def log_prior(self):
         self.regressor.eval()
         return self.regressor.log_prior()
 
+    def features(self, x, u):
+        # regressor features of each sequence, plus the stacked
+        # features of all transitions for the m-step
+        def _features():
+            feat = []
+            with torch.no_grad():
+                for _x, _u in zip(x, u):
+                    T = np.maximum(len(_x) - 1, 1)
+                    _in = np.hstack((_x[:T, :], _u[:T, :self.dm_act]))
+                    feat.append(self.regressor.featurize(to_float(_in, self.device)))
+            stacked = torch.cat([_feat[:len(_x) - 1] for _feat, _x in zip(feat, x)])
+            return feat, stacked
+
+        return memoize(x, u, ('transition', ) + self.features_key, _features)
+
+    @torch.no_grad()
     @ensure_args_are_viable_lists
-    def log_transition(self, x, u):
+    def log_transition(self, x, u, factored=False):
         self.regressor.eval()
 
+        feat, _ = self.features(x, u)
+
         logtrans = []
-        for _x, _u in zip(x, u):
-            T = np.maximum(len(_x) - 1, 1)
-            _in = np.hstack((_x[:T, :], _u[:T, :self.dm_act]))
-            _logtrans = np_float(self.regressor.forward(_in))
-            logtrans.append(_logtrans - logsumexp(_logtrans, axis=-1, keepdims=True))
+        if factored:
+            # K x K matrix plus T x K input term, normalized by the kernels
+            _logmat = np_float(self.regressor.logmat)
+            for _feat in feat:
+                _output = np_float(self.regressor.output(_feat))
+                logtrans.append((_logmat, _output))
+            return logtrans
+
+        # already normalized by the regressor
+        for _feat in feat:
+            logtrans.append(np_float(self.regressor.logtrans(_feat)))
         return logtrans
 
     def mstep(self, zeta, x, u, weights=None, **kwargs):
-        xu = []
-        for _x, _u in zip(x, u):
-            xu.append(np.hstack((_x[:-1, :], _u[:-1, :self.dm_act])))
+        _, feat = self.features(x, u)
+
+        # summed K x K counts and per-step from/to-state
+        # marginals, all the transition elbo depends on
+        if isinstance(zeta[0], tuple):
+            # already reduced by the e-step
+            if weights is not None:
+                raise ValueError("weighted m-step needs the full joint posterior")
+            counts = sum([_zeta[0] for _zeta in zeta])
+            frm = np.vstack([_zeta[1] for _zeta in zeta])
+            to = np.vstack([_zeta[2] for _zeta in zeta])
+        else:
+            aux = []
+            if weights is not None:
+                for _w, _zeta in zip(weights, zeta):
+                   aux.append(_w[1:, None, None] * _zeta)
+                zeta = aux
 
-        aux = []
-        if weights is not None:
-            for _w, _zeta in zip(weights, zeta):
-               aux.append(_w[1:, None, None] * _zeta)
-            zeta = aux
+            counts = sum([np.sum(_zeta, axis=0) for _zeta in zeta])
+            frm = np.vstack([np.sum(_zeta, axis=2) for _zeta in zeta])
+            to = np.vstack([np.sum(_zeta, axis=1) for _zeta in zeta])
 
-        self.regressor.fit(np.vstack(zeta), np.vstack(xu), **kwargs)
+        self.regressor.fit(counts, frm, to, feat, **kwargs)
 
 
 class PolyRecurrentRegressor(nn.Module):
@@ -221,7 +554,13 @@ class PolyRecurrentRegressor(nn.Module):
         self.degree = degree
 
         self.nb_feat = int(sc.special.comb(self.degree + (self.dm_obs + self.dm_act), self.degree)) - 1
-        self.basis = PolynomialFeatures(self.degree, include_bias=False)
+
+        # monomial index table, one (nb_terms x d) block per degree d,
+        # ordered as sklearn's PolynomialFeatures(include_bias=False)
+        _dim = self.dm_obs + self.dm_act
+        self._index = [torch.as_tensor(list(combinations_with_replacement(range(_dim), d)),
+                                       dtype=torch.long, device=self.device)
+                       for d in range(1, self.degree + 1)]
 
         _stdv = torch.sqrt(torch.as_tensor(1. / (self.dm_obs + self.dm_act + self.nb_states)))
         self.coef = nn.Parameter(_stdv * torch.randn(self.nb_states, self.nb_feat), requires_grad=True).to(self.device)
@@ -243,6 +582,7 @@ class PolyRecurrentRegressor(nn.Module):
                 self._dirichlet = _dirichlet = dist.dirichlet.Dirichlet(self._concentration.to(self.device))
 
         self.optim = None
+        self.np_params = None
 
     @torch.no_grad()
     def reset(self):
@@ -253,6 +593,25 @@ class PolyRecurrentRegressor(nn.Module):
         _mat /= torch.sum(_mat, dim=-1, keepdim=True)
         self.logmat.data = torch.log(_mat).to(self.device)
 
+        self.optim = None
+        self.np_params = None
+
+    @torch.no_grad()
+    def permute(self, perm):
+        # reorders the states, a subset drops the others
+        _perm = torch.as_tensor(perm, dtype=torch.long, device=self.device)
+        self.logmat.data = self.logmat.data[_perm][:, _perm]
+        self.coef.data = self.coef.data[_perm]
+        self.nb_states = len(perm)
+
+        if hasattr(self, '_dirichlet'):
+            self._concentration = self._concentration[_perm][:, _perm]
+            self._dirichlet = dist.dirichlet.Dirichlet(self._concentration.to(self.device))
+
+        # adam moments refer to the old states
+        self.optim = None
+        self.np_params = None
+
     def log_prior(self):
         lp = torch.as_tensor(0., device=self.device)
         if self.prior:
@@ -261,39 +620,109 @@ class PolyRecurrentRegressor(nn.Module):
                 lp += self._dirichlet.log_prob(_matrix.to(self.device)).sum()
         return lp
 
-    def propagate(self, xu):
+    def featurize(self, xu):
         norm_xu = (xu - self._mean) / self._std
-        _feat = to_float(self.basis.fit_transform(np_float(norm_xu))).to(self.device)
-        return torch.mm(_feat, torch.transpose(self.coef, 0, 1))
+        return torch.cat([torch.prod(norm_xu[:, idx], dim=-1) for idx in self._index], dim=-1)
 
-    @ensure_args_torch_floats
-    def forward(self, xu):
-        output = self.propagate(xu)
+    def output(self, feat):
+        return torch.mm(feat, torch.transpose(self.coef, 0, 1))
+
+    def propagate(self, xu):
+        return self.output(self.featurize(xu))
+
+    def logtrans(self, feat):
+        output = self.output(feat)
         _logtrans = self.logmat[None, :, :] + output[:, None, :]
         return _logtrans - torch.logsumexp(_logtrans, dim=-1, keepdim=True)
 
-    def elbo(self, zeta, xu, batch_size, set_size):
-        logtrans = self.forward(xu)
-        return torch.sum(zeta * logtrans) * set_size / batch_size + self.log_prior()
+    @ensure_args_torch_floats
+    def forward(self, xu):
+        return self.logtrans(self.featurize(xu))
+
+    # zeta enters only through its summed counts and marginals,
+    # sum(zeta * logtrans) = <counts, logmat> + <to, output> - <frm, norm>
+    def elbo(self, counts, frm, to, feat, batch_size, set_size):
+        output = self.output(feat)
+        norm = torch.logsumexp(self.logmat[None, :, :] + output[:, None, :], dim=-1)
+        return torch.sum(counts * self.logmat)\
+               + (torch.sum(to * output) - torch.sum(frm * norm)) * set_size / batch_size\
+               + self.log_prior()
+
+    # full-batch quasi-newton m-step, the elbo is concave in
+    # coef and logmat so a few iterations reach the optimum.
+    # the line search sets the step, lr has no effect here
+    def _fit_lbfgs(self, counts, frm, to, feat, nb_iter, tol):
+        self.np_params = None
+
+        set_size = feat.shape[0]
+        l2_penalty = self.prior['l2_penalty'] if self.prior and 'l2_penalty' in self.prior else 0.
+
+        optim = LBFGS(self.parameters(), lr=1., max_iter=nb_iter,
+                      tolerance_change=tol, history_size=10,
+                      line_search_fn='strong_wolfe')
+
+        def closure():
+            optim.zero_grad()
+            loss = - self.elbo(counts, frm, to, feat, set_size, set_size)
+            if l2_penalty > 0.:
+                loss += 0.5 * l2_penalty * sum(torch.sum(_param**2) for _param in self.parameters())
+            # per-transition scale, tolerances are relative to data size
+            loss = loss / set_size
+            loss.backward()
+            return loss
+
+        optim.step(closure)
+
+        # the adam moments belong to the parameters before this step
+        self.optim = None
 
     @ensure_args_torch_floats
-    def fit(self, zeta, xu, nb_iter=100, batch_size=None, lr=1e-3):
-        if self.prior and 'l2_penalty' in self.prior:
-            self.optim = Adam(self.parameters(), lr=lr, weight_decay=self.prior['l2_penalty'])
+    def fit(self, counts, frm, to, feat, nb_iter=100, batch_size=None,
+            lr=1e-3, tol=None, method='adam'):
+        self.np_params = None
+
+        if method == 'lbfgs':
+            if batch_size is not None:
+                raise ValueError("l-bfgs m-step runs on the full batch only")
+            return self._fit_lbfgs(counts, frm, to, feat, nb_iter, 0. if tol is None else tol)
+
+        # optimizer state is kept across em iterations,
+        # rebuilt only on first use or a change of step size
+        if self.optim is None or self.optim.defaults['lr'] != lr:
+            if self.prior and 'l2_penalty' in self.prior:
+                self.optim = Adam(self.parameters(), lr=lr, weight_decay=self.prior['l2_penalty'])
+            else:
+                self.optim = Adam(self.parameters(), lr=lr)
+
+        set_size = feat.shape[0]
+        batch_size = set_size if batch_size is None else min(batch_size, set_size)
+
+        # reshuffled every epoch, last partial batch included
+        if batch_size < set_size:
+            batches = BatchSampler(SubsetRandomSampler(range(set_size)), batch_size, False)
         else:
-            self.optim = Adam(self.parameters(), lr=lr)
-
-        set_size = xu.shape[0]
-        batch_size = set_size if batch_size is None else batch_size
-        batches = list(BatchSampler(SubsetRandomSampler(range(set_size)), batch_size, True))
+            batches = [slice(None)]
 
+        last = None
         for n in range(nb_iter):
+            elbo = 0.
             for batch in batches:
+                _frm, _to, _feat = frm[batch], to[batch], feat[batch]
+
                 self.optim.zero_grad()
-                loss = - self.elbo(zeta[batch], xu[batch], batch_size, set_size)
+                _elbo = self.elbo(counts, _frm, _to, _feat, _feat.shape[0], set_size)
+                loss = - _elbo
                 loss.backward()
                 self.optim.step()
 
+                elbo += _elbo.item() * _feat.shape[0] / set_size
+
+            # relative change of the epoch-averaged elbo
+            if tol is not None and last is not None:
+                if abs(elbo - last) <= tol * abs(last):
+                    break
+            last = elbo
+
             # if n % 100 == 0:
             #     print('Epoch: {}/{}.............'.format(n, nb_iter), end=' ')
             #     print("Loss: {:.4f}".format(loss))
@@ -336,28 +765,33 @@ class NeuralRecurrentTransition:
     @ensure_args_torch_floats
     def logmat(self, value):
         self.regressor.logmat.data = value
+        self.regressor.np_params = None
 
+    # weights of every linear layer, biases of those that have one
     @property
     @ensure_res_numpy_floats
     def weights(self):
-        return [self.regressor.layer.weight.data, self.regressor.output.weight.data]
+        return [_layer.weight.data for _layer in self.regressor.linear]
 
     @weights.setter
     @ensure_args_torch_floats
     def weights(self, value):
-        self.regressor.layer.weight.data = value[0]
-        self.regressor.output.weight.data = value[1]
+        for _layer, _w in zip(self.regressor.linear, value):
+            _layer.weight.data = _w
+        self.regressor.np_params = None
 
     @property
     @ensure_res_numpy_floats
     def biases(self):
-        return [self.regressor.layer.bias.data, self.regressor.output.bias.data]
+        return [_layer.bias.data for _layer in self.regressor.linear if _layer.bias is not None]
 
     @biases.setter
     @ensure_args_torch_floats
     def biases(self, value):
-        self.regressor.layer.bias.data = value[0]
-        self.regressor.output.bias.data = value[1]
+        for _layer, _b in zip([_layer for _layer in self.regressor.linear
+                               if _layer.bias is not None], value):
+            _layer.bias.data = _b
+        self.regressor.np_params = None
 
     @property
     def params(self):
@@ -369,51 +803,139 @@ class NeuralRecurrentTransition:
         self.weights = value[1]
         self.biases = value[2]
 
+    @property
+    def version(self):
+        return params_version(list(self.regressor.parameters()))
+
+    @property
+    def features_key(self):
+        return ('neural', self.dm_act,
+                self.norm['mean'].tobytes(), self.norm['std'].tobytes())
+
     def initialize(self, x, u, **kwargs):
         pass
 
+    # numpy copies of the regressor weights for single-step evaluation,
+    # dropped by the regressor whenever it changes its parameters
+    @property
+    def np_params(self):
+        if self.regressor.np_params is None:
+            _linear = self.regressor.linear
+            _params = dict(logmat=np_float(self.regressor.logmat),
+                           weights=[np_float(_layer.weight) for _layer in _linear],
+                           biases=[None if _layer.bias is None else np_float(_layer.bias)
+                                   for _layer in _linear],
+                           mean=np.ravel(self.norm['mean']), std=np.ravel(self.norm['std']))
+            self.regressor.np_params = _params
+        return self.regressor.np_params
+
+    # input terms of the logits of N single steps, N x K
+    def np_output(self, x, u):
+        _params = self.np_params
+        _nonlin = dict(relu=lambda a: np.maximum(a, 0.), tanh=np.tanh,
+                       splus=lambda a: np.logaddexp(0., a))[self.nonlinearity]
+
+        xu = np.hstack((np.atleast_2d(x), np.atleast_2d(u)[:, :self.dm_act]))
+        out = (xu - _params['mean']) / _params['std']
+        for n, (_w, _b) in enumerate(zip(_params['weights'], _params['biases'])):
+            out = np.dot(out, _w.T) if _b is None else np.dot(out, _w.T) + _b
+            if n < len(_params['weights']) - 1:
+                out = _nonlin(out)
+        return out
+
+    # next-state probabilities of a single step, bypasses torch
+    def probs(self, z, x, u):
+        _logits = self.np_params['logmat'][z, :] + self.np_output(np.ravel(x), np.ravel(u))[0]
+        _probs = np.exp(_logits - np.max(_logits))
+        return _probs / np.sum(_probs)
+
+    # normalized log-transitions of N single steps, N x K x K
+    def log_transition_step(self, x, u):
+        _logtrans = self.np_params['logmat'][None, :, :] + self.np_output(x, u)[:, None, :]
+        return _logtrans - logsumexp(_logtrans, axis=-1, keepdims=True)
+
     def sample(self, z, x, u):
-        mat = np.squeeze(np.exp(self.log_transition(x, u)[0]))
-        return npr.choice(self.nb_states, p=mat[z, :])
+        return npr.choice(self.nb_states, p=self.probs(z, x, u))
 
     def likeliest(self, z, x, u):
-        mat = np.squeeze(np.exp(self.log_transition(x, u)[0]))
-        return np.argmax(mat[z, :])
+        return np.argmax(self.probs(z, x, u))
+
+    # cumulative transition probabilities of N inputs at once, N x K x K
+    @torch.no_grad()
+    def cdf(self, x, u):
+        self.regressor.eval()
+        _in = np.hstack((np.atleast_2d(x), np.atleast_2d(u)[:, :self.dm_act]))
+        return np.cumsum(np.exp(np_float(self.regressor.forward(_in))), axis=-1)
 
     def permute(self, perm):
-        self.logmat = self.logmat[np.ix_(perm, perm)]
-        self.weights[-1] = self.weights[-1][:, perm]
-        self.biases[-1] = self.biases[-1][perm]
+        self.regressor.permute(perm)
+        self.nb_states = len(perm)
 
     @ensure_res_numpy_floats
     def log_prior(self):
         self.regressor.eval()
         return self.regressor.log_prior()
 
+    def features(self, x, u):
+        # regressor features of each sequence, plus the stacked
+        # features of all transitions for the m-step
+        def _features():
+            feat = []
+            with torch.no_grad():
+                for _x, _u in zip(x, u):
+                    T = np.maximum(len(_x) - 1, 1)
+                    _in = np.hstack((_x[:T, :], _u[:T, :self.dm_act]))
+                    feat.append(self.regressor.featurize(to_float(_in, self.device)))
+            stacked = torch.cat([_feat[:len(_x) - 1] for _feat, _x in zip(feat, x)])
+            return feat, stacked
+
+        return memoize(x, u, ('transition', ) + self.features_key, _features)
+
+    @torch.no_grad()
     @ensure_args_are_viable_lists
-    def log_transition(self, x, u):
+    def log_transition(self, x, u, factored=False):
         self.regressor.eval()
 
+        feat, _ = self.features(x, u)
+
         logtrans = []
-        for _x, _u in zip(x, u):
-            T = np.maximum(len(_x) - 1, 1)
-            _in = np.hstack((_x[:T, :], _u[:T, :self.dm_act]))
-            _logtrans = np_float(self.regressor.forward(_in))
-            logtrans.append(_logtrans - logsumexp(_logtrans, axis=-1, keepdims=True))
+        if factored:
+            # K x K matrix plus T x K input term, normalized by the kernels
+            _logmat = np_float(self.regressor.logmat)
+            for _feat in feat:
+                _output = np_float(self.regressor.output(_feat))
+                logtrans.append((_logmat, _output))
+            return logtrans
+
+        # already normalized by the regressor
+        for _feat in feat:
+            logtrans.append(np_float(self.regressor.logtrans(_feat)))
         return logtrans
 
     def mstep(self, zeta, x, u, weights=None, **kwargs):
-        xu = []
-        for _x, _u in zip(x, u):
-            xu.append(np.hstack((_x[:-1, :], _u[:-1, :self.dm_act])))
+        _, feat = self.features(x, u)
+
+        # summed K x K counts and per-step from/to-state
+        # marginals, all the transition elbo depends on
+        if isinstance(zeta[0], tuple):
+            # already reduced by the e-step
+            if weights is not None:
+                raise ValueError("weighted m-step needs the full joint posterior")
+            counts = sum([_zeta[0] for _zeta in zeta])
+            frm = np.vstack([_zeta[1] for _zeta in zeta])
+            to = np.vstack([_zeta[2] for _zeta in zeta])
+        else:
+            aux = []
+            if weights is not None:
+                for _w, _zeta in zip(weights, zeta):
+                   aux.append(_w[:-1, None, None] * _zeta)
+                zeta = aux
 
-        aux = []
-        if weights is not None:
-            for _w, _zeta in zip(weights, zeta):
-               aux.append(_w[:-1, None, None] * _zeta)
-            zeta = aux
+            counts = sum([np.sum(_zeta, axis=0) for _zeta in zeta])
+            frm = np.vstack([np.sum(_zeta, axis=2) for _zeta in zeta])
+            to = np.vstack([np.sum(_zeta, axis=1) for _zeta in zeta])
 
-        self.regressor.fit(np.vstack(zeta), np.vstack(xu), **kwargs)
+        self.regressor.fit(counts, frm, to, feat, **kwargs)
 
 
 class NeuralRecurrentRegressor(nn.Module):
@@ -457,6 +979,7 @@ class NeuralRecurrentRegressor(nn.Module):
                 self._dirichlet = dist.dirichlet.Dirichlet(self._concentration.to(self.device))
 
         self.optim = None
+        self.np_params = None
 
     @torch.no_grad()
     def reset(self):
@@ -466,6 +989,26 @@ class NeuralRecurrentRegressor(nn.Module):
         _mat /= torch.sum(_mat, dim=-1, keepdim=True)
         self.logmat.data = torch.log(_mat).to(self.device)
 
+        self.optim = None
+        self.np_params = None
+
+    @torch.no_grad()
+    def permute(self, perm):
+        # reorders the states, a subset drops the others
+        _perm = torch.as_tensor(perm, dtype=torch.long, device=self.device)
+        self.logmat.data = self.logmat.data[_perm][:, _perm]
+        self.layers[-1].weight.data = self.layers[-1].weight.data[_perm]
+        self.layers[-1].out_features = len(perm)
+        self.sizes[-1] = self.nb_states = len(perm)
+
+        if hasattr(self, '_dirichlet'):
+            self._concentration = self._concentration[_perm][:, _perm]
+            self._dirichlet = dist.dirichlet.Dirichlet(self._concentration.to(self.device))
+
+        # adam moments refer to the old states
+        self.optim = None
+        self.np_params = None
+
     def log_prior(self):
         lp = torch.as_tensor(0., device=self.device)
         if self.prior:
@@ -474,41 +1017,81 @@ class NeuralRecurrentRegressor(nn.Module):
                 lp += self._dirichlet.log_prob(_matrix.to(self.device)).sum()
         return lp
 
+    @property
+    def linear(self):
+        return [_layer for _layer in self.layers if isinstance(_layer, nn.Linear)]
+
     def normalize(self, xu):
         return (xu - self._mean) / self._std
 
+    def featurize(self, xu):
+        return self.normalize(xu)
+
+    def output(self, feat):
+        return self.layers.forward(feat)
+
     def propagate(self, xu):
-        out = self.normalize(xu)
-        return self.layers.forward(out)
+        return self.output(self.featurize(xu))
 
-    @ensure_args_torch_floats
-    def forward(self, xu):
-        out = self.propagate(xu)
+    def logtrans(self, feat):
+        out = self.output(feat)
         _logtrans = self.logmat[None, :, :] + out[:, None, :]
         return _logtrans - torch.logsumexp(_logtrans, dim=-1, keepdim=True)
 
-    def elbo(self, zeta, xu, batch_size, set_size):
-        logtrans = self.forward(xu)
-        return torch.sum(zeta * logtrans) * set_size / batch_size + self.log_prior()
+    @ensure_args_torch_floats
+    def forward(self, xu):
+        return self.logtrans(self.featurize(xu))
+
+    # zeta enters only through its summed counts and marginals,
+    # sum(zeta * logtrans) = <counts, logmat> + <to, output> - <frm, norm>
+    def elbo(self, counts, frm, to, feat, batch_size, set_size):
+        output = self.output(feat)
+        norm = torch.logsumexp(self.logmat[None, :, :] + output[:, None, :], dim=-1)
+        return torch.sum(counts * self.logmat)\
+               + (torch.sum(to * output) - torch.sum(frm * norm)) * set_size / batch_size\
+               + self.log_prior()
 
     @ensure_args_torch_floats
-    def fit(self, zeta, xu, nb_iter=100, batch_size=None, lr=1e-3):
-        if self.prior and 'l2_penalty' in self.prior:
-            self.optim = Adam(self.parameters(), lr=lr, weight_decay=self.prior['l2_penalty'])
+    def fit(self, counts, frm, to, feat, nb_iter=100, batch_size=None, lr=1e-3, tol=None):
+        self.np_params = None
+
+        # optimizer state is kept across em iterations,
+        # rebuilt only on first use or a change of step size
+        if self.optim is None or self.optim.defaults['lr'] != lr:
+            if self.prior and 'l2_penalty' in self.prior:
+                self.optim = Adam(self.parameters(), lr=lr, weight_decay=self.prior['l2_penalty'])
+            else:
+                self.optim = Adam(self.parameters(), lr=lr)
+
+        set_size = feat.shape[0]
+        batch_size = set_size if batch_size is None else min(batch_size, set_size)
+
+        # reshuffled every epoch, last partial batch included
+        if batch_size < set_size:
+            batches = BatchSampler(SubsetRandomSampler(range(set_size)), batch_size, False)
         else:
-            self.optim = Adam(self.parameters(), lr=lr)
-
-        set_size = xu.shape[0]
-        batch_size = set_size if batch_size is None else batch_size
-        batches = list(BatchSampler(SubsetRandomSampler(range(set_size)), batch_size, True))
+            batches = [slice(None)]
 
+        last = None
         for n in range(nb_iter):
+            elbo = 0.
             for batch in batches:
+                _frm, _to, _feat = frm[batch], to[batch], feat[batch]
+
                 self.optim.zero_grad()
-                loss = - self.elbo(zeta[batch], xu[batch], batch_size, set_size)
+                _elbo = self.elbo(counts, _frm, _to, _feat, _feat.shape[0], set_size)
+                loss = - _elbo
                 loss.backward()
                 self.optim.step()
 
+                elbo += _elbo.item() * _feat.shape[0] / set_size
+
+            # relative change of the epoch-averaged elbo
+            if tol is not None and last is not None:
+                if abs(elbo - last) <= tol * abs(last):
+                    break
+            last = elbo
+
                 # if n % 10 == 0:
                 #     print('Epoch: {}/{}.............'.format(n, nb_iter), end=' ')
                 #     print("Loss: {:.4f}".format(loss))
@@ -8,6 +8,8 @@ from scipy.optimize import linear_sum_assignment
 from functools import lru_cache
 from functools import wraps
 
+from collections import OrderedDict
+
 import torch
 
 
@@ -83,15 +85,61 @@ def lod2dol(*dicts):
     return d
 
 
+# sequences of a Dataset, sharing one memo of derived arrays
+class SequenceList(list):
+
+    def __init__(self, seqs, memo):
+        super(SequenceList, self).__init__(seqs)
+        self.memo = memo
+
+
+# fixed observations and controls that can be passed to the models
+# in place of (obs, act) lists. Design matrices and features derived
+# from them are built on first use and kept for later iterations,
+# so the sequences must not be modified afterwards
+class Dataset:
+
+    def __init__(self, obs, act=None, dm_act=0):
+        obs = obs if isinstance(obs, (list, tuple)) else [obs]
+        obs = [np.atleast_2d(_obs) for _obs in obs]
+
+        if act is None:
+            act = [np.zeros((_obs.shape[0], dm_act)) for _obs in obs]
+        act = act if isinstance(act, (list, tuple)) else [act]
+        act = [np.atleast_2d(_act) for _act in act]
+
+        self.memo = {}
+        self.obs = SequenceList(obs, self.memo)
+        self.act = SequenceList(act, self.memo)
+
+    def __len__(self):
+        return len(self.obs)
+
+
+# derived arrays are built once if x and u come from the same
+# Dataset, for plain lists they are recomputed on every call
+def memoize(x, u, key, f):
+    memo = getattr(x, 'memo', None)
+    if memo is None or getattr(u, 'memo', None) is not memo:
+        return f()
+
+    if key not in memo:
+        memo[key] = f()
+    return memo[key]
+
+
 def ensure_args_are_viable_lists(f):
     def wrapper(self, obs, act=None, **kwargs):
         assert obs is not None
+        if isinstance(obs, Dataset):
+            obs, act = obs.obs, obs.act
+
         obs = [np.atleast_2d(obs)] if not isinstance(obs, (list, tuple)) else obs
 
         if act is None:
             act = []
             for _obs in obs:
-                act.append(np.zeros((_obs.shape[0], self.dm_act)))
+                act.append(zero_act(_obs.shape[0], self.dm_act))
 
         act = [np.atleast_2d(act)] if not isinstance(act, (list, tuple)) else act
 
@@ -99,31 +147,125 @@ def ensure_args_are_viable_lists(f):
     return wrapper
 
 
-def np_cache(function):
-    @lru_cache()
-    def cached_wrapper(hashable_array, *args):
-        array = np.array(hashable_array)
-        return function(array, *args)
+# shared read-only zero controls, identical across calls
+@lru_cache(maxsize=64)
+def zero_act(nb_steps, dm_act):
+    _act = np.zeros((nb_steps, dm_act))
+    _act.flags.writeable = False
+    return _act
+
+
+# digest of (nested) parameters, changes whenever any value does
+def params_version(params):
+    if isinstance(params, (list, tuple)):
+        return hash(tuple(params_version(_param) for _param in params))
+    if isinstance(params, torch.Tensor):
+        params = params.detach().cpu().numpy()
+    _params = np.ascontiguousarray(params)
+    return hash((_params.shape, _params.dtype.str, _params.tobytes()))
+
+
+# dict kept on obj under name, emptied whenever version changes
+def versioned_memo(obj, name, version):
+    _memo = getattr(obj, name, None)
+    if _memo is None or _memo[0] != version:
+        _memo = (version, {})
+        setattr(obj, name, _memo)
+    return _memo[1]
 
-    @wraps(function)
-    def wrapper(array, *args):
-        array_tuple = tuple(zip(*array.T.tolist()))
-        return cached_wrapper(array_tuple, *args)
 
-    # copy lru_cache attributes over too
-    wrapper.cache_info = cached_wrapper.cache_info
-    wrapper.cache_clear = cached_wrapper.cache_clear
+# memory held by (nested) evaluation results, broadcast
+# dimensions of read-only views are only counted once
+def nbytes(res):
+    if isinstance(res, np.ndarray):
+        return res.itemsize * int(np.prod([_n for _n, _s in zip(res.shape, res.strides) if _s != 0]))
+    if isinstance(res, (list, tuple)):
+        return sum(nbytes(_res) for _res in res)
+    if hasattr(res, '__dict__'):
+        return sum(nbytes(_res) for _res in vars(res).values())
+    return 0
 
-    return wrapper
 
+# sequences of a Dataset are fixed and stand for themselves,
+# plain lists are identified by the content of their arrays,
+# which are hashed in full on every call
+def data_version(arrs):
+    memo = getattr(arrs, 'memo', None)
+    if memo is not None:
+        return id(memo)
+    return params_version(list(arrs))
+
+
+# cache of component evaluations, one entry per component, method,
+# data and keywords holding the result at the parameter version it
+# was computed for. A new version replaces the stale result, least
+# recently used entries are dropped beyond maxbytes altogether
+class LikelihoodCache:
+
+    def __init__(self, maxbytes=2**28):
+        self.maxbytes = maxbytes
+        self.size = 0
+        self.entries = OrderedDict()
+
+    def __call__(self, f, *args, **kwargs):
+        component = f.__self__
+        key = (id(component), f.__func__,
+               tuple(data_version(_arg) for _arg in args),
+               tuple(sorted(kwargs.items())))
+
+        version = component.version
+        if key in self.entries:
+            if self.entries[key][2] == version:
+                self.entries.move_to_end(key)
+                return self.entries[key][-1]
+            self.size -= self.entries.pop(key)[3]
+
+        res = f(*args, **kwargs)
+
+        size = nbytes(res)
+        if size > self.maxbytes:
+            return res
 
-# stack ar observations and controls
-@np_cache
-def stack(x, shift):
-    _hr = len(x) - shift
-    _x = np.vstack([np.hstack([x[t + l] for l in range(shift + 1)])
-                    for t in range(_hr)])
-    return np.squeeze(_x)
+        # hold on to component and memos so their ids stay unique
+        memos = tuple(getattr(_arg, 'memo', None) for _arg in args)
+        self.entries[key] = (component, memos, version, size, res)
+        self.size += size
+        while self.size > self.maxbytes:
+            _, (_, _, _, _size, _) = self.entries.popitem(last=False)
+            self.size -= _size
+
+        return res
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+
+# sliding windows over a sequence as a read-only strided view,
+# row t holds x[t], ..., x[t + lags] side by side without copying
+def lag_embed(x, lags):
+    x = np.ascontiguousarray(x[:, None] if x.ndim == 1 else x)
+    T, D = x.shape
+    return np.lib.stride_tricks.as_strided(x, shape=(max(T - lags, 0), (lags + 1) * D),
+                                           strides=x.strides, writeable=False)
+
+
+# inverse-cdf draws of categorical variables, one per row of cdf
+def inverse_cdf(cdf, unif):
+    return np.minimum(np.sum(unif[..., None] > cdf, axis=-1), cdf.shape[-1] - 1)
+
+
+# pack a list of arrays into one contiguous buffer
+def to_ragged(arrs):
+    offsets = np.zeros((len(arrs) + 1, ), dtype=np.intp)
+    offsets[1:] = np.cumsum([len(_arr) for _arr in arrs])
+    buffer = np.ascontiguousarray(np.concatenate(arrs, axis=0), dtype=np.float64)
+    return buffer, offsets
+
+
+# split a contiguous buffer back into a list of views
+def from_ragged(buffer, offsets):
+    return [buffer[offsets[n]:offsets[n + 1]] for n in range(len(offsets) - 1)]
 
 
 def flatten_to_dim(X, d):
@@ -247,6 +389,90 @@ def linear_regression(Xs, ys, weights=None,
         return W, Sigma
 
 
+# weighted least squares for K weightings of the same data at once,
+# all sufficient statistics are gathered in a single pass
+def batch_linear_regression(Xs, ys, weights,
+                            mu0=0., sigma0=1e32,
+                            nu0=0, psi0=1e-32,
+                            cov_type='full'):
+
+    assert cov_type in ('full', 'diagonal', 'tied')
+
+    Xs = Xs if isinstance(Xs, (list, tuple)) else [Xs]
+    ys = ys if isinstance(ys, (list, tuple)) else [ys]
+    weights = weights if isinstance(weights, (list, tuple)) else [weights]
+    assert len(Xs) == len(ys) == len(weights)
+
+    D = Xs[0].shape[1]
+    P = ys[0].shape[1]
+    K = weights[0].shape[1]
+
+    diagonal = cov_type == 'diagonal'
+
+    # weighted gram matrices X^T W X, X^T W y and y^T W y,
+    # only the diagonal of the latter for diagonal covariances.
+    # One weighted copy of the data at a time, not K of them
+    XWX = np.zeros((K, D, D))
+    XWy = np.zeros((K, D, P))
+    yWy = np.zeros((K, P)) if diagonal else np.zeros((K, P, P))
+    nu = nu0 * np.ones((K, ))
+    for X, y, weight in zip(Xs, ys, weights):
+        for k in range(K):
+            XW = (X * weight[:, k, None]).T                         # (D, N)
+            XWX[k] += np.dot(XW, X)
+            XWy[k] += np.dot(XW, y)
+            if not diagonal:
+                yWy[k] += np.dot((y * weight[:, k, None]).T, y)
+        if diagonal:
+            yWy += np.dot(weight.T, y**2)
+        nu += np.sum(weight, axis=0)
+
+    # posterior with an isotropic prior, no explicit inverse
+    J = XWX + np.eye(D) / sigma0
+    h = XWy + mu0 * np.ones((D, P)) / sigma0
+
+    # minimum-norm solutions as with lstsq, robust to collinear inputs
+    WT = np.matmul(np.linalg.pinv(J), h)                            # (K, D, P)
+    W = np.swapaxes(WT, -1, -2)                                     # (K, P, D)
+
+    # residual scatter from the same statistics
+    if diagonal:
+        Psi = yWy - 2. * np.einsum('kpd,kdp->kp', W, XWy)\
+              + np.einsum('kpd,kde,kpe->kp', W, XWX, W)
+        _trace, _min = np.sum(Psi, axis=-1), np.min(Psi, axis=-1)
+        _scale = np.sum(yWy, axis=-1)
+    else:
+        WXy = np.matmul(W, XWy)
+        Psi = yWy - WXy - np.swapaxes(WXy, -1, -2) + np.matmul(np.matmul(W, XWX), WT)
+        Psi = 0.5 * (Psi + np.swapaxes(Psi, -1, -2))
+        _trace, _min = np.trace(Psi, axis1=-2, axis2=-1), np.linalg.eigvalsh(Psi)[:, 0]
+        _scale = np.trace(yWy, axis1=-2, axis2=-1)
+
+    # the scatter is a difference of gram terms, states with tiny
+    # residuals lose too many digits and get an explicit second pass,
+    # unused states have no weight and an exact zero scatter
+    lossy = ((_trace < 1e-6 * _scale) | (_min <= 0.)) & (_scale > 0.)
+    for k in np.where(lossy)[0]:
+        Psi[k] = 0.
+        for X, y, weight in zip(Xs, ys, weights):
+            resid = y - np.dot(X, W[k].T)
+            if diagonal:
+                Psi[k] += np.dot(weight[:, k], resid**2)
+            else:
+                Psi[k] += np.einsum('t,ti,tj->ij', weight[:, k], resid, resid)
+
+    # Get MAP estimate of posterior covariance, (K, P, P) when full,
+    # (K, P) variances when diagonal and a single (P, P) when tied
+    if diagonal:
+        Sigma = (psi0 + Psi) / (nu + P + 1)[:, None]
+    elif cov_type == 'tied':
+        Sigma = (psi0 * np.eye(P) + np.sum(Psi, axis=0))\
+                / (np.sum(nu) - (K - 1) * nu0 + P + 1)
+    else:
+        Sigma = (psi0 * np.eye(P) + Psi) / (nu + P + 1)[:, None, None]
+    return W, Sigma
+
+
 def to_float(arr, device=torch.device('cpu')):
     if isinstance(arr, np.ndarray):
         return torch.from_numpy(arr).float().to(device)
@@ -11,6 +11,8 @@ ext_modules = []
 ext_modules.append(
     Extension('sds.cython.hmm_cy',
               sources=["sds/cython/hmm_cy.pyx"],
+              extra_compile_args=["-fopenmp"],
+              extra_link_args=["-fopenmp"],
               language="c++")
 )
 
@@ -0,0 +1,58 @@
+import numpy as np
+import torch
+
+import warnings
+
+warnings.simplefilter(action='ignore', category=FutureWarning)
+np.random.seed(1337)
+torch.manual_seed(1337)
+
+T = [150, 110]
+
+K = 4
+
+
+def exact_statistics(model, loglikhds, reduce):
+    if reduce:
+        return model.expected_statistics(*loglikhds)
+    alpha, norm, beta = model.forward_backward(*loglikhds)
+    return model.posterior(alpha, beta), model.joint_posterior(alpha, beta, *loglikhds), norm
+
+
+def test_full_beam(sampled_models):
+    x, hmm, rarhmm = sampled_models
+    # a beam holding all states prunes nothing and is exact
+    for model in [hmm, rarhmm]:
+        loglikhds = model.log_likelihoods(x)
+        for reduce in [True, False]:
+            gamma, zeta, norm = exact_statistics(model, loglikhds, reduce and model.stationary)
+            for beam in [dict(size=K), dict(size=0, threshold=0.)]:
+                _gamma, _zeta, _norm, _pruned = model.beam_statistics(*loglikhds, **beam,
+                                                                      reduce=reduce and model.stationary)
+                assert np.all(np.hstack(_pruned) == 0.)
+                assert np.allclose(np.hstack(_norm), np.hstack(norm))
+                for _g, g, _z, z in zip(_gamma, gamma, _zeta, zeta):
+                    assert np.allclose(_g, g)
+                    assert np.allclose(_z, z)
+
+
+def test_narrow_beam(sampled_models):
+    x, hmm, rarhmm = sampled_models
+    # pruned forward mass only lowers the likelihood
+    for model in [hmm, rarhmm]:
+        loglikhds = model.log_likelihoods(x)
+        _, _, norm = model.expected_statistics(*loglikhds)
+        loglik = np.sum(np.hstack(norm))
+
+        for beam in [dict(size=1), dict(size=2), dict(threshold=1e-2), dict(size=3, threshold=1e-3)]:
+            gamma, _, _norm, _pruned = model.beam_statistics(*loglikhds, **beam)
+            assert np.sum(np.hstack(_norm)) <= loglik + 1e-8
+            assert np.all(np.hstack(_pruned) >= 0.)
+            for _g in gamma:
+                assert np.allclose(np.sum(_g, axis=-1), 1.)
+                # never more states than the beam holds, but on the last step
+                if 'size' in beam:
+                    assert np.all(np.sum(_g[:-1] > 0., axis=-1) <= beam['size'])
+
+        _, _, ll = model.estep(x, reduce=True, beam=dict(size=2))
+        assert np.sum(ll) <= loglik + 1e-8
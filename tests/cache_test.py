@@ -0,0 +1,77 @@
+import numpy as np
+from sds.hmm import HMM
+from sds.arhmm import ARHMM
+from sds.utils import Dataset, LikelihoodCache
+
+import warnings
+
+warnings.simplefilter(action='ignore', category=FutureWarning)
+np.random.seed(1337)
+
+T = [120, 95]
+
+true_hmm = HMM(nb_states=3, dm_obs=2)
+true_z, x = true_hmm.sample(horizon=T)
+
+
+def test_hits_and_misses():
+    model = HMM(nb_states=3, dm_obs=2)
+    model.initialize(x)
+
+    loglikhds = model.log_likelihoods(x)
+    nb_entries = len(model.cache.entries)
+    assert nb_entries > 0
+
+    # same parameters and data, the results are returned as they are
+    _loglikhds = model.log_likelihoods(x)
+    assert all(_l is l for _l, l in zip(_loglikhds, loglikhds))
+
+    # data of the same content is recognized, other data is not
+    _loglikhds = model.log_likelihoods([np.array(_x) for _x in x])
+    assert all(_l is l for _l, l in zip(_loglikhds, loglikhds))
+    # the initial state distribution does not depend on data
+    model.log_likelihoods([_x[:50] for _x in x])
+    assert len(model.cache.entries) == 2 * nb_entries - 1
+
+
+def test_invalidation():
+    model = HMM(nb_states=3, dm_obs=2)
+    model.initialize(x)
+
+    _, _, logobs = model.log_likelihoods(x)
+    nb_entries = len(model.cache.entries)
+
+    # a new version replaces the stale result in place
+    model.observations.mu = model.observations.mu + 1.
+    _, _, _logobs = model.log_likelihoods(x)
+    assert not np.allclose(np.vstack(_logobs), np.vstack(logobs))
+    assert np.allclose(np.vstack(_logobs), np.vstack(model.observations.log_likelihood(x, None)))
+    assert len(model.cache.entries) == nb_entries
+
+    # em keeps one entry per component and data
+    model = ARHMM(nb_states=3, dm_obs=2)
+    model.initialize(x)
+    model.log_likelihoods(x)
+    nb_entries = len(model.cache.entries)
+
+    model.em(x, nb_iter=10, prec=0.)
+    assert len(model.cache.entries) == nb_entries
+
+    model.em(Dataset(x), nb_iter=10, prec=0.)
+    assert len(model.cache.entries) == 2 * nb_entries - 1
+
+
+def test_maxbytes():
+    model = ARHMM(nb_states=3, dm_obs=2)
+    model.initialize(x)
+
+    # results over the budget are not kept, older ones are evicted
+    model.cache = LikelihoodCache(maxbytes=0)
+    model.log_likelihoods(x)
+    assert len(model.cache.entries) == 0 and model.cache.size == 0
+
+    model.cache = LikelihoodCache(maxbytes=2 * 8 * 3 * sum(T))
+    model.log_likelihoods(x)
+    model.log_likelihoods([_x[:60] for _x in x])
+    assert model.cache.size <= model.cache.maxbytes
+    assert model.cache.size == sum(_entry[3] for _entry in model.cache.entries.values())
@@ -0,0 +1,29 @@
+import numpy as np
+import torch
+import pytest
+from sds.hmm import HMM
+from sds.rarhmm import rARHMM
+
+
+@pytest.fixture(scope='module')
+def sampled_models(request):
+    # sequences of horizons T sampled from a K-state hmm, with a
+    # stationary hmm of random transitions and a poly rarhmm
+    # initialized on them. T and K are taken from the test module
+    T = request.module.T
+    K = getattr(request.module, 'K', 3)
+
+    np.random.seed(1337)
+    torch.manual_seed(1337)
+
+    true_hmm = HMM(nb_states=K, dm_obs=2)
+    _, x = true_hmm.sample(horizon=T)
+
+    hmm = HMM(nb_states=K, dm_obs=2)
+    hmm.initialize(x)
+    hmm.transitions.logmat = np.log(np.random.dirichlet(np.ones(K), size=K))
+
+    rarhmm = rARHMM(nb_states=K, dm_obs=2, trans_type='poly')
+    rarhmm.initialize(x)
+
+    return x, hmm, rarhmm
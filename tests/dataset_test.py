@@ -0,0 +1,73 @@
+import copy
+import numpy as np
+import torch
+import sds.observations
+import sds.transitions
+from sds.hmm import HMM
+from sds.rarhmm import rARHMM
+from sds.utils import Dataset, memoize
+
+import warnings
+
+warnings.simplefilter(action='ignore', category=FutureWarning)
+np.random.seed(1337)
+torch.manual_seed(1337)
+
+T = [120, 95]
+
+true_hmm = HMM(nb_states=3, dm_obs=2)
+true_z, x = true_hmm.sample(horizon=T)
+u = [np.random.randn(_T, 1) for _T in T]
+
+
+def counting_memoize(builds):
+    # memoize that counts how often each derived array is built
+    def _memoize(x, u, key, f):
+        def _f():
+            builds[key[0]] = builds.get(key[0], 0) + 1
+            return f()
+        return memoize(x, u, key, _f)
+    return _memoize
+
+
+def test_memoize():
+    data = Dataset(x, u)
+    arrs = memoize(data.obs, data.act, 'key', lambda: [np.ones(3)])
+    assert memoize(data.obs, data.act, 'key', lambda: [np.zeros(3)]) is arrs
+    assert 'key' in data.memo
+
+    # plain lists and controls from elsewhere are not memoized
+    assert memoize(x, u, 'key', lambda: [np.zeros(3)]) is not arrs
+    assert memoize(data.obs, list(u), 'key', lambda: [np.zeros(3)]) is not arrs
+
+
+def test_em():
+    model = rARHMM(nb_states=3, dm_obs=2, dm_act=1, trans_type='poly')
+    model.initialize(x, u)
+    _model = copy.deepcopy(model)
+
+    # the same fit from lists and from a Dataset
+    train_lls = model.em(x, u, nb_iter=5, prec=0.)
+    _train_lls = _model.em(Dataset(x, u), nb_iter=5, prec=0.)
+    assert np.allclose(_train_lls, train_lls)
+    assert np.allclose(_model.observations.A, model.observations.A)
+
+
+def test_built_once(monkeypatch):
+    builds = {}
+    monkeypatch.setattr(sds.observations, 'memoize', counting_memoize(builds))
+    monkeypatch.setattr(sds.transitions, 'memoize', counting_memoize(builds))
+
+    model = rARHMM(nb_states=3, dm_obs=2, dm_act=1, trans_type='poly')
+    model.initialize(x, u)
+
+    # regression data and features are built once for a Dataset
+    model.em(Dataset(x, u), nb_iter=5, prec=0.)
+    assert builds == {'ar-observation': 1, 'transition': 1}
+
+    # and rebuilt on every iteration for lists, with or without
+    # the zero controls filled in for missing actions
+    for act in [u, None]:
+        builds.clear()
+        model.em(x, act, nb_iter=5, prec=0.)
+        assert builds['ar-observation'] >= 5 and builds['transition'] >= 5
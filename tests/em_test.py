@@ -0,0 +1,75 @@
+import copy
+import numpy as np
+import torch
+from sds.hmm import HMM
+from sds.arhmm import ARHMM
+from sds.rarhmm import rARHMM
+
+import warnings
+
+warnings.simplefilter(action='ignore', category=FutureWarning)
+np.random.seed(1337)
+torch.manual_seed(1337)
+
+T = [120, 95]
+
+true_hmm = HMM(nb_states=3, dm_obs=2)
+true_z, x = true_hmm.sample(horizon=T)
+_, test_x = true_hmm.sample(horizon=[60])
+
+
+def traced(model):
+    # copies of the model before every m-step, and the lengths
+    # of the sequences every forward pass runs on
+    snapshots, forwards = [], []
+    mstep, forward = model.mstep, model.forward
+
+    def _mstep(*args, **kwargs):
+        _model = copy.deepcopy(model)
+        del _model.mstep, _model.forward
+        snapshots.append(_model)
+        return mstep(*args, **kwargs)
+
+    def _forward(loginit, logtrans, logobs, *args, **kwargs):
+        forwards.append([len(_logobs) for _logobs in logobs])
+        return forward(loginit, logtrans, logobs, *args, **kwargs)
+
+    model.mstep, model.forward = _mstep, _forward
+    return snapshots, forwards
+
+
+def models():
+    return [ARHMM(nb_states=3, dm_obs=2),
+            rARHMM(nb_states=3, dm_obs=2, trans_type='poly')]
+
+
+def test_em():
+    for model in models():
+        model.initialize(x)
+        snapshots, forwards = traced(model)
+        train_lls = model.em(x, nb_iter=5, prec=0.)
+
+        # the likelihoods come with the statistics of the e-step,
+        # there is no separate forward pass
+        assert len(forwards) == 0
+
+        # and belong to the parameters the e-step ran on
+        assert len(train_lls) == len(snapshots) + 1
+        for _ll, _model in zip(train_lls, snapshots + [model]):
+            assert np.isclose(_ll, _model.log_norm(x))
+
+
+def test_earlystop_em():
+    for model in models():
+        model.initialize(x)
+        snapshots, forwards = traced(model)
+        train_lls = model.earlystop_em(x, nb_iter=5, prec=0., test_obs=test_x,
+                                       test_act=[np.zeros((len(_x), 0)) for _x in test_x])
+
+        # forward passes only run on the test data
+        assert len(forwards) == len(train_lls)
+        assert all(_lengths == [len(_x) for _x in test_x] for _lengths in forwards)
+
+        assert len(train_lls) == len(snapshots) + 1
+        for _ll, _model in zip(train_lls, snapshots + [model]):
+            assert np.isclose(_ll, _model.log_norm(x))
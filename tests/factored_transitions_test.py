@@ -0,0 +1,82 @@
+import copy
+import numpy as np
+from sds.hmm import HMM
+from sds.transitions import SparseFactors
+
+import warnings
+
+warnings.simplefilter(action='ignore', category=FutureWarning)
+np.random.seed(1337)
+
+T = [150, 110]
+
+K = 5
+
+true_hmm = HMM(nb_states=K, dm_obs=2)
+true_z, x = true_hmm.sample(horizon=T)
+
+support = np.eye(K, dtype=bool) | (np.random.rand(K, K) < 0.5)
+
+
+def factored_models(left_to_right=True):
+    models = [HMM(nb_states=K, dm_obs=2, trans_type='sparse', trans_kwargs={'support': support}),
+              HMM(nb_states=K, dm_obs=2, trans_type='banded',
+                  trans_kwargs={'bandwidth': 1, 'left_to_right': left_to_right}),
+              HMM(nb_states=K, dm_obs=2, trans_type='lowrank', trans_kwargs={'rank': 2})]
+
+    for model in models:
+        model.init_state.params = true_hmm.init_state.params
+        model.observations.params = true_hmm.observations.params
+        if model.trans_type != 'lowrank':
+            model.transitions.logmat = np.log(np.random.dirichlet(np.ones(K), size=K))
+    return models
+
+
+def dense_model(model):
+    # the stationary model of the same dense matrix
+    dense = HMM(nb_states=K, dm_obs=2)
+    dense.init_state.params = model.init_state.params
+    dense.observations.params = model.observations.params
+    dense.transitions.logmat = model.transitions.logmat
+    return dense
+
+
+def test_factored_forward_backward():
+    for model in factored_models():
+        dense = dense_model(model)
+
+        loglikhds = model.log_likelihoods(x)
+        assert isinstance(loglikhds[1][0], SparseFactors)
+        dense_loglikhds = dense.log_likelihoods(x)
+
+        # states out of reach are -inf or vanishingly small
+        alpha, norm = model.forward(*loglikhds)
+        dense_alpha, dense_norm = dense.forward(*dense_loglikhds)
+        for _a, _da, _n, _dn in zip(alpha, dense_alpha, norm, dense_norm):
+            assert np.allclose(np.exp(_a), np.exp(_da))
+            assert np.allclose(_n, _dn)
+
+        gamma, zeta, _ = model.expected_statistics(*loglikhds)
+        dense_gamma, dense_zeta, _ = dense.expected_statistics(*dense_loglikhds)
+        for _g, _dg, (_, rcounts), _dz in zip(gamma, dense_gamma, zeta, dense_zeta):
+            assert np.allclose(_g, _dg)
+            # transition counts through both factors
+            if model.trans_type != 'lowrank':
+                assert np.allclose(rcounts.toarray(), _dz[0])
+
+        # m-steps from factored and dense counts agree
+        _model = copy.deepcopy(model)
+        model.transitions.mstep(zeta, x, None)
+        _model.transitions.mstep(dense_zeta, x, None)
+        assert np.allclose(model.transitions.matrix, _model.transitions.matrix)
+
+
+def test_factored_em():
+    # left-to-right models starve the late states of the sampled data
+    for model in factored_models(left_to_right=False):
+        loglik = model.em(x, nb_iter=10, prec=0.)
+        assert np.all(np.diff(loglik) > -1e-6)
+
+        # the support of sparse transitions is kept
+        if model.trans_type != 'lowrank':
+            assert np.all(model.transitions.matrix[~model.transitions.support.toarray()] == 0.)
@@ -0,0 +1,93 @@
+import numpy as np
+import torch
+from sds.hmm import dense_logtrans
+
+import warnings
+
+warnings.simplefilter(action='ignore', category=FutureWarning)
+np.random.seed(1337)
+torch.manual_seed(1337)
+
+T = [120, 95]
+
+
+def compare_forward_backward(model, loglikhds):
+    alpha, norm = model.forward(*loglikhds)
+    np_alpha, np_norm = model.forward(*loglikhds, cython=False)
+    for _a, _np_a, _n, _np_n in zip(alpha, np_alpha, norm, np_norm):
+        assert np.allclose(_a, _np_a)
+        assert np.allclose(_n, _np_n)
+
+    beta = model.backward(*loglikhds, scale=norm)
+    np_beta = model.backward(*loglikhds, scale=norm, cython=False)
+    for _b, _np_b in zip(beta, np_beta):
+        assert np.allclose(_b, _np_b)
+
+    zeta = model.joint_posterior(alpha, beta, *loglikhds)
+    np_zeta = model.joint_posterior(alpha, beta, *loglikhds, cython=False)
+    for _z, _np_z in zip(zeta, np_zeta):
+        assert np.allclose(_z, _np_z)
+
+    return alpha, norm, beta, zeta
+
+
+def test_forward_backward(sampled_models):
+    x, hmm, _ = sampled_models
+    compare_forward_backward(hmm, hmm.log_likelihoods(x))
+
+
+def test_time_varying_transitions(sampled_models):
+    x, hmm, _ = sampled_models
+    # full T x K x K copies take the general path of the kernels
+    loginit, logtrans, logobs = hmm.log_likelihoods(x)
+    tiled = [np.array(_logtrans) for _logtrans in logtrans]
+    tiled[0] = tiled[0] + 1e-3 * np.random.randn(*tiled[0].shape)
+    compare_forward_backward(hmm, (loginit, tiled, logobs))
+
+
+def test_factored_recurrent_transitions(sampled_models):
+    x, _, rarhmm = sampled_models
+    loginit, logtrans, logobs = rarhmm.log_likelihoods(x)
+    assert isinstance(logtrans[0], tuple)
+    _, norm, _, zeta = compare_forward_backward(rarhmm, (loginit, logtrans, logobs))
+
+    # factored and expanded transitions give the same likelihood
+    _, dense_norm = rarhmm.forward(loginit, dense_logtrans(logtrans), logobs)
+    assert np.allclose(np.hstack(norm), np.hstack(dense_norm))
+
+
+def test_expected_statistics(sampled_models):
+    x, hmm, _ = sampled_models
+    loglikhds = hmm.log_likelihoods(x)
+    alpha, norm, beta = hmm.forward_backward(*loglikhds)
+    gamma = hmm.posterior(alpha, beta)
+    zeta = hmm.joint_posterior(alpha, beta, *loglikhds, cython=False)
+
+    _gamma, _zeta, _norm = hmm.expected_statistics(*loglikhds)
+    for _g, g, _z, z in zip(_gamma, gamma, _zeta, zeta):
+        assert np.allclose(_g, g)
+        assert np.allclose(_z[0], np.sum(z, axis=0))
+    assert np.allclose(np.hstack(_norm), np.hstack(norm))
+
+
+def test_reduced_recurrent_statistics(sampled_models):
+    x, _, rarhmm = sampled_models
+    loglikhds = rarhmm.log_likelihoods(x)
+    alpha, norm, beta = rarhmm.forward_backward(*loglikhds)
+    zeta = rarhmm.joint_posterior(alpha, beta, *loglikhds, cython=False)
+
+    _, _zeta, _ = rarhmm.expected_statistics(*loglikhds)
+    for (counts, frm, to), z in zip(_zeta, zeta):
+        assert np.allclose(counts, np.sum(z, axis=0))
+        assert np.allclose(frm, np.sum(z, axis=2))
+        assert np.allclose(to, np.sum(z, axis=1))
+
+
+def test_viterbi(sampled_models):
+    x, hmm, rarhmm = sampled_models
+    for model in [hmm, rarhmm]:
+        delta, z = model.viterbi(x)
+        np_delta, np_z = model.viterbi(x, cython=False)
+        for _d, _np_d, _z, _np_z in zip(delta, np_delta, z, np_z):
+            assert np.allclose(_d, _np_d)
+            assert np.array_equal(_z, _np_z)
@@ -0,0 +1,169 @@
+import numpy as np
+from scipy.stats import multivariate_normal as mvn
+
+from sds.observations import GaussianObservation
+from sds.observations import AutoRegressiveGaussianObservation
+from sds.utils import linear_regression, batch_linear_regression
+
+import warnings
+
+warnings.filterwarnings('ignore')
+np.random.seed(1337)
+
+T = [60, 45]
+
+K, dm_obs, dm_act = 3, 2, 1
+
+x = [0.1 * np.cumsum(np.random.randn(_T, dm_obs), axis=0) for _T in T]
+u = [np.random.randn(_T, dm_act) for _T in T]
+
+
+def regressors(_x, _u, lags):
+    # lagged observations side by side, oldest first, then the last action
+    return np.stack([np.hstack([_x[t - l] for l in range(lags, 0, -1)] + [_u[t - 1]])
+                     for t in range(lags, len(_x))])
+
+
+def test_log_likelihood():
+    for lags in [1, 2, 3]:
+        obs = AutoRegressiveGaussianObservation(K, dm_obs, dm_act, prior={}, lags=lags)
+
+        loglik = obs.log_likelihood(x, u)
+        for _x, _u, _loglik in zip(x, u, loglik):
+            _xs = regressors(_x, _u, lags)
+            _ref = np.column_stack([mvn(mean=np.zeros(dm_obs), cov=obs.cov[k]).logpdf(
+                                    _x[lags:] - np.dot(_xs[:, :-dm_act], obs.A[k].T)
+                                    - np.dot(_xs[:, -dm_act:], obs.B[k].T) - obs.c[k])
+                                    for k in range(K)])
+            assert _loglik.shape == (len(_x) - lags, K)
+            assert np.allclose(_loglik, _ref)
+
+
+def test_mstep():
+    for lags in [1, 2]:
+        obs = AutoRegressiveGaussianObservation(K, dm_obs, dm_act, prior={}, lags=lags)
+
+        gamma = [np.random.dirichlet(np.ones(K), size=_T) for _T in T]
+        obs.mstep(gamma, x, u)
+
+        # the intercept is a column of ones without a prior of its own
+        xs = np.vstack([regressors(_x, _u, lags) for _x, _u in zip(x, u)])
+        xs = np.column_stack((xs, np.ones(len(xs))))
+        ys = np.vstack([_x[lags:] for _x in x])
+        ws = np.vstack([_gamma[lags:] for _gamma in gamma])
+        for k in range(K):
+            coef_, sigma = linear_regression(xs, ys, weights=ws[:, k],
+                                             fit_intercept=False)
+            assert np.allclose(obs.A[k], coef_[:, :dm_obs * lags])
+            assert np.allclose(obs.B[k], coef_[:, dm_obs * lags:-1])
+            assert np.allclose(obs.c[k], coef_[:, -1])
+            assert np.allclose(obs.cov[k], sigma)
+
+
+def gaussian_reference(obs, _x):
+    return np.column_stack([mvn(mean=obs.mu[k], cov=obs.cov[k]).logpdf(_x)
+                            for k in range(K)])
+
+
+def test_covariance_types():
+    gamma = [np.random.dirichlet(np.ones(K), size=_T) for _T in T]
+
+    for cov_type in ['diagonal', 'tied']:
+        obs = GaussianObservation(K, dm_obs, dm_act, prior={}, cov_type=cov_type)
+        full = GaussianObservation(K, dm_obs, dm_act, prior={})
+
+        for _ in range(2):
+            # diagonal factors or one factor shared by all states
+            if cov_type == 'diagonal':
+                assert np.allclose(obs.cov, obs.cov * np.eye(dm_obs))
+            else:
+                assert np.allclose(obs.cov, obs.cov[0])
+
+            for _x, _loglik in zip(x, obs.log_likelihood(x, u)):
+                assert np.allclose(_loglik, gaussian_reference(obs, _x))
+
+            obs.mstep(gamma, x, u)
+            full.mstep(gamma, x, u)
+
+        # restricted estimates follow from the full per-state ones
+        weights = np.sum(np.vstack(gamma), axis=0)
+        if cov_type == 'diagonal':
+            assert np.allclose(obs.cov, full.cov * np.eye(dm_obs))
+        else:
+            _cov = np.einsum('k,kij->ij', weights, full.cov) / np.sum(weights)
+            assert np.allclose(obs.cov, _cov)
+
+    for cov_type in ['diagonal', 'tied']:
+        for lags in [1, 2]:
+            obs = AutoRegressiveGaussianObservation(K, dm_obs, dm_act, prior={},
+                                                    cov_type=cov_type, lags=lags)
+
+            for _ in range(2):
+                if cov_type == 'diagonal':
+                    assert np.allclose(obs.cov, obs.cov * np.eye(dm_obs))
+                else:
+                    assert np.allclose(obs.cov, obs.cov[0])
+
+                for _x, _u, _loglik in zip(x, u, obs.log_likelihood(x, u)):
+                    _xs, _us = regressors(_x, _u, lags)[:, :-dm_act], _u[lags - 1:-1]
+                    _resid = [_x[lags:] - obs.mean(k, _xs, _us) for k in range(K)]
+                    _ref = np.column_stack([mvn(mean=np.zeros(dm_obs), cov=obs.cov[k]).logpdf(_resid[k])
+                                            for k in range(K)])
+                    assert np.allclose(_loglik, _ref)
+
+                obs.mstep(gamma, x, u)
+
+
+def marginal_reference(y, mu, cov):
+    # scipy density of the observed dimensions, one for no observation
+    _obs = ~np.isnan(y)
+    if not np.any(_obs):
+        return 0.
+    return mvn(mean=mu[_obs], cov=cov[np.ix_(_obs, _obs)]).logpdf(y[_obs])
+
+
+def test_masked_log_likelihood():
+    _x = [np.array(_x) for _x in x]
+    for _X in _x:
+        _X[np.random.rand(*_X.shape) < 0.2] = np.nan
+        _X[3] = np.nan
+
+    for cov_type in ['full', 'diagonal', 'tied']:
+        obs = GaussianObservation(K, dm_obs, dm_act, prior={}, cov_type=cov_type)
+        for _X, _loglik in zip(_x, obs.log_likelihood(_x, u)):
+            _ref = [[marginal_reference(_X[t], obs.mu[k], obs.cov[k])
+                     for k in range(K)] for t in range(len(_X))]
+            assert np.allclose(_loglik, _ref)
+
+        for lags in [1, 2]:
+            obs = AutoRegressiveGaussianObservation(K, dm_obs, dm_act, prior={},
+                                                    cov_type=cov_type, lags=lags)
+            for _X, _u, _loglik in zip(_x, u, obs.log_likelihood(_x, u)):
+                _xs = regressors(_X, _u, lags)
+                _ref = np.zeros((len(_X) - lags, K))
+                for t in range(len(_X) - lags):
+                    # steps with missing inputs carry no information
+                    if np.any(np.isnan(_xs[t])):
+                        continue
+                    for k in range(K):
+                        _mu = obs.mean(k, _xs[t, :-dm_act], _xs[t, -dm_act:])
+                        _ref[t, k] = marginal_reference(_X[lags + t], _mu, obs.cov[k])
+                assert np.allclose(_loglik, _ref)
+
+
+def test_batch_linear_regression():
+    # near-perfect fits take the second pass, unused states have no scatter
+    xs = [np.column_stack((np.random.randn(_T, 3), np.ones(_T))) for _T in T]
+    coef = np.random.randn(2, 4)
+    ys = [np.dot(_xs, coef.T) + 1e-7 * np.random.randn(len(_xs), 2) for _xs in xs]
+    ws = [np.random.dirichlet(np.ones(K), size=len(_xs)) for _xs in xs]
+    for _ws in ws:
+        _ws[:, -1] = 0.
+
+    W, Sigma = batch_linear_regression(xs, ys, ws)
+    for k in range(K - 1):
+        coef_, sigma = linear_regression(xs, ys, weights=[_ws[:, k] for _ws in ws],
+                                         fit_intercept=False)
+        assert np.allclose(W[k], coef_)
+        assert np.allclose(Sigma[k], sigma, rtol=1e-6, atol=0.)
+    assert np.allclose(Sigma[-1], 0., atol=1e-30)
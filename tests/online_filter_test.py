@@ -0,0 +1,51 @@
+import numpy as np
+import torch
+from sds.hmm import HMM
+from sds.arhmm import ARHMM
+from sds.rarhmm import rARHMM
+from sds.erarhmm import erARHMM
+
+import warnings
+
+warnings.simplefilter(action='ignore', category=FutureWarning)
+np.random.seed(1337)
+torch.manual_seed(1337)
+
+T = 50
+
+x = [0.1 * np.cumsum(np.random.randn(T, 2), axis=0) for _ in range(3)]
+u = [np.random.randn(T, 1) for _ in range(3)]
+
+
+def batch_belief(model, t):
+    # last forward message of the batch filter on the first t + 1 steps,
+    # without the control term of step t whose action is not known yet
+    _x, _u = [_x[:t + 1] for _x in x], [_u[:t + 1] for _u in u]
+    belief = np.stack([_b[-1] for _b in model.filter(_x, _u)])
+    loglikhds = model.log_likelihoods(_x, _u)
+    if len(loglikhds) > 3 and t > 0:
+        belief *= np.exp(- np.stack([_logctl[-1] for _logctl in loglikhds[3]]))
+    return belief / np.sum(belief, axis=-1, keepdims=True)
+
+
+def test_online_filter():
+    models = [HMM(nb_states=3, dm_obs=2, dm_act=1),
+              ARHMM(nb_states=3, dm_obs=2, dm_act=1, obs_kwargs={'lags': 2}),
+              rARHMM(nb_states=3, dm_obs=2, dm_act=1, trans_type='poly'),
+              rARHMM(nb_states=3, dm_obs=2, dm_act=1, trans_type='neural'),
+              erARHMM(nb_states=3, dm_obs=2, dm_act=1, learn_ctl=True),
+              erARHMM(nb_states=3, dm_obs=2, dm_act=1, ar_ctl=True, lags=2, learn_ctl=True)]
+
+    for model in models:
+        online_filter = model.online_filter(nb_streams=len(x))
+        for t in range(T):
+            _act = np.stack([_u[t - 1] for _u in u]) if t > 0 else None
+            belief = online_filter.update(np.stack([_x[t] for _x in x]), _act)
+            # batch likelihoods need at least lags steps
+            if t >= 2:
+                assert np.allclose(belief, batch_belief(model, t), atol=1e-6)
+
+        # the filter evaluates its terms without the likelihood cache
+        model.cache.clear()
+        online_filter.update(np.stack([_x[0] for _x in x]), np.stack([_u[0] for _u in u]))
+        assert len(model.cache.entries) == 0
@@ -0,0 +1,96 @@
+import numpy as np
+import torch
+from scipy.special import logsumexp
+from sds.hmm import HMM, dense_logtrans
+from sds.arhmm import ARHMM
+from sds.rarhmm import rARHMM
+from sds.erarhmm import erARHMM
+
+import warnings
+
+warnings.simplefilter(action='ignore', category=FutureWarning)
+np.random.seed(1337)
+torch.manual_seed(1337)
+
+T = [120, 95]
+
+K = 6
+
+true_hmm = HMM(nb_states=3, dm_obs=2)
+true_z, x = true_hmm.sample(horizon=T)
+u = [np.random.randn(_T, 1) for _T in T]
+
+
+def models():
+    return [(HMM(nb_states=K, dm_obs=2), None),
+            (ARHMM(nb_states=K, dm_obs=2), None),
+            (ARHMM(nb_states=K, dm_obs=2, trans_type='sparse',
+                   trans_kwargs={'support': np.eye(K, dtype=bool) | (np.random.rand(K, K) < 0.5)}), None),
+            (ARHMM(nb_states=K, dm_obs=2, trans_type='lowrank', trans_kwargs={'rank': 2}), None),
+            (rARHMM(nb_states=K, dm_obs=2, trans_type='poly'), None),
+            (rARHMM(nb_states=K, dm_obs=2, trans_type='neural'), None),
+            (erARHMM(nb_states=K, dm_obs=2, dm_act=1, trans_type='poly',
+                     learn_ctl=True, ar_ctl=True), u)]
+
+
+def components(model):
+    names = ['init_state', 'init_observation', 'transitions', 'observations',
+             'init_control', 'controls']
+    return [getattr(model, _name) for _name in names if hasattr(model, _name)]
+
+
+def normalize(logmat):
+    return np.exp(logmat - logsumexp(logmat, axis=-1, keepdims=True))
+
+
+def test_permute():
+    # reordering the states leaves the likelihood unchanged
+    for model, act in models():
+        model.initialize(x, act)
+        loglik = model.log_norm(x, act)
+        model.permute(np.random.permutation(K))
+        assert np.isclose(model.log_norm(x, act), loglik)
+
+
+def test_prune():
+    keep = np.array([0, 2, 3, 5])
+    gamma = [np.random.dirichlet(np.ones(K), size=_T) for _T in T]
+    for _gamma in gamma:
+        _gamma[:, np.setdiff1d(np.arange(K), keep)] = 0.
+
+    for model, act in models():
+        model.initialize(x, act)
+        pi, logmat = model.init_state.pi, np.array(model.transitions.logmat)
+        logu = getattr(model.transitions, 'logu', None)
+        params = model.observations.params
+
+        assert not model.prune([np.ones((_T, K)) for _T in T])
+        assert model.prune(gamma)
+
+        # every part of the model shrinks to the surviving states
+        assert model.nb_states == len(keep)
+        for _component in components(model):
+            assert _component.nb_states == len(keep)
+        loglikhds = model.log_likelihoods(x, act)
+        assert loglikhds[0].shape == (len(keep), )
+        for _logtrans in dense_logtrans(loglikhds[1]):
+            assert _logtrans.shape[-2:] == (len(keep), len(keep))
+        for _loglik in loglikhds[2:]:
+            assert all(_l.shape[-1] == len(keep) for _l in _loglik)
+
+        # and keeps their parameters in order
+        assert np.allclose(model.init_state.pi, pi[keep] / np.sum(pi[keep]))
+        for _p, p in zip(model.observations.params, params):
+            assert np.allclose(_p, p[keep])
+        if model.trans_type == 'lowrank':
+            # the intermediate states renormalize over the survivors
+            assert np.allclose(model.transitions.logu, logu[keep])
+            assert np.allclose(np.sum(model.transitions.matrix, axis=-1), 1.)
+        else:
+            # rows of logmat are only defined up to a constant
+            _logmat = logmat[np.ix_(keep, keep)]
+            assert np.allclose(normalize(np.array(model.transitions.logmat)), normalize(_logmat))
+
+        # em runs on from the smaller model
+        model.em(x, act, nb_iter=2, prec=0., prune=1.)
+        assert all(_component.nb_states == model.nb_states for _component in components(model))
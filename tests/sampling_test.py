@@ -0,0 +1,73 @@
+import numpy as np
+import torch
+from sds.hmm import HMM
+from sds.arhmm import ARHMM
+from sds.rarhmm import rARHMM
+from sds.utils import random_rotation
+
+import warnings
+
+warnings.simplefilter(action='ignore', category=FutureWarning)
+np.random.seed(1337)
+torch.manual_seed(1337)
+
+N, T = 1000, 200
+
+
+def test_hmm_sample_batch():
+    model = HMM(nb_states=3, dm_obs=2)
+    z, x = model.sample_batch(nb_samples=N, horizon=T)
+    assert len(z) == N and x[0].shape == (T, 2)
+    z, x = np.array(z), np.array(x)
+
+    assert np.allclose(np.bincount(z[:, 0], minlength=3) / N, model.init_state.pi, atol=0.05)
+
+    counts = np.zeros((3, 3))
+    np.add.at(counts, (z[:, :-1].ravel(), z[:, 1:].ravel()), 1)
+    trans = counts / np.sum(counts, axis=1, keepdims=True)
+    assert np.allclose(trans, model.transitions.matrix, atol=0.01)
+
+    for k in range(3):
+        _x, _cov = x[z == k], model.observations.cov[k]
+        assert np.allclose(np.mean(_x, axis=0), model.observations.mu[k],
+                           atol=0.05 * np.sqrt(np.max(np.diag(_cov))))
+        assert np.allclose(np.cov(_x.T), _cov, atol=0.05 * np.max(np.diag(_cov)))
+
+
+def test_arhmm_sample_batch():
+    for lags in [1, 2]:
+        model = ARHMM(nb_states=2, dm_obs=2, obs_kwargs={'lags': lags})
+        # stable dynamics keep the samples bounded
+        for k in range(2):
+            model.observations.A[k] = np.hstack([.9 / lags * random_rotation(2)] * lags)
+
+        z, x = model.sample_batch(nb_samples=N, horizon=T)
+        z, x = np.array(z), np.array(x)
+
+        # one-step residuals of every state follow its noise model
+        xs = np.concatenate([x[:, t - lags:t].reshape(N, -1) for t in range(lags, T)])
+        ys = np.concatenate([x[:, t] for t in range(lags, T)])
+        zs = np.concatenate([z[:, t] for t in range(lags, T)])
+        for k in range(2):
+            _resid = ys[zs == k] - np.dot(xs[zs == k], model.observations.A[k].T)\
+                     - model.observations.c[k]
+            _cov = model.observations.cov[k]
+            assert np.allclose(np.mean(_resid, axis=0), 0., atol=0.05 * np.sqrt(np.max(np.diag(_cov))))
+            assert np.allclose(np.cov(_resid.T), _cov, atol=0.05 * np.max(np.diag(_cov)))
+
+
+def test_rarhmm_sample_batch():
+    model = rARHMM(nb_states=3, dm_obs=2, trans_type='poly')
+    for k in range(3):
+        model.observations.A[k] = .9 * random_rotation(2)
+
+    z, x = model.sample_batch(nb_samples=N, horizon=T)
+    z, x = np.array(z), np.array(x)
+
+    # empirical next-state frequencies match the recurrent
+    # transition probabilities at the sampled observations
+    _u = np.zeros((N * (T - 1), 0))
+    cdf = model.transitions.cdf(x[:, :-1].reshape(-1, 2), _u)
+    probs = np.diff(cdf, prepend=0., axis=-1)[np.arange(N * (T - 1)), z[:, :-1].ravel()]
+    assert np.allclose(np.mean(probs, axis=0),
+                       np.bincount(z[:, 1:].ravel(), minlength=3) / (N * (T - 1)), atol=0.01)
@@ -0,0 +1,66 @@
+import numpy as np
+import torch
+import sds.hmm
+
+import warnings
+
+warnings.simplefilter(action='ignore', category=FutureWarning)
+np.random.seed(1337)
+torch.manual_seed(1337)
+
+T = [300, 257]
+
+
+def test_checkpointed_statistics(sampled_models):
+    x, hmm, rarhmm = sampled_models
+    for model in [hmm, rarhmm]:
+        loglikhds = model.log_likelihoods(x)
+        gamma, zeta, norm = model.expected_statistics(*loglikhds)
+
+        # default sqrt(T) stride, a short one and a single segment
+        for stride in [0, 7, max(T)]:
+            _gamma, _zeta, _loglik = model.checkpointed_statistics(*loglikhds, stride=stride)
+            assert np.allclose(np.sum(_loglik), np.sum(np.hstack(norm)))
+            for _g, g, _z, z in zip(_gamma, gamma, _zeta, zeta):
+                assert np.allclose(_g, g)
+                for _s, s in zip(_z, z):
+                    assert np.allclose(_s, s)
+
+
+def test_checkpointed_estep(sampled_models):
+    x, hmm, rarhmm = sampled_models
+    for model in [hmm, rarhmm]:
+        gamma, zeta, ll = model.estep(x, reduce=True)
+        _gamma, _zeta, _ll = model.estep(x, reduce=True, checkpoint=True)
+        assert np.allclose(_ll, ll)
+
+        try:
+            model.estep(x, checkpoint=True)
+            assert False
+        except ValueError:
+            pass
+
+
+def test_scan(sampled_models):
+    x, hmm, rarhmm = sampled_models
+    # sequences are cut into as many blocks as there are cores
+    nb_cores = sds.hmm.nb_cores
+    try:
+        for model in [hmm, rarhmm]:
+            loglikhds = model.log_likelihoods(x)
+            alpha, norm = model.forward(*loglikhds)
+            beta = model.backward(*loglikhds, scale=norm)
+
+            for nb_blocks in [1, 4, 16]:
+                sds.hmm.nb_cores = nb_blocks
+
+                _alpha, _norm = model.forward(*loglikhds, scan=True)
+                for _a, a, _n, n in zip(_alpha, alpha, _norm, norm):
+                    assert np.allclose(_a, a)
+                    assert np.allclose(_n, n)
+
+                _beta = model.backward(*loglikhds, scale=norm, scan=True)
+                for _b, b in zip(_beta, beta):
+                    assert np.allclose(_b, b)
+    finally:
+        sds.hmm.nb_cores = nb_cores
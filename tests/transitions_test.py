@@ -0,0 +1,140 @@
+import numpy as np
+import torch
+import pytest
+from sds.transitions import PolyRecurrentTransition
+from sds.transitions import NeuralRecurrentTransition
+from sds.utils import to_float, np_float
+
+from sklearn.preprocessing import PolynomialFeatures
+
+import warnings
+
+warnings.simplefilter(action='ignore', category=FutureWarning)
+np.random.seed(1337)
+torch.manual_seed(1337)
+
+T = [80, 65]
+
+K, dm_obs, dm_act = 3, 2, 1
+
+x = [np.random.randn(_T, dm_obs) for _T in T]
+u = [np.random.randn(_T, dm_act) for _T in T]
+
+# random joint posteriors of the transitions
+zeta = [np.random.dirichlet(np.ones(K * K), size=_T - 1).reshape(_T - 1, K, K) for _T in T]
+
+norm = {'mean': np.random.randn(1, dm_obs + dm_act),
+        'std': np.random.rand(1, dm_obs + dm_act) + 0.5}
+
+
+def recurrent_transitions():
+    return [PolyRecurrentTransition(K, dm_obs, dm_act, prior={}, norm=norm, degree=2),
+            NeuralRecurrentTransition(K, dm_obs, dm_act, prior={}, norm=norm,
+                                      hidden_layer_sizes=(8, ), nonlinearity='tanh')]
+
+
+def compare_probs(trans):
+    for _x, _u in zip(x, u):
+        _logtrans = np_float(trans.regressor.forward(np.hstack((_x, _u))))
+        for t in range(0, len(_x), 10):
+            for z in range(K):
+                assert np.allclose(trans.probs(z, _x[t], _u[t]), np.exp(_logtrans[t, z]))
+
+
+def test_probs():
+    for trans in recurrent_transitions():
+        compare_probs(trans)
+
+        # the numpy copies follow every change of the parameters
+        trans.logmat = np.array(trans.logmat) + np.random.randn(K, K)
+        compare_probs(trans)
+
+        if isinstance(trans, PolyRecurrentTransition):
+            trans.coef = np.random.randn(*np.shape(trans.coef))
+        else:
+            trans.weights = [np.random.randn(*_w.shape) for _w in trans.weights]
+            compare_probs(trans)
+            trans.biases = [np.random.randn(*_b.shape) for _b in trans.biases]
+        compare_probs(trans)
+
+        trans.mstep(zeta, x, u, nb_iter=5, lr=1e-2)
+        compare_probs(trans)
+
+
+def test_featurize():
+    xu = np.hstack((np.vstack(x), np.vstack(u)))
+    _xu = (xu - norm['mean']) / norm['std']
+    for degree in [1, 2, 3]:
+        trans = PolyRecurrentTransition(K, dm_obs, dm_act, prior={}, norm=norm, degree=degree)
+        regressor = trans.regressor
+
+        # same monomials in the same order as sklearn
+        feat = regressor.featurize(to_float(xu))
+        _feat = PolynomialFeatures(degree, include_bias=False).fit_transform(_xu)
+        assert feat.shape == (len(xu), regressor.nb_feat)
+        assert np.allclose(np_float(feat), _feat, atol=1e-4)
+
+        # gradients reach the coefficients through the basis
+        w = to_float(np.random.randn(len(xu), K))
+        regressor.coef.grad = None
+        torch.sum(w * regressor.propagate(to_float(xu))).backward()
+        assert np.allclose(np_float(regressor.coef.grad), np.dot(np_float(w).T, _feat), rtol=1e-3, atol=1e-3)
+
+
+def transition_elbo(trans):
+    # elbo of the regressor at the reduced statistics of zeta
+    _, feat = trans.features(x, u)
+    counts = to_float(sum([np.sum(_zeta, axis=0) for _zeta in zeta]))
+    frm = to_float(np.vstack([np.sum(_zeta, axis=2) for _zeta in zeta]))
+    to = to_float(np.vstack([np.sum(_zeta, axis=1) for _zeta in zeta]))
+    with torch.no_grad():
+        return trans.regressor.elbo(counts, frm, to, feat, len(feat), len(feat)).item()
+
+
+def test_adam_mstep():
+    # minibatches are drawn at random, independent of the other tests
+    torch.manual_seed(1337)
+    for trans in recurrent_transitions():
+        elbo = transition_elbo(trans)
+        trans.mstep(zeta, x, u, nb_iter=50, lr=1e-2)
+        optim = trans.regressor.optim
+
+        # the optimizer is kept and carries on from where it stopped
+        for _ in range(3):
+            _elbo = transition_elbo(trans)
+            assert _elbo > elbo
+            elbo = _elbo
+            trans.mstep(zeta, x, u, nb_iter=50, lr=1e-2, batch_size=32)
+            assert trans.regressor.optim is optim
+
+        # a loose tolerance stops early, close to where it started
+        elbo = transition_elbo(trans)
+        trans.mstep(zeta, x, u, nb_iter=1000, lr=1e-3, tol=1.)
+        assert np.isclose(transition_elbo(trans), elbo, rtol=1e-2)
+
+
+def test_lbfgs_mstep():
+    trans = PolyRecurrentTransition(K, dm_obs, dm_act, prior={}, norm=norm, degree=2)
+    adam = PolyRecurrentTransition(K, dm_obs, dm_act, prior={}, norm=norm, degree=2)
+    adam.logmat, adam.coef = np.array(trans.logmat), np.array(trans.coef)
+
+    elbo = transition_elbo(trans)
+    trans.mstep(zeta, x, u, nb_iter=100, method='lbfgs')
+    _elbo = transition_elbo(trans)
+    assert _elbo > elbo
+
+    # the elbo is concave, the quasi-newton step lands on the optimum
+    trans.mstep(zeta, x, u, nb_iter=100, method='lbfgs')
+    assert np.isclose(transition_elbo(trans), _elbo, rtol=1e-4)
+
+    # adam moments from before the step are dropped
+    trans.mstep(zeta, x, u, nb_iter=5, lr=1e-2)
+    assert trans.regressor.optim is not None
+    trans.mstep(zeta, x, u, nb_iter=100, method='lbfgs')
+    assert trans.regressor.optim is None
+
+    with pytest.raises(ValueError):
+        trans.mstep(zeta, x, u, nb_iter=100, batch_size=32, method='lbfgs')
+
+    adam.mstep(zeta, x, u, nb_iter=500, lr=1e-2)
+    assert transition_elbo(adam) <= _elbo + 1e-4 * abs(_elbo)